@@ -1,18 +1,356 @@
-"""Trapper Keeper main module."""
+"""Trapper Keeper main module.
 
+The CLI is called from shell hooks in tight loops, so only Typer and the light `paths`/`profiling` modules are imported
+here.  Each command imports its backend (pykeepass, sqlite, BoltDB) when it runs, which keeps ``--help`` and the
+commands that do not touch a vault from paying for the whole stack.
+"""
+
+import sys
+from pathlib import Path
+from typing import Annotated
+
+import typer
 from typer import Typer
 
+from trapper_keeper.util import profiling
+from trapper_keeper.util.paths import KEEPASS_DB_KEY, KEEPASS_DB_PATH, KEEPASS_DB_TOKEN, KV_STORE
+
 app = Typer()
 
+VaultOption = Annotated[Path, typer.Option("--vault", help="KeePass database")]
+TokenOption = Annotated[Path, typer.Option("--token", help="File holding the database password")]
+KeyOption = Annotated[Path, typer.Option("--key", help="Key file of the database")]
+
+
+@app.callback()
+def main(
+  ctx: typer.Context,
+  profile: Annotated[bool, typer.Option("--profile", help="Print a timing breakdown to stderr when done")] = False,
+  profile_output: Annotated[Path | None, typer.Option(help="Write spans and counters as a Chrome trace JSON")] = None,
+  cprofile: Annotated[Path | None, typer.Option(help="Dump cProfile stats of the command, see pstats")] = None,
+):
+  if not (profile or profile_output or cprofile):
+    return
+  profiler: profiling.Profiler = ctx.with_resource(profiling.profiling(cprofile=cprofile))
+
+  def report() -> None:
+    if profile_output is not None:
+      profiler.write(profile_output)
+    if profile:
+      typer.echo(profiler.report(), err=True)
+
+  # Resources close in reverse, so the command span below ends before the report is taken
+  ctx.call_on_close(report)
+  ctx.with_resource(profiling.span(f"command.{ctx.invoked_subcommand}"))
+
 
 @app.command(name="pack", short_help="Pack will create any files which are missing as well as the Keepass database itself.")
 def pack_db():
   pass
 
 
-def unpack_db():
-  pass
+@app.command(name="unpack", short_help="Takes the artifacts and unpacks them back to where they were originally.")
+def unpack_db(
+  include: Annotated[list[str] | None, typer.Option(help="Glob of attachment paths to unpack, repeatable")] = None,
+  root: Annotated[Path | None, typer.Option(help="Unpack under this directory instead of /")] = None,
+  vault: VaultOption = KEEPASS_DB_PATH,
+  token: TokenOption = KEEPASS_DB_TOKEN,
+  key: KeyOption = KEEPASS_DB_KEY,
+):
+  from trapper_keeper.util.db_utils import DbUtils
 
+  report = DbUtils.unpack_tk_store(kp_fp=vault, kp_token=token, kp_key=key, include=include, root=root)
+  typer.echo(f"{len(report.written)} written, {len(report.skipped)} already up to date")
 
-def repack_db():
-  pass
+
+@app.command(name="export-tar", short_help="Stream the artifacts as a tar archive, e.g. into a container build.")
+def export_tar(
+  include: Annotated[list[str] | None, typer.Option(help="Glob of attachment paths to export, repeatable")] = None,
+  output: Annotated[Path | None, typer.Option(help="Write the archive here instead of stdout")] = None,
+  vault: VaultOption = KEEPASS_DB_PATH,
+  token: TokenOption = KEEPASS_DB_TOKEN,
+  key: KeyOption = KEEPASS_DB_KEY,
+):
+  from trapper_keeper.util.db_utils import DbUtils
+
+  if output is None:
+    report = DbUtils.export_tk_tar(kp_fp=vault, kp_token=token, kp_key=key, fileobj=sys.stdout.buffer, include=include)
+    sys.stdout.buffer.flush()
+  else:
+    with open(output, mode="wb") as archive:
+      report = DbUtils.export_tk_tar(kp_fp=vault, kp_token=token, kp_key=key, fileobj=archive, include=include)
+  typer.echo(f"{len(report.written)} exported", err=True)
+
+
+@app.command(name="import-tar", short_help="Pack the files of a tar archive read from stdin into the vault.")
+def import_tar(
+  archive: Annotated[Path | None, typer.Option("--input", help="Read the archive from here instead of stdin")] = None,
+  vault: VaultOption = KEEPASS_DB_PATH,
+  token: TokenOption = KEEPASS_DB_TOKEN,
+  key: KeyOption = KEEPASS_DB_KEY,
+):
+  from trapper_keeper.util.db_utils import DbUtils
+
+  if archive is None:
+    report = DbUtils.import_tk_tar(kp_fp=vault, kp_token=token, kp_key=key, fileobj=sys.stdin.buffer)
+  else:
+    with open(archive, mode="rb") as fileobj:
+      report = DbUtils.import_tk_tar(kp_fp=vault, kp_token=token, kp_key=key, fileobj=fileobj)
+  typer.echo(f"{len(report.attached)} attached, {len(report.unchanged)} unchanged")
+
+
+@app.command(name="repack", short_help="Pack what changed in the XDG directories into an existing vault.")
+def repack_db(
+  root: Annotated[list[Path] | None, typer.Option(help="Directory to gather from, repeatable, defaults to the XDG homes")] = None,
+  include: Annotated[list[str] | None, typer.Option(help="Glob of files to gather, repeatable, defaults to all")] = None,
+  exclude: Annotated[list[str] | None, typer.Option(help="Glob of files or directories to leave out, repeatable")] = None,
+  workers: Annotated[int | None, typer.Option(min=1, help="Scanner threads, defaults to the executor's choice")] = None,
+  kv_store: Annotated[Path, typer.Option(help="Key/Value store holding the stat index")] = KV_STORE,
+  vault: VaultOption = KEEPASS_DB_PATH,
+  token: TokenOption = KEEPASS_DB_TOKEN,
+  key: KeyOption = KEEPASS_DB_KEY,
+):
+  from trapper_keeper.util.db_utils import DbUtils
+  from trapper_keeper.util.discovery import DEFAULT_EXCLUDES, ScanRules
+
+  rules = ScanRules(include=tuple(include or ("*",)), exclude=DEFAULT_EXCLUDES + tuple(exclude or ()))
+  report = DbUtils.repack_tk_store(kp_fp=vault, kp_token=token, kp_key=key, kv_fp=kv_store, roots=root, rules=rules,
+                                   workers=workers)
+  found = report.discovery
+  typer.echo(f"{found.scanned} files scanned, {found.hashed} hashed, {len(found.changed)} changed, "
+             f"{len(found.removed)} gone in {found.seconds:.3f}s")
+  for error in found.errors:
+    typer.echo(f"unreadable {error}", err=True)
+  if report.pack is not None:
+    typer.echo(f"{len(report.pack.attached)} attached, {len(report.pack.unchanged)} unchanged")
+
+
+@app.command(name="compact", short_help="Drop unreferenced and duplicate attachment payloads from the vault.")
+def compact_db(
+  vault: VaultOption = KEEPASS_DB_PATH,
+  token: TokenOption = KEEPASS_DB_TOKEN,
+  key: KeyOption = KEEPASS_DB_KEY,
+):
+  from trapper_keeper.util.db_utils import DbUtils
+
+  report = DbUtils.compact_tk_store(kp_fp=vault, kp_token=token, kp_key=key)
+  typer.echo(f"{report.binaries} binaries, {report.kept} kept: {report.unreferenced} unreferenced, "
+             f"{report.duplicates} duplicates, {report.bytes_reclaimed:,} bytes reclaimed")
+  if report.dangling:
+    typer.echo(f"{report.dangling} attachments referred to missing binaries and were removed", err=True)
+
+
+@app.command(name="index", short_help="Keep a lookup index next to the vault so opening it skips the tree walk.")
+def index_db(
+  drop: Annotated[bool, typer.Option("--drop", help="Delete the index file instead")] = False,
+  vault: VaultOption = KEEPASS_DB_PATH,
+  token: TokenOption = KEEPASS_DB_TOKEN,
+  key: KeyOption = KEEPASS_DB_KEY,
+):
+  if drop:
+    from trapper_keeper.util.vault_index import index_path
+
+    index_path(vault).unlink(missing_ok=True)
+    return
+  from trapper_keeper.util.db_utils import DbUtils
+
+  typer.echo(DbUtils.index_tk_store(kp_fp=vault, kp_token=token, kp_key=key))
+
+
+@app.command(name="ingest", short_help="Sync chezmoi's BoltDB state into the Key/Value store.")
+def ingest_boltdb(
+  bolt: Annotated[Path, typer.Argument(help="chezmoi state database, e.g. ~/.config/chezmoi/chezmoistate.boltdb")],
+  bucket: Annotated[list[str] | None, typer.Option(help="Bucket to sync, repeatable, defaults to chezmoi's")] = None,
+  kv_store: Annotated[Path, typer.Option(help="Key/Value store to sync into")] = KV_STORE,
+):
+  from trapper_keeper.util.db_utils import DbUtils
+
+  report = DbUtils.ingest_boltdb_store(bp_fp=bolt, kv_fp=kv_store, buckets=bucket)
+  typer.echo(f"{report.written} written, {report.deleted} deleted, {report.unchanged} unchanged, "
+             f"{len(report.skipped)} buckets skipped")
+
+
+@app.command(name="export", short_help="Write chezmoi's BoltDB state back out of the Key/Value store.")
+def export_boltdb(
+  bolt: Annotated[Path, typer.Argument(help="chezmoi state database to write")],
+  bucket: Annotated[list[str] | None, typer.Option(help="Bucket to export, repeatable, defaults to chezmoi's")] = None,
+  kv_store: Annotated[Path, typer.Option(help="Key/Value store to export from")] = KV_STORE,
+):
+  from trapper_keeper.util.db_utils import DbUtils
+
+  report = DbUtils.export_boltdb_store(bp_fp=bolt, kv_fp=kv_store, buckets=bucket)
+  typer.echo(f"{report.written} written")
+
+
+@app.command(name="keygen", short_help="Mint token/key pairs for many images at once.")
+def keygen_batch(
+  dest: Annotated[Path, typer.Argument(help="Directory receiving one numbered subdirectory per credential pair")],
+  count: Annotated[int, typer.Option(min=1, help="Number of token/key pairs")] = 1,
+  workers: Annotated[int | None, typer.Option(help="Writer threads, defaults to the executor's choice")] = None,
+):
+  from trapper_keeper.util import keegen
+
+  _, report = keegen.gen_credentials(count=count, dest=dest, workers=workers)
+  typer.echo(f"{report.count} credentials ({report.files} files) in {report.seconds:.3f}s: "
+             f"generate {report.gen_seconds:.3f}s, write {report.write_seconds:.3f}s, {report.per_second:,.0f}/s")
+
+
+@app.command(name="get", short_help="Print a field of a vault entry.")
+def get_field(
+  title: Annotated[str, typer.Argument(help="Entry title")],
+  field_name: Annotated[str, typer.Option("--field", help="password, username, url, notes or a custom property")] = "password",
+  vault: VaultOption = KEEPASS_DB_PATH,
+  token: TokenOption = KEEPASS_DB_TOKEN,
+  key: KeyOption = KEEPASS_DB_KEY,
+):
+  from trapper_keeper.util.db_utils import DbUtils
+
+  value = DbUtils.read_field(kp_fp=vault, kp_token=token, kp_key=key, title=title, field_name=field_name)
+  typer.echo("" if value is None else value)
+
+
+@app.command(name="prop", short_help="Print a value of the vault's Key/Value store.")
+def get_property(
+  name: Annotated[str, typer.Argument(help="Key in the Key/Value store")],
+  vault: VaultOption = KEEPASS_DB_PATH,
+  token: TokenOption = KEEPASS_DB_TOKEN,
+  key: KeyOption = KEEPASS_DB_KEY,
+):
+  from trapper_keeper.util.db_utils import DbUtils
+
+  with DbUtils.load_kv_store(kp_fp=vault, kp_token=token, kp_key=key) as kv_store:
+    value = kv_store.get(name)
+  if value is None:
+    raise typer.Exit(code=1)
+  typer.echo(value)
+
+
+@app.command(name="cat", short_help="Write a packed artifact to stdout.")
+def cat_attachment(
+  filename: Annotated[str, typer.Argument(help="Path the artifact was packed from")],
+  vault: VaultOption = KEEPASS_DB_PATH,
+  token: TokenOption = KEEPASS_DB_TOKEN,
+  key: KeyOption = KEEPASS_DB_KEY,
+):
+  from trapper_keeper.util.db_utils import DbUtils
+
+  sys.stdout.buffer.write(DbUtils.read_attachment(kp_fp=vault, kp_token=token, kp_key=key, filename=filename))
+
+
+@app.command(name="bench", short_help="Benchmark the hot paths on synthetic data and print JSON results.")
+def run_bench(
+  case: Annotated[list[str] | None, typer.Option(help="Case to run, repeatable, one of vault, kv, keygen")] = None,
+  artifacts: Annotated[list[int] | None, typer.Option(help="Artifacts per vault, repeatable")] = None,
+  artifact_size: Annotated[list[int] | None, typer.Option(help="Bytes per artifact, repeatable")] = None,
+  rows: Annotated[list[int] | None, typer.Option(help="Key/Value store rows, repeatable")] = None,
+  token_length: Annotated[list[int] | None, typer.Option(help="Generated token length, repeatable")] = None,
+  kdf_iterations: Annotated[int | None, typer.Option(help="Argon2 iterations of the benchmark vaults")] = None,
+  kdf_memory: Annotated[int, typer.Option(help="Argon2 memory in KiB, with --kdf-iterations")] = 64 * 1024,
+  kdf_parallelism: Annotated[int, typer.Option(help="Argon2 lanes, with --kdf-iterations")] = 2,
+  repeat: Annotated[int, typer.Option(min=1, help="Repetitions per case, the best one counts")] = 3,
+  label: Annotated[str | None, typer.Option(help="Free form tag for the run, e.g. the commit")] = None,
+  output: Annotated[Path | None, typer.Option(help="Write the JSON here instead of stdout")] = None,
+  baseline: Annotated[Path | None, typer.Option(help="JSON of an earlier run to compare against")] = None,
+):
+  import json
+
+  from trapper_keeper import bench
+  from trapper_keeper.util.kdf import KdfParameters
+
+  kdf = None if kdf_iterations is None else KdfParameters(kdf_iterations, kdf_memory, kdf_parallelism)
+  results = bench.run(cases=case or bench.CASES, artifact_counts=artifacts or (10,), artifact_sizes=artifact_size or (4096,),
+                      kv_rows=rows or (10_000,), token_lengths=token_length or (40,), kdf=kdf, repeat=repeat,
+                      label=label)
+  document = json.dumps(results, indent=2)
+  if output is None:
+    typer.echo(document)
+  else:
+    output.write_text(document + "\n", encoding="utf-8")
+  if baseline is not None:
+    regressed = False
+    for key, before, after, slower in bench.compare(json.loads(baseline.read_text(encoding="utf-8")), results):
+      regressed |= slower
+      typer.echo(f"{'REGRESSED' if slower else 'ok':>9} {key}: {before:.4f}s -> {after:.4f}s ({after / before:.2f}x)",
+                 err=True)
+    if regressed:
+      raise typer.Exit(code=1)
+
+
+@app.command(name="fleet", short_help="Create or pack every vault listed in a fleet file across all cores.")
+def run_fleet(
+  manifest: Annotated[Path, typer.Argument(help="JSON list of vault/token/key/kv_store/artifacts objects")],
+  mode: Annotated[str, typer.Option(help="auto creates missing vaults and packs the others, or create, or pack")] = "auto",
+  workers: Annotated[int | None, typer.Option(min=1, help="Worker processes, defaults to the available cores")] = None,
+  kdf_iterations: Annotated[int | None, typer.Option(help="Argon2 iterations of created vaults")] = None,
+  kdf_memory: Annotated[int, typer.Option(help="Argon2 memory in KiB, with --kdf-iterations")] = 64 * 1024,
+  kdf_parallelism: Annotated[int, typer.Option(help="Argon2 lanes, with --kdf-iterations")] = 2,
+  kdf_target: Annotated[float | None, typer.Option(help="Calibrate created vaults to open in this many seconds")] = None,
+  output: Annotated[Path | None, typer.Option(help="Write the per-vault results as JSON")] = None,
+):
+  import json
+
+  from trapper_keeper import fleet
+  from trapper_keeper.util.kdf import KdfParameters, calibrate
+
+  def progress(result: "fleet.JobResult", done: int, total: int) -> None:
+    status = "ok" if result.ok else f"FAILED {result.error}"
+    typer.echo(f"[{done}/{total}] {result.action} {result.vault} {result.seconds:.2f}s {status}", err=True)
+
+  kdf = None if kdf_iterations is None else KdfParameters(kdf_iterations, kdf_memory, kdf_parallelism)
+  if kdf is None and kdf_target is not None:
+    # Once up front, calibrating in every worker would have them compete for the cores being measured
+    kdf = calibrate(target_seconds=kdf_target).parameters
+    typer.echo(f"calibrated {kdf}", err=True)
+  try:
+    report = fleet.run_fleet(fleet.load_fleet(manifest), mode=mode, workers=workers, kdf=kdf, progress=progress)
+  except ValueError as e:
+    raise typer.BadParameter(str(e)) from e
+  if output is not None:
+    output.write_text(json.dumps(report.to_dict(), indent=2) + "\n", encoding="utf-8")
+  typer.echo(f"{len(report.results) - len(report.failed)} ok, {len(report.failed)} failed in {report.seconds:.2f}s "
+             f"on {report.workers} workers ({report.job_seconds:.2f}s of work, {report.speedup:.1f}x)")
+  if report.failed:
+    raise typer.Exit(code=1)
+
+
+@app.command(name="calibrate", short_help="Pick Argon2 settings that unlock in a target time on this machine.")
+def calibrate_kdf(
+  target: Annotated[float, typer.Option(min=0.01, help="Seconds one unlock may take")] = 1.0,
+  max_memory: Annotated[int | None, typer.Option(min=8, help="Argon2 memory ceiling in KiB")] = None,
+  parallelism: Annotated[int | None, typer.Option(min=1, help="Argon2 lanes, defaults to the available cores")] = None,
+  apply: Annotated[bool, typer.Option("--apply", help="Re-encrypt the vault with the calibrated settings")] = False,
+  vault: VaultOption = KEEPASS_DB_PATH,
+  token: TokenOption = KEEPASS_DB_TOKEN,
+  key: KeyOption = KEEPASS_DB_KEY,
+):
+  from trapper_keeper.util import kdf
+
+  calibration = kdf.calibrate(target_seconds=target, max_memory_kib=max_memory, parallelism=parallelism)
+  chosen = calibration.parameters
+  typer.echo(f"{chosen.iterations} iterations, {chosen.memory_kib} KiB, {chosen.parallelism} lanes: "
+             f"{calibration.seconds:.3f}s per unlock after {calibration.trials} trials")
+  if apply:
+    from trapper_keeper.util.db_utils import DbUtils
+
+    saved = DbUtils.tune_tk_store(kp_fp=vault, kp_token=token, kp_key=key, kdf=chosen)
+    typer.echo(f"{vault} {'re-encrypted' if saved else 'already uses these settings'}")
+
+
+@app.command(name="agent", short_help="Run the unlock agent that keeps vaults open between invocations.")
+def run_agent(
+  idle_timeout: Annotated[float, typer.Option(help="Seconds before an unused vault is locked again")] = 15 * 60,
+  stop: Annotated[bool, typer.Option("--stop", help="Stop the running agent instead")] = False,
+):
+  from trapper_keeper import agent
+
+  if stop:
+    if (client := agent.AgentClient.connect()) is not None:
+      client.stop()
+    return
+  if (socket_path := agent.agent_socket_path()) is None:
+    raise typer.BadParameter("XDG_RUNTIME_DIR is not set, there is nowhere to put the agent socket")
+  agent.VaultAgent(socket_path, idle_timeout=idle_timeout).serve_forever()
+
+
+if __name__ == "__main__":
+  app()
@@ -0,0 +1,239 @@
+"""Local unlock agent that keeps decrypted vaults warm between CLI invocations.
+
+Opening a vault runs the KDF and parses the whole XML payload, which dominates short scripted lookups.  The agent is a
+small process listening on a Unix socket under ``xdg_runtime_dir()``.  It holds the vaults it has unlocked in memory
+and drops each one after `IDLE_TIMEOUT` seconds without use.  `DbUtils` and the CLI route their reads and writes through
+it whenever the socket exists, and fall back to opening the vault themselves otherwise.
+
+The protocol is one JSON request line and one JSON response line per connection.  Only processes of the agent's own
+user may connect, the socket lives in a 0700 directory and peer credentials are checked where the platform has them.
+"""
+
+import base64
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+from trapper_keeper import xdg_runtime_dir
+from trapper_keeper.util.db_utils import DbUtils
+from trapper_keeper.util.session import VaultSession
+
+IDLE_TIMEOUT: float = 15 * 60
+SOCKET_NAME: str = "trapper_keeper/agent.sock"
+# Large enough for attachments returned Base64 encoded
+MAX_LINE: int = 256 * 1024 * 1024
+
+
+class AgentError(RuntimeError):
+  """The agent answered a request with an error."""
+
+
+# Errors re-raised with their own type on the client side, anything else becomes an `AgentError`
+_PASSTHROUGH_ERRORS: dict[str, type[Exception]] = {error.__name__: error for error in (
+  AttributeError, FileNotFoundError, KeyError, ValueError,
+)}
+
+
+def agent_socket_path() -> Path | None:
+  """Where the agent listens, None when there is no XDG_RUNTIME_DIR to put it in."""
+  runtime_dir: Path | None = xdg_runtime_dir()
+  return None if runtime_dir is None else Path(runtime_dir, SOCKET_NAME)
+
+
+def _optional_path(value: str | None) -> Path | None:
+  return None if value is None else Path(value)
+
+
+@dataclass
+class _OpenVault:
+  session: VaultSession
+  stat: tuple[int, int]
+  last_used: float = field(default_factory=time.monotonic)
+  lock: threading.Lock = field(default_factory=threading.Lock)
+
+
+def _vault_stat(kp_fp: Path) -> tuple[int, int]:
+  stat = kp_fp.stat()
+  return stat.st_mtime_ns, stat.st_size
+
+
+class VaultAgent:
+  """Holds unlocked vaults, keyed by vault, token and key path, and answers requests against them."""
+
+  def __init__(self, socket_path: Path, idle_timeout: float = IDLE_TIMEOUT):
+    self.socket_path = socket_path
+    self.idle_timeout = idle_timeout
+    self._vaults: dict[tuple[str, str, str | None], _OpenVault] = {}
+    self._vaults_lock = threading.Lock()
+    self._server: socketserver.ThreadingUnixStreamServer | None = None
+
+  @staticmethod
+  def _vault_key(kp_fp: Path, kp_token: Path, kp_key: Path | None) -> tuple[str, str, str | None]:
+    return str(kp_fp.resolve()), str(kp_token.resolve()), None if kp_key is None else str(kp_key.resolve())
+
+  def _vault(self, kp_fp: Path, kp_token: Path, kp_key: Path | None) -> _OpenVault:
+    """The open vault for these credentials, unlocking it or reloading it if the file changed on disk."""
+    vault_key = self._vault_key(kp_fp, kp_token, kp_key)
+    stat = _vault_stat(kp_fp)
+    with self._vaults_lock:
+      vault: _OpenVault | None = self._vaults.get(vault_key)
+      if vault is None or vault.stat != stat:
+        # A stale copy would overwrite whatever another writer saved, so the file always wins
+        vault = _OpenVault(session=DbUtils.open_session(kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key), stat=stat)
+        self._vaults[vault_key] = vault
+      vault.last_used = time.monotonic()
+      return vault
+
+  def _discard(self, vault_key: tuple[str, str, str | None], vault: _OpenVault) -> None:
+    """Forget `vault` unless it was replaced already, the next request unlocks the file afresh."""
+    with self._vaults_lock:
+      if self._vaults.get(vault_key) is vault:
+        del self._vaults[vault_key]
+
+  def evict_idle(self) -> int:
+    """Forget vaults unused for `idle_timeout` seconds, returns how many were dropped."""
+    deadline: float = time.monotonic() - self.idle_timeout
+    with self._vaults_lock:
+      idle = [vault_key for vault_key, vault in self._vaults.items() if vault.last_used < deadline]
+      for vault_key in idle:
+        del self._vaults[vault_key]
+    return len(idle)
+
+  def handle(self, request: dict) -> object:
+    """Run one request and return its JSON serializable result."""
+    op: str = request.get("op", "")
+    if op == "ping":
+      return {"pid": os.getpid(), "vaults": len(self._vaults)}
+    if op == "lock":
+      with self._vaults_lock:
+        self._vaults.clear()
+      return None
+    if op == "stop":
+      threading.Thread(target=self.shutdown, daemon=True).start()
+      return None
+
+    kp_fp, kp_token, kp_key = Path(request["kp_fp"]), Path(request["kp_token"]), _optional_path(request.get("kp_key"))
+    vault: _OpenVault = self._vault(kp_fp, kp_token, kp_key)
+    with vault.lock:
+      if op == "attachment":
+        return base64.b64encode(DbUtils.read_kp_attachment(vault.session.kp_db, request["filename"])).decode("ascii")
+      if op == "properties":
+        return base64.b64encode(DbUtils.read_kp_properties(vault.session.kp_db)).decode("ascii")
+      if op == "field":
+        return DbUtils.read_kp_field(vault.session.kp_db, request["title"], request.get("field_name", "password"))
+      if op == "unpack":
+        report = DbUtils.unpack_kp_db(vault.session.kp_db, include=request.get("include"),
+                                      root=_optional_path(request.get("root")), workers=request.get("workers"))
+        return asdict(report)
+      if op == "pack":
+        try:
+          report = DbUtils.pack_kp_db(vault.session, kv_fp=_optional_path(request.get("kv_fp")),
+                                      artifacts=[Path(artifact) for artifact in request.get("artifacts", [])],
+                                      compress=request.get("compress", True))
+          report.saved = vault.session.flush()
+        except BaseException:
+          # The vault may be changed in memory and not saved, later requests must not see or flush that
+          self._discard(self._vault_key(kp_fp, kp_token, kp_key), vault)
+          raise
+        vault.stat = _vault_stat(kp_fp)
+        return asdict(report)
+    raise ValueError(f"Unknown agent operation {op!r}")
+
+  def serve_forever(self) -> None:
+    """Listen on `socket_path` until `shutdown`, evicting idle vaults along the way."""
+    self.socket_path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    self.socket_path.unlink(missing_ok=True)
+    agent = self
+
+    class Handler(socketserver.StreamRequestHandler):
+      def handle(self):
+        if not _same_user(self.connection):
+          return
+        try:
+          result = {"ok": True, "result": agent.handle(json.loads(self.rfile.readline(MAX_LINE)))}
+        except Exception as e:  # every failure is reported back to the client
+          result = {"ok": False, "type": type(e).__name__, "error": str(e)}
+        self.wfile.write(json.dumps(result).encode("utf-8") + b"\n")
+
+    old_umask = os.umask(0o177)
+    try:
+      self._server = socketserver.ThreadingUnixStreamServer(str(self.socket_path), Handler)
+    finally:
+      os.umask(old_umask)
+    self._server.daemon_threads = True
+    # serve_forever calls service_actions once per poll interval
+    self._server.service_actions = self.evict_idle
+    try:
+      self._server.serve_forever(poll_interval=0.5)
+    finally:
+      self._server.server_close()
+      self.socket_path.unlink(missing_ok=True)
+
+  def shutdown(self) -> None:
+    if self._server is not None:
+      self._server.shutdown()
+
+
+def _same_user(connection: socket.socket) -> bool:
+  """Whether the peer runs as our uid, assumed where SO_PEERCRED is unavailable and the 0600 socket has to do."""
+  if not hasattr(socket, "SO_PEERCRED"):
+    return True
+  creds = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+  _, uid, _ = struct.unpack("3i", creds)
+  return uid == os.getuid()
+
+
+def _absolute(value: object) -> str:
+  return str(value.absolute()) if isinstance(value, Path) else str(value)
+
+
+class AgentClient:
+  """Sends requests to a running `VaultAgent`."""
+
+  def __init__(self, socket_path: Path, timeout: float | None = None):
+    self.socket_path = socket_path
+    self.timeout = timeout
+
+  @classmethod
+  def connect(cls, socket_path: Path | None = None) -> "AgentClient | None":
+    """A client for the agent socket, or None when no agent is listening there."""
+    socket_path = socket_path or agent_socket_path()
+    if socket_path is None or not socket_path.is_socket():
+      return None
+    return cls(socket_path)
+
+  def request(self, op: str, **params) -> object:
+    """Send one request, raising `ConnectionError` when the agent is gone and `AgentError` when it failed."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+      conn.settimeout(self.timeout)
+      try:
+        conn.connect(str(self.socket_path))
+      except (FileNotFoundError, ConnectionRefusedError) as e:
+        raise ConnectionError(f"No agent listening on {self.socket_path}") from e
+      # The agent has its own working directory, so paths travel absolute
+      conn.sendall(json.dumps({"op": op, **params}, default=_absolute).encode("utf-8") + b"\n")
+      with conn.makefile("rb") as response_file:
+        line: bytes = response_file.readline(MAX_LINE)
+    if not line:
+      raise ConnectionError(f"Agent on {self.socket_path} closed the connection")
+    response: dict = json.loads(line)
+    if not response["ok"]:
+      if (error := _PASSTHROUGH_ERRORS.get(response["type"])) is not None:
+        raise error(response["error"])
+      raise AgentError(f"{response['type']}: {response['error']}")
+    return response["result"]
+
+  def ping(self) -> dict:
+    return self.request("ping")
+
+  def lock(self) -> None:
+    self.request("lock")
+
+  def stop(self) -> None:
+    self.request("stop")
@@ -0,0 +1,125 @@
+"""asyncio front-end for the key/value store and the vault operations.
+
+Everything underneath is blocking: sqlite calls, and PyKeePass opens and saves that spend hundreds of milliseconds in the
+KDF and in encryption.  The coroutines here push that work onto an executor so an event loop can drive many stores and
+vaults at once without stalling.  argon2 and the ciphers release the GIL, so a thread pool is enough to overlap them.
+"""
+
+import asyncio
+import contextlib
+import functools
+import itertools
+from collections.abc import AsyncIterator, Callable, Iterable, Mapping
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import TypeVar
+
+from trapper_keeper.sqlite_kvstore import FETCH_SIZE, SharedKeyValueStore, _prefix_upper_bound
+from trapper_keeper.util.db_utils import DbUtils, PackReport, UnpackReport
+from trapper_keeper.util.session import SaveStats
+
+T = TypeVar("T")
+
+
+async def _run(executor: Executor | None, func: Callable[..., T], *args, **kwargs) -> T:
+  """Run `func` on `executor`, or the loop's default executor when None."""
+  return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+class AsyncKeyValueStore:
+  """Awaitable wrapper around a `SharedKeyValueStore`.
+
+  Executor threads read through their own connections and writes are serialized by the underlying store, so any number
+  of coroutines may use one instance concurrently.
+  """
+
+  def __init__(self, store: SharedKeyValueStore, executor: Executor | None = None):
+    self.store = store
+    self.executor = executor
+
+  @classmethod
+  async def open(cls, filename: Path | str, executor: Executor | None = None, **kwargs) -> "AsyncKeyValueStore":
+    """Open a `SharedKeyValueStore` off the event loop, keyword arguments are passed through to it."""
+    return cls(await _run(executor, SharedKeyValueStore, filename, **kwargs), executor=executor)
+
+  async def get(self, key: str, default=None):
+    return await _run(self.executor, self.store.get, key, default)
+
+  async def getitem(self, key: str):
+    """Like ``store[key]``, raises `KeyError` when the key is absent."""
+    return await _run(self.executor, self.store.__getitem__, key)
+
+  async def set(self, key: str, value, ttl: float | None = None) -> None:
+    await _run(self.executor, self.store.set, key, value, ttl)
+
+  async def delete(self, key: str) -> None:
+    await _run(self.executor, self.store.__delitem__, key)
+
+  async def contains(self, key: str) -> bool:
+    return await _run(self.executor, self.store.__contains__, key)
+
+  async def length(self) -> int:
+    return await _run(self.executor, len, self.store)
+
+  async def set_many(self, items: Iterable[tuple[str, object]], ttl: float | None = None) -> None:
+    # Materialize here, a lazy iterable would otherwise be consumed on the executor thread
+    await _run(self.executor, self.store.set_many, list(items), ttl)
+
+  async def purge_expired(self) -> int:
+    return await _run(self.executor, self.store.purge_expired)
+
+  async def update(self, other: Mapping | Iterable[tuple[str, object]] = (), /, **kwargs) -> None:
+    if isinstance(other, Mapping):
+      other = other.items()
+    await self.set_many(itertools.chain(other, kwargs.items()))
+
+  async def scan(self, prefix: str = "", fetch_size: int = FETCH_SIZE) -> AsyncIterator[tuple[str, object]]:
+    """Async counterpart of `KeyValueStore.scan`.
+
+    Each page is an independent keyset query resuming after the last key seen, so no sqlite cursor is carried between
+    executor threads.
+    """
+    start: str = prefix
+    end: str | None = _prefix_upper_bound(prefix) if prefix else None
+    while True:
+      rows = await _run(self.executor, self._page, start, end, fetch_size)
+      for row in rows:
+        yield row
+      if len(rows) < fetch_size:
+        return
+      # "\0" appended gives the smallest key strictly greater than the last one returned
+      start = f"{rows[-1][0]}\0"
+
+  def _page(self, start: str, end: str | None, fetch_size: int) -> list[tuple[str, object]]:
+    with contextlib.closing(self.store.range(start, end, fetch_size=fetch_size)) as rows:
+      return list(itertools.islice(rows, fetch_size))
+
+  async def close(self) -> None:
+    await _run(self.executor, self.store.close)
+
+  async def __aenter__(self) -> "AsyncKeyValueStore":
+    return self
+
+  async def __aexit__(self, exc_type, exc_val, exc_tb):
+    await self.close()
+
+
+async def create_tk_store(kp_fp: Path, kp_token: Path, kp_key: Path, kv_fp: Path | None = None,
+                          artifacts: Iterable[Path] = (), executor: Executor | None = None) -> SaveStats:
+  """Awaitable `DbUtils.create_tk_store`."""
+  return await _run(executor, DbUtils.create_tk_store, kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key, kv_fp=kv_fp,
+                    artifacts=list(artifacts))
+
+
+async def pack_tk_store(kp_fp: Path, kp_token: Path, kp_key: Path, kv_fp: Path | None = None,
+                        artifacts: Iterable[Path] = (), executor: Executor | None = None) -> PackReport:
+  """Awaitable `DbUtils.pack_tk_store`."""
+  return await _run(executor, DbUtils.pack_tk_store, kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key, kv_fp=kv_fp,
+                    artifacts=list(artifacts))
+
+
+async def unpack_tk_store(kp_fp: Path, kp_token: Path, kp_key: Path | None = None, include: Iterable[str] | None = None,
+                          root: Path | None = None, executor: Executor | None = None) -> UnpackReport:
+  """Awaitable `DbUtils.unpack_tk_store`."""
+  return await _run(executor, DbUtils.unpack_tk_store, kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key,
+                    include=None if include is None else list(include), root=root)
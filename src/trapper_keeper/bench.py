@@ -0,0 +1,230 @@
+"""Offline benchmarks of the hot paths: vault create/pack/unpack, the Key/Value store and key generation.
+
+Every case runs against synthetic data generated from a fixed seed in a scratch directory, never against the user's
+vault or unlock agent.  The XDG directories point into the scratch directory for the whole run, so caches such as the
+unicode letters table are neither read from nor written to the user's.  `run` returns a JSON serializable document
+that `compare` diffs against a baseline taken on another commit, see ``python -m trapper_keeper bench --help``.
+"""
+
+import contextlib
+import itertools
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections.abc import Callable, Iterable, Iterator
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+from trapper_keeper.sqlite_kvstore import KeyValueStore
+from trapper_keeper.util import keegen
+from trapper_keeper.util.db_utils import DbUtils
+from trapper_keeper.util.kdf import KdfParameters
+
+BENCH_VERSION: int = 1
+CASES: tuple[str, ...] = ("vault", "kv", "keygen")
+SEED: int = 1337
+REPEAT: int = 3
+# Compared to a baseline, a case this much slower is reported as a regression
+REGRESSION_RATIO: float = 1.1
+# Differences below this many seconds are timer noise, whatever the ratio
+NOISE_FLOOR: float = 0.001
+
+# Base directories pointed into the scratch directory while benchmarks run
+_XDG_HOMES: tuple[str, ...] = ("XDG_CACHE_HOME", "XDG_CONFIG_HOME", "XDG_DATA_HOME", "XDG_STATE_HOME", "XDG_BIN_HOME",
+                               "XDG_LIB_HOME", "XDG_RUNTIME_DIR")
+
+_WORDS: tuple[str, ...] = ("export", "PATH", "alias", "ssh", "git", "config", "token", "=", "/home/user", "--verbose",
+                           "true", "false", "[core]", "editor", "nvim", "#", "0644", "https://example.com")
+
+
+@dataclass
+class BenchResult:
+  """Wall clock seconds of each repetition of one case with one set of parameters."""
+  name: str
+  params: dict
+  seconds: list[float] = field(default_factory=list)
+
+  @property
+  def best(self) -> float:
+    return min(self.seconds)
+
+  @property
+  def median(self) -> float:
+    return statistics.median(self.seconds)
+
+  @property
+  def key(self) -> str:
+    """Identifies the case across runs, e.g. ``pack[artifacts=10,size=4096]``."""
+    return f"{self.name}[{','.join(f'{k}={v}' for k, v in sorted(self.params.items()))}]"
+
+  def to_dict(self) -> dict:
+    return {**asdict(self), "key": self.key, "best": self.best, "median": self.median}
+
+
+def _measure(name: str, params: dict, func: Callable[[], object], repeat: int,
+             setup: Callable[[], object] | None = None) -> BenchResult:
+  """Time `func` `repeat` times, running the untimed `setup` before each repetition."""
+  result = BenchResult(name=name, params=params)
+  for _ in range(repeat):
+    if setup is not None:
+      setup()
+    start = time.perf_counter()
+    func()
+    result.seconds.append(time.perf_counter() - start)
+  return result
+
+
+@contextlib.contextmanager
+def _scratch_xdg(root: Path) -> Iterator[None]:
+  """Point every XDG base directory under `root`, restoring the environment on exit."""
+  saved: dict[str, str | None] = {name: os.environ.get(name) for name in _XDG_HOMES}
+  try:
+    for name in _XDG_HOMES:
+      home = Path(root, name.lower())
+      home.mkdir(mode=0o700, parents=True)
+      os.environ[name] = str(home)
+    yield
+  finally:
+    for name, value in saved.items():
+      if value is None:
+        os.environ.pop(name, None)
+      else:
+        os.environ[name] = value
+
+
+def synthetic_artifact(rng: random.Random, size: int) -> bytes:
+  """Dotfile-like text with a random tail, so the codecs have something realistic to chew on."""
+  text = " ".join(rng.choices(_WORDS, k=size // 4)).encode("utf-8")[:size * 3 // 4]
+  return text + rng.randbytes(size - len(text))
+
+
+def bench_vault(root: Path, artifact_counts: Iterable[int], artifact_sizes: Iterable[int], kdf: KdfParameters | None,
+                repeat: int = REPEAT, seed: int = SEED) -> list[BenchResult]:
+  """create_tk_store, a full pack, a repack with nothing changed and an unpack, per artifact count and size."""
+  kee_auth: keegen.KeeAuth = keegen.KeeAuth.batch([root])[0]
+  kee_auth.save()
+  credentials = {"kp_token": kee_auth.kp_token[0], "kp_key": kee_auth.kp_key[0]}
+  kdf_params = {} if kdf is None else {f"kdf_{name}": value for name, value in asdict(kdf).items()}
+
+  counter = itertools.count()
+  results: list[BenchResult] = []
+
+  def fresh_vault() -> Path:
+    kp_fp = Path(root, f"vault-{next(counter)}.kdbx")
+    DbUtils.create_tk_store(kp_fp=kp_fp, kv_fp=Path(root, "kv.sqlite"), kdf=kdf, **credentials)
+    return kp_fp
+
+  vault: list[Path] = []
+  results.append(_measure("create", dict(kdf_params), lambda: vault.append(fresh_vault()), repeat))
+
+  for count, size in itertools.product(artifact_counts, artifact_sizes):
+    rng = random.Random(seed)
+    artifacts_dir = Path(root, f"artifacts-{count}-{size}")
+    artifacts: list[Path] = []
+    for i in range(count):
+      artifact = Path(artifacts_dir, f"{i % 8}", f"artifact-{i}")
+      artifact.parent.mkdir(parents=True, exist_ok=True)
+      artifact.write_bytes(synthetic_artifact(rng, size))
+      artifacts.append(artifact)
+    params = {"artifacts": count, "size": size, **kdf_params}
+
+    def pack(artifacts: list[Path] = artifacts) -> None:
+      DbUtils.pack_tk_store(kp_fp=vault[-1], artifacts=artifacts, use_agent=False, **credentials)
+
+    def unpack() -> None:
+      DbUtils.unpack_tk_store(kp_fp=vault[-1], root=Path(root, "rootfs"), use_agent=False, **credentials)
+
+    results.append(_measure("pack", params, pack, repeat, setup=lambda: vault.append(fresh_vault())))
+    results.append(_measure("repack_unchanged", params, pack, repeat))
+    results.append(_measure("unpack", params, unpack, repeat))
+  return results
+
+
+def bench_kv(root: Path, row_counts: Iterable[int], repeat: int = REPEAT, seed: int = SEED) -> list[BenchResult]:
+  """Bulk load, point lookups, a prefix scan and serialization of the store, per row count.
+
+  Every bulk load goes into a fresh store, so each repetition measures inserts rather than updates of the keys the
+  previous one wrote.  The other cases run against the last store loaded.
+  """
+  counter = itertools.count()
+  results: list[BenchResult] = []
+  for rows in row_counts:
+    rng = random.Random(seed)
+    items: list[tuple[str, str]] = [(f"ns{i % 16}/key-{i:08}", rng.randbytes(32).hex()) for i in range(rows)]
+    lookups: list[str] = [key for key, _ in rng.choices(items, k=min(rows, 10_000))]
+    stores: list[KeyValueStore] = []
+
+    def fresh_store(stores: list[KeyValueStore] = stores, rows: int = rows) -> None:
+      stores.append(KeyValueStore(Path(root, f"kv-{rows}-{next(counter)}.sqlite")))
+
+    try:
+      params = {"rows": rows}
+      results.append(_measure("kv_set_many", params, lambda stores=stores, items=items: stores[-1].set_many(items),
+                              repeat, setup=fresh_store))
+      store: KeyValueStore = stores[-1]
+      results.append(_measure("kv_get", {**params, "lookups": len(lookups)},
+                              lambda store=store, lookups=lookups: [store[key] for key in lookups], repeat))
+      results.append(_measure("kv_scan", params, lambda store=store: sum(1 for _ in store.scan("ns7/")), repeat))
+      results.append(_measure("kv_serialize", params,
+                              lambda store=store: KeyValueStore.from_bytes(bytes(store)).close(), repeat))
+    finally:
+      for opened in stores:
+        opened.close()
+  return results
+
+
+def bench_keygen(lengths: Iterable[int], count: int, repeat: int = REPEAT) -> list[BenchResult]:
+  """gen_utf8 and gen_utf8_many per token length, with the letters table already warm."""
+  keegen.unicode_letters_table()
+  results: list[BenchResult] = []
+  for length in lengths:
+    results.append(_measure("gen_utf8", {"length": length}, lambda length=length: keegen.gen_utf8(length), repeat))
+    results.append(_measure("gen_utf8_many", {"length": length, "count": count},
+                            lambda length=length: keegen.gen_utf8_many(count, length), repeat))
+  return results
+
+
+def run(cases: Iterable[str] = CASES, artifact_counts: Iterable[int] = (10,), artifact_sizes: Iterable[int] = (4096,),
+        kv_rows: Iterable[int] = (10_000,), token_lengths: Iterable[int] = (keegen.TOKEN_SIZE,), token_count: int = 100,
+        kdf: KdfParameters | None = None, repeat: int = REPEAT, seed: int = SEED, label: str | None = None) -> dict:
+  """Run the selected `cases` and return the results together with what they ran on."""
+  cases = list(cases)
+  if unknown := set(cases) - set(CASES):
+    raise ValueError(f"Unknown bench cases {sorted(unknown)}, expected some of {CASES}")
+
+  results: list[BenchResult] = []
+  with tempfile.TemporaryDirectory(prefix="trapper_keeper-bench-") as tmpdir, _scratch_xdg(Path(tmpdir, "xdg")):
+    if "vault" in cases:
+      vault_root = Path(tmpdir, "vault")
+      vault_root.mkdir()
+      results.extend(bench_vault(vault_root, artifact_counts, artifact_sizes, kdf, repeat=repeat, seed=seed))
+    if "kv" in cases:
+      results.extend(bench_kv(Path(tmpdir), kv_rows, repeat=repeat, seed=seed))
+    if "keygen" in cases:
+      results.extend(bench_keygen(token_lengths, token_count, repeat=repeat))
+
+  return {
+    "version": BENCH_VERSION,
+    "label": label,
+    "python": sys.version.split()[0],
+    "platform": platform.platform(),
+    "machine": platform.machine(),
+    "seed": seed,
+    "repeat": repeat,
+    "results": [result.to_dict() for result in results],
+  }
+
+
+def compare(baseline: dict, current: dict, threshold: float = REGRESSION_RATIO) -> list[tuple[str, float, float, bool]]:
+  """``(key, baseline best, current best, regressed)`` for every case present in both runs."""
+  before: dict[str, float] = {result["key"]: result["best"] for result in baseline["results"]}
+  rows: list[tuple[str, float, float, bool]] = []
+  for result in current["results"]:
+    if (best := before.get(result["key"])) is not None:
+      slower: bool = result["best"] > best * threshold and result["best"] - best > NOISE_FLOOR
+      rows.append((result["key"], best, result["best"], slower))
+  return rows
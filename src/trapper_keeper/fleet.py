@@ -0,0 +1,156 @@
+"""Create or pack many vaults at once, one per target image.
+
+Opening, encrypting and saving a vault is CPU bound (Argon2, the payload cipher, gzip and XML), so a fleet is spread
+over a process pool sized to the cores this process may run on.  Every vault is an independent job: a job that raises
+is reported as failed with its error and the others carry on.
+
+A fleet file is a JSON list of objects, relative paths in it are resolved against the file's directory::
+
+  [
+    {"vault": "img-001/secrets.kdbx", "token": "img-001/secrets_token", "key": "img-001/secrets.keyx",
+     "kv_store": "img-001/kv_store.sqlite", "artifacts": ["img-001/etc/hosts"]}
+  ]
+
+Only ``vault``, ``token`` and ``key`` are required.
+"""
+
+import json
+import time
+from collections.abc import Callable, Iterable
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+from trapper_keeper.util.kdf import KdfParameters, available_cores
+
+MODES: tuple[str, ...] = ("auto", "create", "pack")
+
+
+@dataclass(frozen=True)
+class FleetJob:
+  """One vault of the fleet with its secrets and what to pack into it."""
+  vault: Path
+  token: Path
+  key: Path
+  kv_store: Path | None = None
+  artifacts: tuple[Path, ...] = ()
+
+
+@dataclass
+class JobResult:
+  """Outcome of one `FleetJob`, `error` is set when it failed."""
+  vault: str
+  action: str
+  seconds: float
+  attached: int = 0
+  unchanged: int = 0
+  saved: bool = False
+  error: str | None = None
+
+  @property
+  def ok(self) -> bool:
+    return self.error is None
+
+
+@dataclass
+class FleetReport:
+  """Every `JobResult` of a `run_fleet` call in completion order, with the wall clock of the whole run."""
+  workers: int
+  seconds: float
+  results: list[JobResult] = field(default_factory=list)
+
+  @property
+  def failed(self) -> list[JobResult]:
+    return [result for result in self.results if not result.ok]
+
+  @property
+  def job_seconds(self) -> float:
+    """Sum of the time spent in each job, what a serial run would have taken."""
+    return sum(result.seconds for result in self.results)
+
+  @property
+  def speedup(self) -> float:
+    return self.job_seconds / self.seconds if self.seconds > 0 else 0.0
+
+  def to_dict(self) -> dict:
+    return {"workers": self.workers, "seconds": self.seconds, "job_seconds": self.job_seconds,
+            "speedup": self.speedup, "failed": len(self.failed), "results": [asdict(result) for result in self.results]}
+
+
+def load_fleet(path: Path) -> list[FleetJob]:
+  """Read the jobs of a fleet file, see the module documentation for its format."""
+  base: Path = Path(path).absolute().parent
+  entries = json.loads(Path(path).read_text(encoding="utf-8"))
+  if not isinstance(entries, list):
+    raise ValueError(f"{path} must hold a JSON list of vaults")
+
+  jobs: list[FleetJob] = []
+  for i, entry in enumerate(entries):
+    if missing := {"vault", "token", "key"} - set(entry):
+      raise ValueError(f"Vault {i} of {path} lacks {sorted(missing)}")
+    jobs.append(FleetJob(
+      vault=base / entry["vault"],
+      token=base / entry["token"],
+      key=base / entry["key"],
+      kv_store=None if entry.get("kv_store") is None else base / entry["kv_store"],
+      artifacts=tuple(base / artifact for artifact in entry.get("artifacts", ())),
+    ))
+  return jobs
+
+
+def run_job(job: FleetJob, mode: str = "auto", kdf: KdfParameters | None = None) -> JobResult:
+  """Create or pack the vault of `job` in this process, never raises.
+
+  In ``auto`` mode vaults that do not exist yet are created.  `kdf` only applies to created vaults.
+  """
+  # Imported here, the parent process only needs the dataclasses above
+  from trapper_keeper.util.db_utils import DbUtils
+
+  action: str = mode if mode != "auto" else ("pack" if job.vault.exists() else "create")
+  start = time.perf_counter()
+  try:
+    if action == "create":
+      job.vault.parent.mkdir(parents=True, exist_ok=True)
+      DbUtils.create_tk_store(kp_fp=job.vault, kp_token=job.token, kp_key=job.key, kv_fp=job.kv_store,
+                              artifacts=job.artifacts, kdf=kdf)
+      result = JobResult(vault=str(job.vault), action=action, seconds=0.0, attached=len(job.artifacts), saved=True)
+    else:
+      # The agent serves one vault at a time, going through it would serialize the whole fleet again
+      report = DbUtils.pack_tk_store(kp_fp=job.vault, kp_token=job.token, kp_key=job.key, kv_fp=job.kv_store,
+                                     artifacts=job.artifacts, use_agent=False)
+      result = JobResult(vault=str(job.vault), action=action, seconds=0.0, attached=len(report.attached),
+                         unchanged=len(report.unchanged), saved=report.saved)
+  except Exception as e:
+    result = JobResult(vault=str(job.vault), action=action, seconds=0.0, error=f"{type(e).__name__}: {e}")
+  result.seconds = time.perf_counter() - start
+  return result
+
+
+def run_fleet(jobs: Iterable[FleetJob], mode: str = "auto", workers: int | None = None,
+              kdf: KdfParameters | None = None,
+              progress: Callable[[JobResult, int, int], None] | None = None) -> FleetReport:
+  """Run every job on a process pool of `workers` processes, `available_cores` by default.
+
+  `progress` is called in this process with each result, the number of jobs done and the total as they complete.
+  """
+  if mode not in MODES:
+    raise ValueError(f"Unknown fleet mode {mode!r}, expected one of {MODES}")
+  jobs = list(jobs)
+  workers = min(workers or available_cores(), max(len(jobs), 1))
+
+  report = FleetReport(workers=workers, seconds=0.0)
+  start = time.perf_counter()
+  with ProcessPoolExecutor(max_workers=workers) as pool:
+    futures: dict[Future, FleetJob] = {pool.submit(run_job, job, mode, kdf): job for job in jobs}
+    for future in as_completed(futures):
+      try:
+        result = future.result()
+      except Exception as e:
+        # run_job catches everything, this is a worker that died (e.g. OOM killed) and took its job with it
+        result = JobResult(vault=str(futures[future].vault), action=mode, seconds=0.0,
+                           error=f"{type(e).__name__}: {e}")
+      report.results.append(result)
+      if progress is not None:
+        progress(result, len(report.results), len(jobs))
+  report.seconds = time.perf_counter() - start
+  return report
@@ -1,43 +1,320 @@
-"""https://stackoverflow.com/questions/47237807/use-sqlite-as-a-keyvalue-store"""
+"""https://stackoverflow.com/questions/47237807/use-sqlite-as-a-keyvalue-store
+
+Schema version 2 (``PRAGMA user_version``) keeps the pairs in a ``WITHOUT ROWID`` table clustered on `key`, so a lookup
+is one b-tree descent and keys are not stored a second time in a separate unique index.  The `value` column has no type
+affinity: bytes, str, int (64 bit), float and None are stored as sqlite's own BLOB, TEXT, INTEGER, REAL and NULL, whose
+serial type in the record header is the type tag and costs nothing to decode.  Anything else (dicts, lists, bools, big
+ints, NaN) is stored as compact JSON text with `kind` set to `KIND_JSON`.  `expires` holds the optional expiry of a pair
+as a Unix time: expired pairs are invisible to every read and deleted by `KeyValueStore.purge_expired` or the background
+purge of `KeyValueStore.start_purge`.  Stores in the version 1 layout (``key text unique, value text``) are migrated
+when they are opened or deserialized.
+"""
 
 import contextlib
+import itertools
+import json
+import math
 import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from collections.abc import Iterable, Iterator, Mapping
 from pathlib import Path
 
+from trapper_keeper.util import profiling
+
+JOURNAL_MODE: str = "WAL"
+SYNCHRONOUS: str = "NORMAL"
+SYNCHRONOUS_LEVELS: tuple[str, ...] = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+# Seconds a connection waits on a locked database before raising `sqlite3.OperationalError`
+BUSY_TIMEOUT: float = 5.0
+
+# Rows pulled per `fetchmany` when streaming, keeps memory flat regardless of table size
+FETCH_SIZE: int = 512
+
+# Name sqlite3 gives a private in-memory database
+MEMORY: str = ":memory:"
+
+SCHEMA_VERSION: int = 2
+# `kind` of a value stored as JSON text, NULL means the value is stored as is
+KIND_JSON: int = 1
+# Seconds between two runs of the background purge of expired pairs
+PURGE_INTERVAL: float = 60.0
+
+_CREATE_TABLE: str = ("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY NOT NULL, value BLOB, kind INTEGER, "
+                      "expires REAL) WITHOUT ROWID")
+_LIVE: str = "(expires IS NULL OR expires > ?)"
+_PURGE: str = "DELETE FROM kv WHERE expires <= ?"
+_INT64 = range(-2 ** 63, 2 ** 63)
+
+# Offsets of the file format read/write version bytes in the database header, 2 marks a WAL database
+_HEADER_VERSION = slice(18, 20)
+_WAL_VERSION: bytes = b"\x02\x02"
+_ROLLBACK_VERSION: bytes = b"\x01\x01"
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+# Cached marker for keys known to be absent, so repeated `in` checks are served from the cache as well
+_MISSING = object()
+
+
+def _encode(value) -> tuple[object, int | None]:
+  """``(value, kind)`` as stored, see the module documentation."""
+  if isinstance(value, float) and math.isnan(value):
+    # sqlite stores a NaN REAL as NULL, which would read back as None
+    return json.dumps(value), KIND_JSON
+  if (value is None or isinstance(value, str | bytes | float)
+      or (isinstance(value, int) and not isinstance(value, bool) and value in _INT64)):
+    return value, None
+  if isinstance(value, bytearray | memoryview):
+    return bytes(value), None
+  return json.dumps(value, separators=(",", ":")), KIND_JSON
+
+
+def _decode(value, kind: int | None):
+  return value if kind is None else json.loads(value)
+
+
+def _expiry(ttl: float | None) -> float | None:
+  if ttl is None:
+    return None
+  if ttl <= 0:
+    raise ValueError(f"TTL must be positive, got {ttl}")
+  return time.time() + ttl
+
+
+def _live(expires: float | None, now: float | None = None) -> bool:
+  return expires is None or expires > (time.time() if now is None else now)
+
+
+class _ReadCache:
+  """LRU entries plus the ``PRAGMA data_version`` of the connection they were read through."""
+
+  def __init__(self):
+    # ``(stored value, kind, expires)`` of a key, or `_MISSING`.  JSON is decoded per read, so that callers mutating
+    # what they got back cannot change what the next read returns
+    self.entries: OrderedDict = OrderedDict()
+    self.data_version: int | None = None
+    self.hits: int = 0
+    self.misses: int = 0
+
+
+class _Purge(threading.Thread):
+  """Deletes expired pairs every `interval` seconds through a connection of its own, until `stop` is called."""
+
+  def __init__(self, filename: Path | str, interval: float, busy_timeout: float):
+    super().__init__(name=f"kv-purge {filename}", daemon=True)
+    self.filename = filename
+    self.interval = interval
+    self.busy_timeout = busy_timeout
+    self._stopped = threading.Event()
+
+  def run(self) -> None:
+    conn = sqlite3.connect(self.filename, isolation_level=None, timeout=self.busy_timeout)
+    try:
+      while not self._stopped.wait(self.interval):
+        # A writer holding the lock past the busy timeout only delays the purge to the next round
+        with contextlib.suppress(sqlite3.OperationalError):
+          conn.execute(_PURGE, (time.time(),))
+    finally:
+      conn.close()
+
+  def stop(self) -> None:
+    self._stopped.set()
+    self.join()
+
 
 class KeyValueStore(dict):
-  """_summary_
-  Args:
-      dict (_type_): _description_
+  """Dict-like view over a single sqlite `kv` table, see the module documentation for how values are stored.
+
+  Statements issued outside of `transaction()` are committed immediately, so a single `store[key] = value` is durable
+  once it returns.  Bulk loads should go through `set_many`/`update` or a `transaction()` block so that thousands of
+  keys cost one commit instead of one each.
+
+  With ``cache_size`` set, reads go through a bounded LRU cache.  Before a cached answer is used the cache is checked
+  against ``PRAGMA data_version``, which changes whenever another connection commits to the same file, so several
+  processes can share one store without serving stale values.
+
+  `set` and `set_many` take an optional TTL in seconds after which the pair reads as absent.
+
+  A `KeyValueStore` owns one connection and must stay on the thread that created it, see `SharedKeyValueStore`.
   """
 
-  def __init__(self, filename: Path):
-    """_summary_
+  def __init__(self, filename: Path | str, synchronous: str = SYNCHRONOUS, journal_mode: str = JOURNAL_MODE,
+               cache_size: int = 0, fetch_size: int = FETCH_SIZE, busy_timeout: float = BUSY_TIMEOUT):
+    """Open (or create) the store.
+
     Args:
-        filename (_type_, optional): _description_. Defaults to KV_STORE.
+        filename: Path of the sqlite database, or ``":memory:"``.
+        synchronous: sqlite ``PRAGMA synchronous`` level, one of `SYNCHRONOUS_LEVELS`.  ``NORMAL`` is crash safe in
+          WAL mode and only risks the last commits on power loss; use ``FULL`` when that matters.
+        journal_mode: sqlite ``PRAGMA journal_mode``.  Defaults to ``WAL``.
+        cache_size: Maximum number of keys held in the read cache.  ``0`` disables caching.
+        fetch_size: Rows fetched per round trip by the streaming iterators and scans.
+        busy_timeout: Seconds to wait for a lock held by another connection.
     """
     super().__init__()
-    self.conn = sqlite3.connect(filename)
-    self.conn.execute("CREATE TABLE IF NOT EXISTS kv (key text unique, value text)")
+    synchronous = synchronous.upper()
+    if synchronous not in SYNCHRONOUS_LEVELS:
+      raise ValueError(f"Unknown synchronous level {synchronous}, expected one of {SYNCHRONOUS_LEVELS}")
+
+    self.filename = filename
+    self.busy_timeout: float = busy_timeout
+    self.fetch_size: int = fetch_size
+
+    # isolation_level=None hands transaction control to us rather than the implicit (never committed) BEGIN of sqlite3
+    self.conn = self._connect()
+    self.conn.execute(f"PRAGMA journal_mode={journal_mode}")
+    self.conn.execute(f"PRAGMA synchronous={synchronous}")
+    self._tx_depth: int = 0
+    self._write_lock = contextlib.nullcontext()
+    self._purge: _Purge | None = None
+    self._migrate()
+
+    self._cache_size: int = max(cache_size, 0)
+    self._cache = _ReadCache()
+
+  @classmethod
+  def from_bytes(cls, data: bytes, **kwargs) -> "KeyValueStore":
+    """An in-memory store loaded from a `serialize`d image, nothing is read from or written to disk.
+
+    Keyword arguments are passed through to the constructor.
+    """
+    kv_store = cls(MEMORY, **kwargs)
+    kv_store.deserialize(data)
+    return kv_store
+
+  def serialize(self) -> bytes:
+    """The whole database as one buffer, in the sqlite file format."""
+    with self._write_lock, profiling.span("sqlite.serialize") as span:
+      data: bytes = self.conn.serialize()
+      span["bytes"] = len(data)
+      return data
+
+  __bytes__ = serialize
+
+  def deserialize(self, data: bytes) -> None:
+    """Replace the contents of the store with a `serialize`d image."""
+    if data[_HEADER_VERSION] == _WAL_VERSION:
+      # An image taken from a WAL database still says so in its header, which an in-memory database cannot open
+      data = bytearray(data)
+      data[_HEADER_VERSION] = _ROLLBACK_VERSION
+    with self._write_lock:
+      if self._tx_depth:
+        raise sqlite3.OperationalError("Cannot deserialize inside a transaction")
+      if data:
+        with profiling.span("sqlite.deserialize", bytes=len(data)):
+          self.conn.deserialize(data)
+      else:
+        # Vaults created before the store was serialized carry an empty attachment, that is an empty store
+        self.conn.execute("DROP TABLE IF EXISTS kv")
+        self.conn.execute("PRAGMA user_version = 0")
+      # Images packed into older vaults are in the version 1 layout
+      self._migrate()
+      self._cache.entries.clear()
+      self._cache.data_version = None
+
+  def _migrate(self) -> None:
+    """Bring the schema to `SCHEMA_VERSION`, in one transaction so that a crash leaves either layout intact.
+
+    Version 1 values keep the storage class they had, so text stays text.  The version is checked again once the
+    write lock is held, another process may have migrated the file in the meantime.
+    """
+    if self.conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION:
+      return
+    self.conn.execute("BEGIN IMMEDIATE")
+    try:
+      version: int = self.conn.execute("PRAGMA user_version").fetchone()[0]
+      if version > SCHEMA_VERSION:
+        raise sqlite3.DatabaseError(f"{self.filename} has schema version {version}, newer than {SCHEMA_VERSION}")
+      legacy: bool = version < SCHEMA_VERSION and self.conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'kv'").fetchone() is not None
+      if version < SCHEMA_VERSION:
+        with profiling.span("sqlite.migrate", version=version):
+          if legacy:
+            self.conn.execute("ALTER TABLE kv RENAME TO kv_v1")
+          self.conn.execute(_CREATE_TABLE)
+          if legacy:
+            # A unique column still takes any number of NULLs, which have no place in a keyed table
+            self.conn.execute("INSERT OR REPLACE INTO kv (key, value) SELECT key, value FROM kv_v1 WHERE key IS NOT NULL")
+            self.conn.execute("DROP TABLE kv_v1")
+          self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    except BaseException:
+      self.conn.rollback()
+      raise
+    self.conn.commit()
+    if legacy:
+      # Give back the pages of the old table and its index, serialized images would carry them along otherwise
+      self.conn.execute("VACUUM")
+
+  def _connect(self, check_same_thread: bool = True) -> sqlite3.Connection:
+    conn = sqlite3.connect(self.filename, isolation_level=None, timeout=self.busy_timeout,
+                           check_same_thread=check_same_thread)
+    if profiling.enabled():
+      # Only connections opened while profiling pay for the callback
+      conn.set_trace_callback(_count_statement)
+    return conn
+
+  @property
+  def _reader(self) -> sqlite3.Connection:
+    """Connection used for reads."""
+    return self.conn
+
+  def _read_cache(self) -> _ReadCache | None:
+    """Cache serving the current read, or None when reads should go straight to sqlite."""
+    return self._cache if self._cache_size else None
 
   def __len__(self):
-    rows = self.conn.execute("SELECT COUNT(*) FROM kv").fetchone()[0]
+    rows = self._reader.execute(f"SELECT COUNT(*) FROM kv WHERE {_LIVE}", (time.time(),)).fetchone()[0]
     return rows if rows is not None else 0
 
+  def _stream(self, sql: str, params: tuple = (), fetch_size: int | None = None) -> Iterator[tuple]:
+    """Yield rows of `sql` in `fetchmany` chunks rather than materializing the result set."""
+    c = self._reader.execute(sql, params)
+    try:
+      while rows := c.fetchmany(fetch_size or self.fetch_size):
+        yield from rows
+    finally:
+      c.close()
+
   def iterkeys(self):
-    c = self.conn.cursor()
-    for row in c.execute("SELECT key FROM kv"):
+    for row in self._stream(f"SELECT key FROM kv WHERE {_LIVE}", (time.time(),)):
       yield row[0]
 
   def itervalues(self):
-    c = self.conn.cursor()
-    for row in c.execute("SELECT value FROM kv"):
-      yield row[0]
+    for value, kind in self._stream(f"SELECT value, kind FROM kv WHERE {_LIVE}", (time.time(),)):
+      yield value if kind is None else json.loads(value)
 
   def iteritems(self):
-    c = self.conn.cursor()
-    for row in c.execute("SELECT key, value FROM kv"):
-      yield row[0], row[1]
+    for key, value, kind in self._stream(f"SELECT key, value, kind FROM kv WHERE {_LIVE}", (time.time(),)):
+      yield key, value if kind is None else json.loads(value)
+
+  def scan(self, prefix: str = "", fetch_size: int | None = None) -> Iterator[tuple[str, object]]:
+    """Yield ``(key, value)`` pairs whose key starts with `prefix`, in key order.
+
+    The prefix is turned into a half-open key range so the lookup walks the table's b-tree on `key` instead of
+    evaluating ``LIKE`` against every row.
+    """
+    if not prefix:
+      return self.range(fetch_size=fetch_size)
+    return self.range(prefix, _prefix_upper_bound(prefix), fetch_size=fetch_size)
+
+  def range(self, start: str | None = None, end: str | None = None,
+            fetch_size: int | None = None) -> Iterator[tuple[str, object]]:
+    """Yield ``(key, value)`` pairs with ``start <= key < end`` in key order.  Either bound may be None."""
+    clauses: list[str] = [_LIVE]
+    params: list[object] = [time.time()]
+    if start is not None:
+      clauses.append("key >= ?")
+      params.append(start)
+    if end is not None:
+      clauses.append("key < ?")
+      params.append(end)
+    sql = f"SELECT key, value, kind FROM kv WHERE {' AND '.join(clauses)} ORDER BY key"
+    for key, value, kind in self._stream(sql, tuple(params), fetch_size):
+      yield key, value if kind is None else json.loads(value)
 
   def keys(self):
     return list(self.iterkeys())
@@ -49,24 +326,260 @@ class KeyValueStore(dict):
     return list(self.iteritems())
 
   def __contains__(self, key):
-    return self.conn.execute("SELECT 1 FROM kv WHERE key = ?", (key,)).fetchone() is not None
+    if (cache := self._read_cache()) is not None:
+      return self._cached_value(cache, key) is not _MISSING
+    item = self._reader.execute("SELECT expires FROM kv WHERE key = ?", (key,)).fetchone()
+    return item is not None and _live(item[0])
 
   def __getitem__(self, key):
-    item = self.conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
-    if item is None:
+    if (cache := self._read_cache()) is not None:
+      value = self._cached_value(cache, key)
+      if value is _MISSING:
+        raise KeyError(key)
+      return value
+    item = self._reader.execute("SELECT value, kind, expires FROM kv WHERE key = ?", (key,)).fetchone()
+    if item is None or not _live(item[2]):
       raise KeyError(key)
-    return item[0]
+    return _decode(item[0], item[1])
+
+  def get(self, key, default=None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
 
   def __setitem__(self, key, value):
-    self.conn.execute("REPLACE INTO kv (key, value) VALUES (?,?)", (key, value))
+    self.set(key, value)
+
+  def set(self, key, value, ttl: float | None = None) -> None:
+    """``store[key] = value``, read as absent once `ttl` seconds have passed when it is given."""
+    with self._write_lock:
+      self.conn.execute("REPLACE INTO kv (key, value, kind, expires) VALUES (?,?,?,?)",
+                        (key, *_encode(value), _expiry(ttl)))
+      self._cache.entries.pop(key, None)
 
   def __delitem__(self, key):
-    if key not in self:
-      raise KeyError(key)
-    self.conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+    with self._write_lock:
+      self._cache.entries.pop(key, None)
+      # Drained, a RETURNING statement left pending would hold its implicit transaction open
+      deleted = self.conn.execute("DELETE FROM kv WHERE key = ? RETURNING expires", (key,)).fetchall()
+      if not deleted or not _live(deleted[0][0]):
+        raise KeyError(key)
+
+  def purge_expired(self) -> int:
+    """Delete the pairs whose TTL ran out, returns how many there were."""
+    with self._write_lock:
+      self._cache.entries.clear()
+      return self.conn.execute(_PURGE, (time.time(),)).rowcount
+
+  def start_purge(self, interval: float = PURGE_INTERVAL) -> None:
+    """Run `purge_expired` every `interval` seconds on a background thread until the store is closed.
+
+    The thread has a connection of its own, so it needs a database file.
+    """
+    if str(self.filename) == MEMORY:
+      raise ValueError("A background purge needs a database file, each connection to :memory: is a new database")
+    if self._purge is None:
+      self._purge = _Purge(self.filename, interval, self.busy_timeout)
+      self._purge.start()
 
   def __iter__(self):
     return self.iterkeys()
 
-  def __exit__(self, exc_type, exc_val, exc_tb):
+  @property
+  def in_transaction(self) -> bool:
+    """True while a `transaction()` block is open."""
+    return self._tx_depth > 0
+
+  @contextlib.contextmanager
+  def transaction(self) -> Iterator["KeyValueStore"]:
+    """Group every write inside the block into one sqlite transaction.
+
+    The outermost block takes the write lock up front (``BEGIN IMMEDIATE``), commits on a clean exit and rolls back if
+    the block raises.  Nested blocks join the enclosing transaction.
+    """
+    with self._write_lock:
+      if self._tx_depth == 0:
+        self.conn.execute("BEGIN IMMEDIATE")
+      self._tx_depth += 1
+      try:
+        yield self
+      except BaseException:
+        self._tx_depth -= 1
+        if self._tx_depth == 0:
+          self.conn.rollback()
+          self._cache.entries.clear()
+        raise
+      self._tx_depth -= 1
+      if self._tx_depth == 0:
+        with profiling.span("sqlite.commit"):
+          self.conn.commit()
+
+  batch = transaction
+
+  def commit(self) -> None:
+    """Commit whatever has been written so far.
+
+    Inside a `transaction()` block a fresh transaction is started afterwards so the block keeps its semantics.
+    """
+    with self._write_lock:
+      if self.conn.in_transaction:
+        self.conn.commit()
+      if self._tx_depth > 0:
+        self.conn.execute("BEGIN IMMEDIATE")
+
+  def set_many(self, items: Iterable[tuple[str, object]], ttl: float | None = None) -> None:
+    """Write every ``(key, value)`` pair with a single `executemany` inside one transaction, see `set`."""
+    expires: float | None = _expiry(ttl)
+    with self.transaction():
+      self._cache.entries.clear()
+      self.conn.executemany("REPLACE INTO kv (key, value, kind, expires) VALUES (?,?,?,?)",
+                            ((key, *_encode(value), expires) for key, value in items))
+
+  def update(self, other: Mapping | Iterable[tuple[str, object]] = (), /, **kwargs) -> None:
+    """`dict.update` semantics, backed by `set_many`."""
+    if isinstance(other, Mapping):
+      other = other.items()
+    self.set_many(itertools.chain(other, kwargs.items()))
+
+  def _cached_value(self, cache: _ReadCache, key):
+    """Look `key` up through the LRU cache, returning `_MISSING` for absent keys."""
+    reader = self._reader
+    data_version: int = reader.execute("PRAGMA data_version").fetchone()[0]
+    if data_version != cache.data_version:
+      # Another connection committed since we last looked, anything cached may be stale
+      cache.entries.clear()
+      cache.data_version = data_version
+
+    if key in cache.entries:
+      cache.hits += 1
+      cache.entries.move_to_end(key)
+      entry = cache.entries[key]
+    else:
+      cache.misses += 1
+      entry = reader.execute("SELECT value, kind, expires FROM kv WHERE key = ?", (key,)).fetchone() or _MISSING
+      cache.entries[key] = entry
+      if len(cache.entries) > self._cache_size:
+        cache.entries.popitem(last=False)
+    # Expiring is not a commit, a cached pair can run out while nothing else changed
+    return _MISSING if entry is _MISSING or not _live(entry[2]) else _decode(entry[0], entry[1])
+
+  def cache_info(self) -> CacheInfo:
+    """Hit/miss statistics of the read cache, in the spirit of `functools.lru_cache`."""
+    return CacheInfo(self._cache.hits, self._cache.misses, self._cache_size, len(self._cache.entries))
+
+  def cache_clear(self) -> None:
+    self._cache = _ReadCache()
+
+  def close(self) -> None:
+    if self._purge is not None:
+      self._purge.stop()
+      self._purge = None
     self.conn.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+
+
+class SharedKeyValueStore(KeyValueStore):
+  """`KeyValueStore` that can be shared by many threads.
+
+  Every thread reads through its own ``query_only`` connection, so lookups run in parallel under WAL and never trip
+  sqlite3's same-thread check.  All writes funnel through the single writer connection behind a lock; a thread inside
+  `transaction()` reads through that writer as well so it sees its own uncommitted changes.  Read caches are kept per
+  thread since ``PRAGMA data_version`` is only meaningful for the connection it was read on.
+  """
+
+  def __init__(self, filename: Path | str, synchronous: str = SYNCHRONOUS, journal_mode: str = JOURNAL_MODE,
+               cache_size: int = 0, fetch_size: int = FETCH_SIZE, busy_timeout: float = BUSY_TIMEOUT):
+    if str(filename) == MEMORY:
+      raise ValueError("SharedKeyValueStore needs a database file, each connection to :memory: is a new database")
+    self._local = threading.local()
+    self._readers: list[sqlite3.Connection] = []
+    self._caches: list[_ReadCache] = []
+    self._readers_lock = threading.Lock()
+    self._tx_owner: int | None = None
+    super().__init__(filename, synchronous=synchronous, journal_mode=journal_mode, cache_size=cache_size,
+                     fetch_size=fetch_size, busy_timeout=busy_timeout)
+    self._write_lock = threading.RLock()
+
+  def _connect(self, check_same_thread: bool = False) -> sqlite3.Connection:
+    # Connections are confined to one thread by construction, but close() has to reach all of them
+    return super()._connect(check_same_thread=check_same_thread)
+
+  def _owns_transaction(self) -> bool:
+    return self._tx_depth > 0 and self._tx_owner == threading.get_ident()
+
+  @property
+  def _reader(self) -> sqlite3.Connection:
+    if self._owns_transaction():
+      return self.conn
+    reader: sqlite3.Connection | None = getattr(self._local, "reader", None)
+    if reader is None:
+      reader = self._connect()
+      reader.execute("PRAGMA query_only=ON")
+      self._local.reader = reader
+      with self._readers_lock:
+        self._readers.append(reader)
+    return reader
+
+  def _read_cache(self) -> _ReadCache | None:
+    if not self._cache_size or self._owns_transaction():
+      return None
+    cache: _ReadCache | None = getattr(self._local, "cache", None)
+    if cache is None:
+      cache = self._local.cache = _ReadCache()
+      with self._readers_lock:
+        self._caches.append(cache)
+    return cache
+
+  @contextlib.contextmanager
+  def transaction(self) -> Iterator["SharedKeyValueStore"]:
+    with self._write_lock, super().transaction():
+      self._tx_owner = threading.get_ident()
+      try:
+        yield self
+      finally:
+        if self._tx_depth == 1:
+          self._tx_owner = None
+
+  batch = transaction
+
+  def cache_info(self) -> CacheInfo:
+    """Statistics summed over every thread's read cache."""
+    with self._readers_lock:
+      caches = list(self._caches)
+    return CacheInfo(sum(c.hits for c in caches), sum(c.misses for c in caches), self._cache_size,
+                     sum(len(c.entries) for c in caches))
+
+  def cache_clear(self) -> None:
+    with self._readers_lock:
+      for cache in self._caches:
+        cache.entries.clear()
+        cache.data_version = None
+        cache.hits = cache.misses = 0
+
+  def close(self) -> None:
+    with self._readers_lock:
+      for reader in self._readers:
+        reader.close()
+      self._readers.clear()
+    super().close()
+
+
+def _count_statement(_statement: str) -> None:
+  profiling.count("sqlite.statements")
+
+
+def _prefix_upper_bound(prefix: str) -> str | None:
+  """Smallest string greater than every string starting with `prefix`, or None when no such bound exists."""
+  while prefix:
+    last = ord(prefix[-1])
+    if last < sys.maxunicode:
+      # Skip the surrogate block, sqlite only takes text that encodes to UTF-8
+      return prefix[:-1] + chr(0xE000 if 0xD7FF <= last < 0xE000 else last + 1)
+    prefix = prefix[:-1]
+  return None
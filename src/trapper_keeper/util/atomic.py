@@ -0,0 +1,33 @@
+"""Crash-safe file replacement for everything unpacked out of a vault."""
+
+import contextlib
+import os
+import tempfile
+from collections.abc import Iterable
+from pathlib import Path
+
+
+def atomic_write(path: Path, data: bytes | Iterable[bytes], mode: int = 0o600) -> None:
+  """Replace `path` with `data` so readers see either the old or the new file, never a partial one.
+
+  `data` may also be an iterable of chunks, which are written as they are produced.
+
+  The bytes land in a temp file next to `path`, are fsync'ed and then renamed over it.  The temp file is private
+  (0600) until it is complete, `mode` is applied just before the rename.
+  """
+  path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+  fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+  try:
+    with os.fdopen(fd, mode="wb") as tmp_file:
+      if isinstance(data, bytes | bytearray | memoryview):
+        tmp_file.write(data)
+      else:
+        tmp_file.writelines(data)
+      tmp_file.flush()
+      os.fsync(tmp_file.fileno())
+    os.chmod(tmp_name, mode)
+    os.replace(tmp_name, path)
+  except BaseException:
+    with contextlib.suppress(FileNotFoundError):
+      os.unlink(tmp_name)
+    raise
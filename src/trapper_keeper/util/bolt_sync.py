@@ -0,0 +1,178 @@
+"""Sync chezmoi's BoltDB state with the Key/Value store.
+
+chezmoi keeps its persistent state (``chezmoistate.boltdb``) in one bucket per kind of state.  `ingest_boltdb` walks
+the chosen buckets with cursors and streams their pairs into a `KeyValueStore` under ``<namespace><bucket>/<key>``,
+one transaction per batch, and `export_boltdb` writes them back.
+
+Ingest is a merge of two key ordered streams, the bucket cursor and a range scan of the bucket's prefix, so only one
+batch of either side is held in memory and rows that did not change are not rewritten.  Alongside every batch the
+transaction records a checkpoint with the BoltDB transaction id and the last key written:
+
+* an interrupted ingest resumes after that key as long as the BoltDB file has not been written since;
+* a bucket whose transaction id is unchanged since its last complete ingest is skipped without being read.
+
+Keys are decoded as UTF-8, which chezmoi's keys always are, and values are stored as BLOBs so they round trip byte for
+byte.
+"""
+
+import contextlib
+import json
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from boltdb import BoltDB
+from boltdb.bucket import Bucket
+
+from trapper_keeper.sqlite_kvstore import KeyValueStore, _prefix_upper_bound
+
+CHEZMOI_BUCKETS: tuple[str, ...] = (
+  "configState", "entryState", "gitHubKeysState", "gitHubLatestReleaseState", "gitHubTagsState",
+  "gitRepoExternalState", "scriptState",
+)
+NAMESPACE: str = "chezmoi/"
+# Checkpoints live outside of every namespace, under ``<CHECKPOINT_PREFIX><namespace><bucket>``
+CHECKPOINT_PREFIX: str = ".sync/boltdb/"
+BATCH_SIZE: int = 500
+
+
+@dataclass
+class SyncReport:
+  """Rows touched by `ingest_boltdb` or `export_boltdb`, buckets skipped as unchanged or missing."""
+  written: int = 0
+  deleted: int = 0
+  unchanged: int = 0
+  buckets: list[str] = field(default_factory=list)
+  skipped: list[str] = field(default_factory=list)
+
+
+@contextlib.contextmanager
+def open_boltdb(filename: Path, readonly: bool = True) -> Iterator[BoltDB]:
+  """Open `filename` and release its file lock on exit.
+
+  `BoltDB.close` is not idempotent and runs again from ``__del__``, where it would close whatever file has reused the
+  descriptor in the meantime, so the instance's close is disarmed once it ran.
+  """
+  bolt_db = BoltDB(filename=filename, readonly=readonly)
+  try:
+    yield bolt_db
+  finally:
+    bolt_db.close()
+    bolt_db.close = lambda: None
+
+
+def _bucket_prefix(namespace: str, bucket: str) -> str:
+  return f"{namespace}{bucket}/"
+
+
+def _read_checkpoint(kv_store: KeyValueStore, checkpoint_key: str) -> dict:
+  value = kv_store.get(checkpoint_key)
+  return {} if value is None else json.loads(value)
+
+
+def _bucket_pairs(bucket: Bucket, after: bytes | None = None) -> Iterator[tuple[bytes, bytes]]:
+  """Key ordered pairs of `bucket` after `after`, nested buckets (value None) are left out."""
+  cursor = bucket.cursor()
+  if after is None:
+    key, value = cursor.first()
+  else:
+    key, value = cursor.seek(after)
+    if key == after:
+      key, value = cursor.next()
+  while key is not None:
+    if value is not None:
+      yield key, value
+    key, value = cursor.next()
+
+
+def _batches(pairs: Iterator[tuple[bytes, bytes]], batch_size: int) -> Iterator[list[tuple[bytes, bytes]]]:
+  batch: list[tuple[bytes, bytes]] = []
+  for pair in pairs:
+    batch.append(pair)
+    if len(batch) >= batch_size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+
+def _merge_range(kv_store: KeyValueStore, start: str, end: str | None, pairs: dict[str, bytes],
+                 report: SyncReport) -> None:
+  """Make ``start <= key < end`` of `kv_store` hold exactly `pairs`, writing only what differs."""
+  existing: dict[str, object] = dict(kv_store.range(start, end))
+  stale: list[str] = [key for key in existing if key not in pairs]
+  changed: list[tuple[str, bytes]] = [(key, value) for key, value in pairs.items() if existing.get(key) != value]
+  for key in stale:
+    del kv_store[key]
+  kv_store.set_many(changed)
+  report.deleted += len(stale)
+  report.written += len(changed)
+  report.unchanged += len(pairs) - len(changed)
+
+
+def ingest_bucket(bolt_db: BoltDB, kv_store: KeyValueStore, bucket_name: str, namespace: str = NAMESPACE,
+                  batch_size: int = BATCH_SIZE, report: SyncReport | None = None) -> SyncReport:
+  """Mirror one BoltDB bucket into `kv_store`, see the module docstring."""
+  report = report if report is not None else SyncReport()
+  prefix: str = _bucket_prefix(namespace, bucket_name)
+  checkpoint_key: str = f"{CHECKPOINT_PREFIX}{prefix}"
+  tx = bolt_db.begin(writable=False)
+  try:
+    txid: int = tx.meta.txid
+    checkpoint: dict = _read_checkpoint(kv_store, checkpoint_key)
+    if checkpoint.get("txid") == txid and checkpoint.get("done"):
+      report.skipped.append(bucket_name)
+      return report
+    bucket: Bucket | None = tx.bucket(bucket_name.encode("utf-8"))
+    if bucket is None:
+      report.skipped.append(bucket_name)
+      return report
+
+    # Resume only when the bucket is exactly as it was when the checkpoint was taken
+    after: str | None = checkpoint.get("after") if checkpoint.get("txid") == txid else None
+    start: str = prefix if after is None else f"{prefix}{after}\0"
+    for batch in _batches(_bucket_pairs(bucket, None if after is None else after.encode("utf-8")), batch_size):
+      pairs: dict[str, bytes] = {f"{prefix}{key.decode('utf-8')}": value for key, value in batch}
+      last: str = batch[-1][0].decode("utf-8")
+      with kv_store.transaction():
+        _merge_range(kv_store, start, f"{prefix}{last}\0", pairs, report)
+        kv_store[checkpoint_key] = json.dumps({"txid": txid, "after": last, "done": False})
+      start = f"{prefix}{last}\0"
+
+    with kv_store.transaction():
+      # Whatever is left past the last key no longer exists in the bucket
+      _merge_range(kv_store, start, _prefix_upper_bound(prefix), {}, report)
+      kv_store[checkpoint_key] = json.dumps({"txid": txid, "done": True})
+    report.buckets.append(bucket_name)
+    return report
+  finally:
+    tx.close()
+
+
+def ingest_boltdb(bolt_db: BoltDB, kv_store: KeyValueStore, buckets: Iterable[str] = CHEZMOI_BUCKETS,
+                  namespace: str = NAMESPACE, batch_size: int = BATCH_SIZE) -> SyncReport:
+  """Mirror each of `buckets` into `kv_store`, skipping buckets that are unchanged since the last ingest."""
+  report = SyncReport()
+  for bucket_name in buckets:
+    ingest_bucket(bolt_db, kv_store, bucket_name, namespace=namespace, batch_size=batch_size, report=report)
+  return report
+
+
+def export_boltdb(kv_store: KeyValueStore, bolt_db: BoltDB, buckets: Iterable[str] = CHEZMOI_BUCKETS,
+                  namespace: str = NAMESPACE, batch_size: int = BATCH_SIZE) -> SyncReport:
+  """Write the pairs ingested from `buckets` back into `bolt_db`, creating missing buckets.
+
+  Pairs are streamed out of `kv_store` and committed `batch_size` at a time.  Puts are idempotent, so an interrupted
+  export is finished by running it again.  Keys present only in `bolt_db` are left alone.
+  """
+  report = SyncReport()
+  for bucket_name in buckets:
+    prefix: str = _bucket_prefix(namespace, bucket_name)
+    for batch in _batches(kv_store.scan(prefix), batch_size):
+      with bolt_db.update() as tx:
+        bucket: Bucket = tx.bucket(bucket_name.encode("utf-8")) or tx.create_bucket(bucket_name.encode("utf-8"))
+        for key, value in batch:
+          bucket.put(key[len(prefix):].encode("utf-8"), value.encode("utf-8") if isinstance(value, str) else value)
+      report.written += len(batch)
+    report.buckets.append(bucket_name)
+  return report
@@ -0,0 +1,93 @@
+"""Content-defined chunking of large artifacts, so a small change to one only adds the chunks it touched.
+
+Artifacts of at least `CHUNKED_MIN_SIZE` are cut where a gear rolling hash over the last 32 bytes hits a mask (FastCDC
+with normalized chunking), so boundaries follow the content rather than offsets and an insertion only moves the
+boundaries around it.  Each chunk is stored once, as an attachment named after its sha256 on the `CHUNKS_TITLE` entry,
+and the artifact's own attachment becomes a recipe listing its chunks.  Chunks are shared by every artifact that
+contains them, whichever entry that artifact is attached to.
+
+Re-chunking a changed artifact first walks the chunks of its previous recipe: a chunk whose bytes still hash the same at
+the same offset would be cut at the same place, so the rolling hash only runs from the first changed chunk on.
+"""
+
+import hashlib
+from collections.abc import Iterable, Iterator, Sequence
+
+from trapper_keeper.util import codec as codec_utils
+
+CHUNKS_TITLE: str = "Chunks"
+# Codec recorded for an attachment that holds a recipe rather than the artifact itself
+CHUNKED: str = "chunks"
+
+MIN_CHUNK_SIZE: int = 16 * 1024
+AVG_CHUNK_SIZE: int = 64 * 1024
+MAX_CHUNK_SIZE: int = 256 * 1024
+# Smaller artifacts are attached whole, they would only make a handful of chunks
+CHUNKED_MIN_SIZE: int = MAX_CHUNK_SIZE
+
+# Normalized chunking: a mask with two more bits than the average size before it is reached, two fewer after, taken
+# from the top of the hash where every one of the last 32 bytes has had its say
+_MASK_SMALL: int = ((1 << 18) - 1) << 14
+_MASK_LARGE: int = ((1 << 14) - 1) << 18
+# Fixed forever, changing it would cut every stored artifact differently and share nothing with what is in the vault
+_GEAR: tuple[int, ...] = tuple(int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], "big") for i in range(256))
+
+Recipe = list[tuple[str, int]]
+
+
+def _cut(data: memoryview, start: int) -> int:
+  """End of the chunk starting at `start`."""
+  end: int = len(data)
+  if end - start <= MIN_CHUNK_SIZE:
+    return end
+  limit: int = min(end, start + MAX_CHUNK_SIZE)
+  normal: int = min(limit, start + AVG_CHUNK_SIZE)
+  gear = _GEAR
+  position: int = start + MIN_CHUNK_SIZE
+  fingerprint: int = 0
+  for byte in data[position:normal]:
+    fingerprint = ((fingerprint << 1) + gear[byte]) & 0xFFFFFFFF
+    position += 1
+    if not fingerprint & _MASK_SMALL:
+      return position
+  for byte in data[position:limit]:
+    fingerprint = ((fingerprint << 1) + gear[byte]) & 0xFFFFFFFF
+    position += 1
+    if not fingerprint & _MASK_LARGE:
+      return position
+  return limit
+
+
+def iter_chunks(data: bytes, previous: Sequence[tuple[str, int]] = ()) -> Iterator[tuple[str, memoryview]]:
+  """Yield ``(sha256, chunk)`` of every chunk of `data` in order.
+
+  `previous` is the recipe `data` was last stored with.  Its chunks that still match are taken over without hashing
+  byte by byte; its last chunk never is, as it may only have ended there because the data did.
+  """
+  view = memoryview(data)
+  start: int = 0
+  for digest, size in previous[:-1]:
+    chunk = view[start:start + size]
+    if len(chunk) != size or hashlib.sha256(chunk).hexdigest() != digest:
+      break
+    yield digest, chunk
+    start += size
+  while start < len(view):
+    end: int = _cut(view, start)
+    chunk = view[start:end]
+    yield hashlib.sha256(chunk).hexdigest(), chunk
+    start = end
+
+
+def dumps_recipe(recipe: Iterable[tuple[str, int]]) -> bytes:
+  return "".join(f"{digest} {size}\n" for digest, size in recipe).encode("ascii")
+
+
+def loads_recipe(data: bytes) -> Recipe:
+  return [(digest, int(size)) for digest, size in (line.split(" ") for line in data.decode("ascii").splitlines())]
+
+
+def iter_parts(parts: Iterable[tuple[bytes, str | None]]) -> Iterator[bytes]:
+  """Plain bytes of an artifact stored as ``(payload, codec)`` parts, a whole attachment or the chunks of a recipe."""
+  for payload, codec in parts:
+    yield from codec_utils.iter_decompress(payload, codec)
@@ -0,0 +1,93 @@
+"""Per-artifact compression for vault attachments.
+
+Attachments are encrypted (and, for KDBX3, Base64 encoded) at their full size on every save, so text-heavy artifacts
+such as shell histories, configs and sqlite stores are compressed before they are attached.  The codec is picked per
+artifact from the stdlib codecs by compressing a sample, and stored alongside the attachment so unpack knows how to
+reverse it.
+"""
+
+import bz2
+import lzma
+import zlib
+from collections.abc import Callable, Iterable, Iterator
+
+# Entry custom property holding the codec of the attachment named after the prefix
+CODEC_PROPERTY_PREFIX: str = "codec:"
+
+# Below this size the codec header and the bookkeeping cost more than they save
+MIN_COMPRESS_SIZE: int = 512
+# Only artifacts at least this large are worth trying the slower lzma and bz2 on
+STRONG_CODEC_MIN_SIZE: int = 64 * 1024
+SAMPLE_SIZE: int = 64 * 1024
+# Compressed/original ratio of the sample above which the artifact is stored raw
+MAX_RATIO: float = 0.9
+# A slower codec has to beat zlib's sample size by this factor to be chosen
+STRONG_CODEC_GAIN: float = 0.9
+CHUNK_SIZE: int = 1024 * 1024
+
+_COMPRESSORS: dict[str, Callable[[bytes], bytes]] = {
+  "zlib": lambda data: zlib.compress(data, 6),
+  "bz2": lambda data: bz2.compress(data, 9),
+  "lzma": lambda data: lzma.compress(data, preset=6),
+}
+
+_DECOMPRESSORS: dict[str, Callable[[], object]] = {
+  "zlib": zlib.decompressobj,
+  "bz2": bz2.BZ2Decompressor,
+  "lzma": lzma.LZMADecompressor,
+}
+
+CODECS: tuple[str, ...] = tuple(_COMPRESSORS)
+
+
+def _sample(data: bytes) -> bytes:
+  """Head, middle and tail of `data`, so a large artifact with a compressible header is not mistaken for text."""
+  if len(data) <= SAMPLE_SIZE:
+    return data
+  third = SAMPLE_SIZE // 3
+  middle = len(data) // 2
+  return data[:third] + data[middle:middle + third] + data[-third:]
+
+
+def choose_codec(data: bytes) -> str | None:
+  """Codec to store `data` with, or None when it is small or does not compress."""
+  if len(data) < MIN_COMPRESS_SIZE:
+    return None
+  sample = _sample(data)
+  sizes: dict[str, int] = {"zlib": len(zlib.compress(sample, 1))}
+  if sizes["zlib"] / len(sample) > MAX_RATIO:
+    return None
+  if len(data) >= STRONG_CODEC_MIN_SIZE:
+    sizes["bz2"] = len(bz2.compress(sample, 9))
+    sizes["lzma"] = len(lzma.compress(sample, preset=1))
+  best = min(sizes, key=sizes.__getitem__)
+  return best if sizes[best] < sizes["zlib"] * STRONG_CODEC_GAIN else "zlib"
+
+
+def compress(data: bytes, codec: str) -> bytes:
+  return _COMPRESSORS[codec](data)
+
+
+def iter_decompress(data: bytes, codec: str | None, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+  """Decompress `data` a chunk of input at a time, so the plain artifact is never held in memory as a whole."""
+  if codec is None:
+    yield data
+    return
+  decompressor = _DECOMPRESSORS[codec]()
+  view = memoryview(data)
+  for offset in range(0, len(view), chunk_size):
+    if plain := decompressor.decompress(view[offset:offset + chunk_size]):
+      yield plain
+  if (flush := getattr(decompressor, "flush", None)) is not None and (plain := flush()):
+    yield plain
+
+
+def decompress(data: bytes, codec: str | None) -> bytes:
+  return b"".join(iter_decompress(data, codec))
+
+
+def digest_chunks(chunks: Iterable[bytes], hash_factory: Callable) -> str:
+  digest = hash_factory()
+  for chunk in chunks:
+    digest.update(chunk)
+  return digest.hexdigest()
@@ -1,25 +1,52 @@
 """Utility module to create all the insecure stores to pack into KeePass"""
 
+import base64
 import contextlib
-from dataclasses import dataclass
+import fnmatch
+import hashlib
+import io
+import os
+import posixpath
+import sqlite3
+import stat as stat_module
+import tarfile
+import time
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from enum import Enum
 from pathlib import Path
+from typing import TYPE_CHECKING, BinaryIO
 
-from boltdb import BoltDB
 from pykeepass.attachment import Attachment
 from pykeepass.group import Entry, Group
-from pykeepass.pykeepass import create_database, PyKeePass
+from pykeepass.pykeepass import BLANK_DATABASE_LOCATION, BLANK_DATABASE_PASSWORD, PyKeePass
 
-from trapper_keeper import xdg_cache_home, xdg_data_home, xdg_config_home, xdg_state_home
-from trapper_keeper.sqlite_kvstore import KeyValueStore
+from trapper_keeper.sqlite_kvstore import MEMORY, KeyValueStore
+from trapper_keeper.util import chunking, profiling
+from trapper_keeper.util import codec as codec_utils
+from trapper_keeper.util import discovery as discovery_utils
+from trapper_keeper.util import kdf as kdf_utils
+from trapper_keeper.util.atomic import atomic_write
+from trapper_keeper.util.kdf import KdfParameters
+from trapper_keeper.util.manifest import ArtifactRecord, Manifest, file_sha256
+
+# The defaults used to be defined here and are still imported from here
+from trapper_keeper.util.paths import KEEPASS_DB_KEY, KEEPASS_DB_PATH, KEEPASS_DB_TOKEN, KV_STORE
+from trapper_keeper.util.session import SaveStats, VaultSession
+from trapper_keeper.util.vault_index import VaultIndex, index_path
+
+if TYPE_CHECKING:
+  from boltdb import BoltDB
+
+  from trapper_keeper.util.bolt_sync import SyncReport
 
 PROPERTIES_IDX: int = 0
-KV_STORE: Path = Path(xdg_cache_home(), "trapper_keeper/kv_store.sqlite")
-KEEPASS_DB_PATH: Path = Path.joinpath(xdg_data_home(), "trapper_keeper/secrets.kdbx")
-KEEPASS_DB_KEY: Path = Path.joinpath(xdg_config_home(), "trapper_keeper/secrets.keyx")
-KEEPASS_DB_TOKEN: Path = Path.joinpath(xdg_state_home(), "trapper_keeper/secrets_token")
 
 SPECIAL_BINARIES: str = "2b405bc0-8583-491c-a4af-81628388f2c4"
+PROPERTIES_TITLE: str = "Properties"
+ARTIFACTS_TITLE: str = "Artifacts"
+ENTRY_FIELDS: tuple[str, ...] = ("title", "username", "password", "url", "notes")
 
 
 @dataclass
@@ -29,35 +56,707 @@ class DbTypes(Enum):
   SQLITE: str = "Sqlite"
 
 
+@dataclass
+class PackReport:
+  """Outcome of `DbUtils.pack_tk_store`: which artifacts were re-attached and whether the vault was written.
+
+  `reclaimed` is the number of payload bytes the `DbUtils.compact_kp_db` pass after attaching dropped.  Chunked
+  artifacts (see `util.chunking`) count the chunks they added to the vault and those it already held.
+  """
+  attached: list[str] = field(default_factory=list)
+  unchanged: list[str] = field(default_factory=list)
+  saved: bool = False
+  reclaimed: int = 0
+  chunks_added: int = 0
+  chunks_reused: int = 0
+
+
+@dataclass
+class CompactReport:
+  """Outcome of `DbUtils.compact_kp_db`, binary counts are before and after the pass."""
+  binaries: int = 0
+  kept: int = 0
+  duplicates: int = 0
+  unreferenced: int = 0
+  dangling: int = 0
+  bytes_reclaimed: int = 0
+  saved: bool = False
+
+
+@dataclass
+class RepackReport:
+  """Outcome of `DbUtils.repack_tk_store`: what discovery found and the pack of the changed files, if there were any."""
+  discovery: discovery_utils.Discovery
+  pack: PackReport | None = None
+
+
+@dataclass
+class UnpackReport:
+  """Outcome of `DbUtils.unpack_tk_store`: files written and files that already matched."""
+  written: list[str] = field(default_factory=list)
+  skipped: list[str] = field(default_factory=list)
+
+
+def _unpack_artifact(destination: Path, parts: list[tuple[bytes, str | None]],
+                     record: ArtifactRecord | None = None) -> bool:
+  """Atomically write the artifact stored as `parts` to `destination` unless it already holds exactly that.
+
+  The file gets the mode recorded when it was packed, else keeps the mode it has, and is private (0600) when neither
+  is known.  Returns whether the file was written.
+  """
+  mode: int | None = None if record is None else record.mode
+  with contextlib.suppress(FileNotFoundError):
+    stat: os.stat_result = destination.stat()
+    size: int = stat.st_size
+    if mode is None:
+      mode = stat_module.S_IMODE(stat.st_mode)
+    if record is not None:
+      matches = size == record.size and file_sha256(destination) == record.sha256
+    elif len(parts) == 1 and parts[0][1] is None:
+      matches = size == len(parts[0][0]) and file_sha256(destination) == hashlib.sha256(parts[0][0]).hexdigest()
+    else:
+      matches = file_sha256(destination) == codec_utils.digest_chunks(chunking.iter_parts(parts), hashlib.sha256)
+    if matches:
+      return False
+  with profiling.span("unpack.write"):
+    atomic_write(destination, chunking.iter_parts(parts), mode=0o600 if mode is None else mode)
+  if profiling.enabled():
+    profiling.count("unpack.bytes_written", destination.stat().st_size)
+  return True
+
+
+class _ChunkReader(io.RawIOBase):
+  """Read-only file over an iterator of byte chunks, lets `tarfile` stream a decompressing attachment."""
+
+  def __init__(self, chunks: Iterable[bytes]):
+    self._chunks: Iterator[bytes] = iter(chunks)
+    self._pending: memoryview = memoryview(b"")
+
+  def readable(self) -> bool:
+    return True
+
+  def readinto(self, buffer) -> int:
+    """Fill `buffer` across chunk boundaries, `tarfile` takes any short read for the end of the data."""
+    view = memoryview(buffer).cast("B")
+    filled: int = 0
+    while filled < len(view):
+      if not self._pending:
+        chunk = next(self._chunks, None)
+        if chunk is None:
+          break
+        self._pending = memoryview(chunk)
+        continue
+      size = min(len(view) - filled, len(self._pending))
+      view[filled:filled + size] = self._pending[:size]
+      self._pending = self._pending[size:]
+      filled += size
+    return filled
+
+
+class _ChunkStore:
+  """The chunk attachments of an open vault, resolving recipes into the payloads they list."""
+
+  def __init__(self, kp_db: PyKeePass):
+    self.kp_db = kp_db
+    # PyKeePass.binaries rebuilds the whole list on every access, so take it once rather than per attachment
+    self.binaries: list[bytes] = kp_db.binaries
+    index: VaultIndex = VaultIndex.of(kp_db)
+    group: Group | None = index.group(SPECIAL_BINARIES)
+    self.entry: Entry | None = None if group is None else index.entry(chunking.CHUNKS_TITLE, group)
+    self._codecs: dict[str, str] | None = None
+
+  def holds(self, attachment: Attachment) -> bool:
+    """Whether `attachment` is a chunk rather than an artifact."""
+    return self.entry is not None and attachment._element.getparent() is self.entry._element
+
+  def parts(self, data: bytes, codec: str | None) -> list[tuple[bytes, str | None]]:
+    """``(payload, codec)`` of the attachment `data` stored with `codec`, one per chunk when it is a recipe."""
+    if codec != chunking.CHUNKED:
+      return [(data, codec)]
+    if self._codecs is None:
+      # One pass over the entry, its custom_properties would look every key up again
+      self._codecs = {} if self.entry is None else {
+        string.findtext("Key")[len(codec_utils.CODEC_PROPERTY_PREFIX):]: string.findtext("Value")
+        for string in self.entry._element.iterfind("String")
+        if string.findtext("Key", "").startswith(codec_utils.CODEC_PROPERTY_PREFIX)}
+    index: VaultIndex = VaultIndex.of(self.kp_db)
+    parts: list[tuple[bytes, str | None]] = []
+    for digest, _ in chunking.loads_recipe(data):
+      chunk: Attachment | None = None if self.entry is None else index.attachment(digest, self.entry)
+      if chunk is None:
+        raise KeyError(f"Chunk {digest} is missing from the vault")
+      parts.append((self.binaries[chunk.id], self._codecs.get(digest)))
+    return parts
+
+  def read(self, attachment: Attachment, codec: str | None) -> bytes:
+    return b"".join(chunking.iter_parts(self.parts(self.binaries[attachment.id], codec)))
+
+
+def agent_client():
+  """Client of the running unlock agent, or None.  Imported lazily, the agent module itself builds on `DbUtils`."""
+  from trapper_keeper.agent import AgentClient
+
+  return AgentClient.connect()
+
+
 class DbUtils:
 
   @classmethod
-  def create_tk_store(cls, kp_fp: Path, kp_token: Path, kp_key: Path, kv_fp: Path | None = None) -> None:
-    kp_db: PyKeePass = cls._create_kp_db(kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key)
-    group: Group = cls._create_group(kp_db)
-    cls._create_kv_store(kp_db, group, kv_fp)
-    kp_db.save()
-    # TODO: Validation on creation
+  def create_tk_store(cls, kp_fp: Path, kp_token: Path, kp_key: Path, kv_fp: Path | None = None,
+                      artifacts: Iterable[Path] = (), compress: bool = True,
+                      kdf: KdfParameters | None = None, kdf_target: float | None = None) -> SaveStats:
+    """Create the vault with its special binaries group and kv store, and pack `artifacts` into it.
+
+    Everything happens in one `VaultSession`, so the new vault is encrypted and written exactly once.  `kdf` replaces
+    the library's default Argon2 settings, or with `kdf_target` they are calibrated to open in that many seconds on
+    this machine, see `util.kdf.calibrate`.
+    """
+    if kdf is None and kdf_target is not None:
+      kdf = kdf_utils.calibrate(target_seconds=kdf_target).parameters
+    with cls.create_session(kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key) as session:
+      if kdf is not None:
+        kdf.apply(session.kp_db)
+      group: Group = cls._create_group(session.kp_db)
+      cls._create_kv_store(session.kp_db, group, kv_fp).close()
+      artifacts = [Path(artifact).absolute() for artifact in artifacts]
+      if artifacts:
+        cls.pack_kp_db(session, artifacts=artifacts, compress=compress)
+      # TODO: Validation on creation
+    return session.stats
+
+  @classmethod
+  def open_session(cls, kp_fp: Path, kp_token: Path, kp_key: Path | None = None) -> VaultSession:
+    """Unlock an existing vault for a batch of mutations, see `VaultSession`."""
+    return VaultSession(cls._open_kp_db(kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key))
+
+  @classmethod
+  def create_session(cls, kp_fp: Path, kp_token: Path, kp_key: Path | None = None) -> VaultSession:
+    """Start a new vault that is only written to `kp_fp` when the session flushes."""
+    return VaultSession(cls._create_kp_db(kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key), dirty=True)
+
+  @classmethod
+  def pack_tk_store(cls, kp_fp: Path, kp_token: Path, kp_key: Path, kv_fp: Path | None = None,
+                    artifacts: Iterable[Path] = (), compress: bool = True, use_agent: bool = True) -> PackReport:
+    """Attach the kv store and `artifacts` to the vault, skipping whatever the manifest says is already packed.
+
+    Only artifacts whose content hash changed are re-attached, and the vault is not re-encrypted at all when none did.
+    With `compress`, each attachment is stored with the codec `util.codec.choose_codec` picks for it, recorded in a
+    ``codec:<filename>`` custom property of its entry.
+
+    Routed through the unlock agent when one is running, see `trapper_keeper.agent`.
+    """
+    # Recorded paths are where unpack writes back to, which must not depend on the working directory
+    kv_fp = None if kv_fp is None else Path(kv_fp).absolute()
+    artifacts = [Path(artifact).absolute() for artifact in artifacts]
+    if use_agent and (client := agent_client()) is not None:
+      with contextlib.suppress(ConnectionError):
+        return PackReport(**client.request("pack", kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key, kv_fp=kv_fp,
+                                           artifacts=artifacts, compress=compress))
+    with cls.open_session(kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key) as session:
+      report: PackReport = cls.pack_kp_db(session, kv_fp=kv_fp, artifacts=artifacts, compress=compress)
+      report.saved = session.flush()
+    return report
+
+  @classmethod
+  def repack_tk_store(cls, kp_fp: Path, kp_token: Path, kp_key: Path, kv_fp: Path = KV_STORE,
+                      roots: Iterable[Path] | None = None, rules: discovery_utils.ScanRules | None = None,
+                      compress: bool = True, workers: int | None = None, use_agent: bool = True) -> RepackReport:
+    """Pack whatever changed under the XDG `roots` since the last repack, see `util.discovery`.
+
+    The stat index lives in the Key/Value store at `kv_fp`.  When nothing changed the vault is not even opened.
+    """
+    kv_fp = Path(kv_fp).absolute()
+    kv_fp.parent.mkdir(parents=True, exist_ok=True)
+    with KeyValueStore(kv_fp) as kv_store:
+      # The vault must never end up packing its own secrets
+      found = discovery_utils.discover(kv_store, roots=roots, rules=rules, skip=(kp_fp, kp_token, kp_key, kv_fp),
+                                       workers=workers)
+      report = RepackReport(discovery=found)
+      if found.changed:
+        report.pack = cls.pack_tk_store(kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key, artifacts=found.artifacts,
+                                        compress=compress, use_agent=use_agent)
+      discovery_utils.commit_index(kv_store, found)
+    return report
+
+  @classmethod
+  @profiling.traced("pack")
+  def pack_kp_db(cls, session: VaultSession, kv_fp: Path | None = None, artifacts: Iterable[Path] = (),
+                 compress: bool = True, kv_store: KeyValueStore | None = None) -> PackReport:
+    """`pack_tk_store` within `session`, which is marked dirty but not flushed when anything was attached.
+
+    An open `kv_store`, e.g. one from `load_kp_kv_store`, is packed straight from memory in place of `kv_fp`.
+    """
+    kp_db: PyKeePass = session.kp_db
+    group: Group = cls._find_group(kp_db)
+    manifest: Manifest = Manifest.load(kp_db, group)
+    report = PackReport()
+
+    if kv_store is not None or kv_fp is not None:
+      path: str = str(kv_fp) if kv_fp is not None else cls._properties_filename(kp_db, group)
+      if kv_store is None:
+        if not kv_fp.is_file():
+          raise FileNotFoundError(f"Key/Value store not found in path {kv_fp}")
+        # Through sqlite rather than the raw file, so commits still sitting in the WAL are packed as well
+        with KeyValueStore(kv_fp) as disk_store:
+          data: bytes = disk_store.serialize()
+      else:
+        data = kv_store.serialize()
+      previous: ArtifactRecord | None = manifest.get(path)
+      record = ArtifactRecord(path=path, size=len(data), mtime_ns=0, sha256=hashlib.sha256(data).hexdigest())
+      manifest[path] = record
+      entry: Entry = cls._find_entry(kp_db, group, PROPERTIES_TITLE)
+      # The vault holds a single store, one packed from a new path replaces the old one
+      for stale in [attachment for attachment in entry.attachments if attachment.filename != path]:
+        VaultIndex.of(kp_db).delete_attachment(stale)
+      cls._attach(kp_db, entry, path, lambda: data, previous, record, compress, report)
+
+    owner_changed: bool = False
+    for artifact in artifacts:
+      artifact_fp = Path(artifact)
+      path = str(artifact_fp)
+      previous = manifest.get(path)
+      entry = cls._find_entry(kp_db, group, ARTIFACTS_TITLE)
+      record, artifact_data = ArtifactRecord.read(artifact_fp, previous)
+      if artifact_data is None and VaultIndex.of(kp_db).attachment(path, entry) is None:
+        # The manifest outlived the attachment, the bytes have to be read and hashed after all
+        record, artifact_data = ArtifactRecord.read(artifact_fp)
+      manifest[path] = record
+      owner_changed |= record.owner_changed(previous)
+      cls._attach(kp_db, entry, path, lambda data=artifact_data: data, previous, record, compress, report)
+
+    cls._finish_pack(session, group, manifest, report, owner_changed)
+    return report
+
+  @classmethod
+  def _finish_pack(cls, session: VaultSession, group: Group, manifest: Manifest, report: PackReport,
+                   owner_changed: bool = False) -> None:
+    """Store the manifest and mark `session` dirty when anything was attached or only modes/owners moved."""
+    if not (report.attached or owner_changed):
+      return
+    manifest.store(session.kp_db, group)
+    if report.attached:
+      cls._detach_unused_chunks(session.kp_db, group)
+      # Every replaced attachment left its old payload behind in the binary pool
+      report.reclaimed = cls.compact_kp_db(session.kp_db).bytes_reclaimed
+    session.mark_dirty()
+
+  @staticmethod
+  def _detach_unused_chunks(kp_db: PyKeePass, group: Group) -> None:
+    """Detach the chunks no recipe lists any more, along with their codecs, for `compact_kp_db` to drop."""
+    index: VaultIndex = VaultIndex.of(kp_db)
+    chunks_entry: Entry | None = index.entry(chunking.CHUNKS_TITLE, group)
+    if chunks_entry is None:
+      return
+    binaries: list[bytes] = kp_db.binaries
+    used: set[str] = set()
+    # Recipes of history entries included, restoring one must not lose its chunks
+    for codec in kp_db.tree.xpath(f"//Entry/String[Value='{chunking.CHUNKED}']"):
+      key: str = codec.findtext("Key")
+      if not key.startswith(codec_utils.CODEC_PROPERTY_PREFIX):
+        continue
+      filename: str = key[len(codec_utils.CODEC_PROPERTY_PREFIX):]
+      for binary in codec.getparent().iterfind("Binary"):
+        if binary.findtext("Key") == filename and (ref := int(binary.find("Value").get("Ref"))) < len(binaries):
+          used.update(digest for digest, _ in chunking.loads_recipe(binaries[ref]))
+
+    unused: set[str] = set()
+    for attachment in chunks_entry.attachments:
+      if attachment.filename not in used:
+        unused.add(attachment.filename)
+        index.delete_attachment(attachment)
+    for string in chunks_entry._element.findall("String"):
+      key = string.findtext("Key", "")
+      if key.startswith(codec_utils.CODEC_PROPERTY_PREFIX) and key[len(codec_utils.CODEC_PROPERTY_PREFIX):] in unused:
+        chunks_entry._element.remove(string)
+    profiling.count("chunks.detached", len(unused))
+
+  @classmethod
+  def import_tk_tar(cls, kp_fp: Path, kp_token: Path, kp_key: Path, fileobj: BinaryIO,
+                    compress: bool = True) -> PackReport:
+    """Pack every regular file of the tar stream `fileobj` under its path in the archive, taken from ``/``.
+
+    The archive is read strictly sequentially, so it may come from a pipe.  Modes, ownership and mtimes of the members
+    are recorded like those of packed files, and the member landing on the Key/Value store's path replaces the store.
+    """
+    with cls.open_session(kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key) as session:
+      report: PackReport = cls.import_kp_tar(session, fileobj, compress=compress)
+      report.saved = session.flush()
+    return report
+
+  @classmethod
+  @profiling.traced("import.tar")
+  def import_kp_tar(cls, session: VaultSession, fileobj: BinaryIO, compress: bool = True) -> PackReport:
+    """`import_tk_tar` within `session`."""
+    kp_db: PyKeePass = session.kp_db
+    group: Group = cls._find_group(kp_db)
+    manifest: Manifest = Manifest.load(kp_db, group)
+    properties_path: str = cls._properties_filename(kp_db, group)
+    report = PackReport()
+    owner_changed: bool = False
+
+    with tarfile.open(fileobj=fileobj, mode="r|*") as archive:
+      for member in archive:
+        if not member.isreg():
+          continue
+        # Anchored at / so that no member name, ``..`` included, can point above it.  normpath keeps exactly two
+        # leading slashes, which an absolute member name would otherwise end up with
+        path: str = "/" + posixpath.normpath(f"/{member.name}").lstrip("/")
+        with archive.extractfile(member) as member_file:
+          data: bytes = member_file.read()
+        previous: ArtifactRecord | None = manifest.get(path)
+        record = ArtifactRecord(path=path, size=len(data), mtime_ns=int(member.mtime * 1e9),
+                                sha256=hashlib.sha256(data).hexdigest(), mode=member.mode, uid=member.uid,
+                                gid=member.gid)
+        manifest[path] = record
+        owner_changed |= record.owner_changed(previous)
+        title: str = PROPERTIES_TITLE if path == properties_path else ARTIFACTS_TITLE
+        cls._attach(kp_db, cls._find_entry(kp_db, group, title), path, lambda data=data: data, previous, record,
+                    compress, report)
+
+    cls._finish_pack(session, group, manifest, report, owner_changed)
+    return report
+
+  @classmethod
+  def compact_tk_store(cls, kp_fp: Path, kp_token: Path, kp_key: Path | None = None) -> CompactReport:
+    """`compact_kp_db` on the vault at `kp_fp`, which is only written when something was reclaimed."""
+    with cls.open_session(kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key) as session:
+      report: CompactReport = cls.compact_kp_db(session.kp_db)
+      if report.binaries != report.kept or report.dangling:
+        session.mark_dirty()
+      report.saved = session.flush()
+    return report
 
   @classmethod
-  def pack_tk_store(cls, kp_fp: Path, kp_token: Path, kp_key: Path, kv_fp: Path | None = None):
-    with PyKeePass(filename=kp_fp, password=kp_token, keyfile=kp_key) as kp_db:
-      binary_entry: Entry = kp_db.find_entries(title="Properties", first=True)
-      properties_attachment: Attachment = binary_entry.attachments[PROPERTIES_IDX]
-      binary_entry.delete_attachment(properties_attachment)
-      binary_entry.add_attachment(id=PROPERTIES_IDX, filename=str(kv_fp))
-      kp_db.save()
+  def tune_tk_store(cls, kp_fp: Path, kp_token: Path, kp_key: Path | None, kdf: KdfParameters) -> bool:
+    """Re-encrypt the vault with the Argon2 settings `kdf`, returns whether it had other settings and was written."""
+    with cls.open_session(kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key) as session:
+      if KdfParameters.of(session.kp_db) != kdf:
+        kdf.apply(session.kp_db)
+        session.mark_dirty()
+      return session.flush()
 
   @classmethod
-  def unpack_tk_store(cls, kp_fp: Path, kp_token: Path, kp_key: Path | None = None):
-    with PyKeePass(filename=kp_fp, password=kp_token, keyfile=kp_key) as kp_db:
-      for attachment in kp_db.attachments:
-        with open(file=attachment.filename, encoding='utf-8', mode="w+b") as attachment_update:
-          attachment_update.write(attachment.binary)
+  def index_tk_store(cls, kp_fp: Path, kp_token: Path, kp_key: Path | None = None) -> Path:
+    """Persist the lookup index of the vault next to it and keep it updated from now on, see `util.vault_index`."""
+    with cls.open_session(kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key) as session:
+      if VaultIndex.of(session.kp_db).persist():
+        # The index key has to be in the vault before the index file can be written for it
+        session.mark_dirty()
+    return index_path(kp_fp)
+
+  @staticmethod
+  @profiling.traced("compact")
+  def compact_kp_db(kp_db: PyKeePass) -> CompactReport:
+    """Drop binaries no attachment refers to and merge identical ones, re-pointing every attachment.
+
+    Attachments reference binaries by position, so the pool is rebuilt in order and every reference, including those
+    of history entries, is rewritten.  References to binaries that do not exist are removed as they cannot be read
+    anyway.  Only KDBX4 keeps binaries in the inner header, older vaults are left alone.
+    """
+    if kp_db.version < (4, 0):
+      return CompactReport(binaries=len(kp_db.binaries), kept=len(kp_db.binaries))
+    pool = kp_db.payload.inner_header.binary
+    references = kp_db.tree.xpath("//Binary/Value[@Ref]")
+    referenced: set[int] = {int(reference.get("Ref")) for reference in references}
+
+    report = CompactReport(binaries=len(pool))
+    kept: list = []
+    remap: dict[int, int] = {}
+    # Keyed on the payload including its protected flag byte, so protection survives the merge
+    first_seen: dict[bytes, int] = {}
+    for old_id, binary in enumerate(pool):
+      if old_id not in referenced:
+        report.unreferenced += 1
+        report.bytes_reclaimed += len(binary.data) - 1
+        continue
+      digest: bytes = hashlib.sha256(binary.data).digest()
+      if (new_id := first_seen.get(digest)) is not None:
+        report.duplicates += 1
+        report.bytes_reclaimed += len(binary.data) - 1
+      else:
+        new_id = first_seen[digest] = len(kept)
+        kept.append(binary)
+      remap[old_id] = new_id
+
+    for reference in references:
+      if (new_id := remap.get(int(reference.get("Ref")))) is None:
+        report.dangling += 1
+        VaultIndex.of(kp_db).delete_attachment(Attachment(element=reference.getparent(), kp=kp_db))
+      else:
+        reference.set("Ref", str(new_id))
+    pool[:] = kept
+    report.kept = len(kept)
+    profiling.count("compact.bytes_reclaimed", report.bytes_reclaimed)
+    return report
+
+  @classmethod
+  def _attach(cls, kp_db: PyKeePass, entry: Entry, path: str, read: Callable[[], bytes],
+              previous: ArtifactRecord | None, record: ArtifactRecord, compress: bool, report: PackReport) -> None:
+    """(Re-)attach `path` to `entry` unless the attached copy already has the hash of `record`."""
+    index: VaultIndex = VaultIndex.of(kp_db)
+    attachment: Attachment | None = index.attachment(path, entry)
+    if attachment is not None and previous is not None and previous.sha256 == record.sha256:
+      report.unchanged.append(path)
+      return
+
+    recipe: chunking.Recipe = []
+    if attachment is not None:
+      if entry.get_custom_property(f"{codec_utils.CODEC_PROPERTY_PREFIX}{path}") == chunking.CHUNKED:
+        recipe = chunking.loads_recipe(attachment.binary)
+      index.delete_attachment(attachment)
+    data: bytes = read()
+    profiling.count("pack.bytes_read", len(data))
+    if len(data) >= chunking.CHUNKED_MIN_SIZE:
+      encoded: bytes = cls._store_chunks(kp_db, entry, path, data, recipe, compress, report)
+    else:
+      encoded = cls._encode_artifact(entry, path, data, compress)
+    index.add_attachment(entry, kp_db.add_binary(encoded, protected=True), filename=path)
+    report.attached.append(path)
+
+  @classmethod
+  @profiling.traced("chunks.store")
+  def _store_chunks(cls, kp_db: PyKeePass, entry: Entry, path: str, data: bytes, previous: chunking.Recipe,
+                    compress: bool, report: PackReport) -> bytes:
+    """Attach the chunks of `data` the vault does not hold yet and return its recipe, marked as such on `entry`.
+
+    `previous` is the recipe `path` was stored with so far, see `util.chunking.iter_chunks`.  Each chunk is compressed
+    on its own, so only new chunks are ever compressed.
+    """
+    index: VaultIndex = VaultIndex.of(kp_db)
+    chunks_entry: Entry = cls._find_entry(kp_db, cls._find_group(kp_db), chunking.CHUNKS_TITLE)
+    recipe: chunking.Recipe = []
+    for digest, chunk in chunking.iter_chunks(data, previous):
+      recipe.append((digest, len(chunk)))
+      if index.attachment(digest, chunks_entry) is not None:
+        report.chunks_reused += 1
+        continue
+      encoded: bytes = cls._encode_artifact(chunks_entry, digest, bytes(chunk), compress)
+      index.add_attachment(chunks_entry, kp_db.add_binary(encoded, protected=True), filename=digest)
+      report.chunks_added += 1
+      profiling.count("chunks.bytes_added", len(chunk))
+    entry.set_custom_property(f"{codec_utils.CODEC_PROPERTY_PREFIX}{path}", chunking.CHUNKED)
+    return chunking.dumps_recipe(recipe)
+
+  @classmethod
+  def unpack_tk_store(cls, kp_fp: Path, kp_token: Path, kp_key: Path | None = None, include: Iterable[str] | None = None,
+                      root: Path | None = None, workers: int | None = None, use_agent: bool = True) -> UnpackReport:
+    """Write the vault's attachments back to the paths they were packed from.
+
+    Args:
+        include: Glob patterns (`fnmatch` style, ``*`` also matches ``/``) selecting which attachments to unpack, all
+          of them when None.
+        root: Directory to unpack under instead of ``/``, e.g. a container rootfs.
+        workers: Threads hashing and writing attachments.
+
+    Every file is written through a temp file and an atomic rename, so an interrupted unpack never leaves a
+    half-written secret behind.  Files whose content already matches are left untouched.  Routed through the unlock
+    agent when one is running.
+    """
+    include = None if include is None else list(include)
+    if use_agent and (client := agent_client()) is not None:
+      with contextlib.suppress(ConnectionError):
+        return UnpackReport(**client.request("unpack", kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key,
+                                             include=include, root=root, workers=workers))
+    return cls.unpack_kp_db(cls._open_kp_db(kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key), include=include,
+                            root=root, workers=workers)
+
+  @classmethod
+  @profiling.traced("unpack")
+  def unpack_kp_db(cls, kp_db: PyKeePass, include: Iterable[str] | None = None, root: Path | None = None,
+                   workers: int | None = None) -> UnpackReport:
+    """`unpack_tk_store` against an already unlocked vault."""
+    jobs: list[tuple[Path, list[tuple[bytes, str | None]], ArtifactRecord | None]] = []
+    for filename, parts, record in cls._selected_attachments(kp_db, include):
+      destination = Path(filename) if root is None else Path(root, filename.lstrip("/"))
+      jobs.append((destination, parts, record))
+
+    report = UnpackReport()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+      results = pool.map(lambda job: _unpack_artifact(*job), jobs)
+      for (destination, *_), written in zip(jobs, results, strict=True):
+        (report.written if written else report.skipped).append(str(destination))
+    return report
+
+  @classmethod
+  def _selected_attachments(cls, kp_db: PyKeePass, include: Iterable[str] | None = None
+                            ) -> Iterator[tuple[str, list[tuple[bytes, str | None]], ArtifactRecord | None]]:
+    """``(filename, stored parts, manifest record)`` of every artifact matching `include`, see `_ChunkStore.parts`."""
+    group: Group | None = VaultIndex.of(kp_db).group(SPECIAL_BINARIES)
+    manifest: Manifest = Manifest() if group is None else Manifest.load(kp_db, group)
+    patterns: list[str] | None = None if include is None else list(include)
+
+    chunks = _ChunkStore(kp_db)
+    for attachment in kp_db.attachments:
+      filename: str = attachment.filename
+      if chunks.holds(attachment):
+        continue
+      if patterns is not None and not any(fnmatch.fnmatchcase(filename, pattern) for pattern in patterns):
+        continue
+      codec: str | None = attachment.entry.get_custom_property(f"{codec_utils.CODEC_PROPERTY_PREFIX}{filename}")
+      yield filename, chunks.parts(chunks.binaries[attachment.id], codec), manifest.get(filename)
+
+  @classmethod
+  def export_tk_tar(cls, kp_fp: Path, kp_token: Path, kp_key: Path | None, fileobj: BinaryIO,
+                    include: Iterable[str] | None = None) -> UnpackReport:
+    """Stream the vault's attachments as a tar archive to `fileobj` instead of writing them out, see `export_kp_tar`."""
+    return cls.export_kp_tar(cls._open_kp_db(kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key), fileobj, include=include)
+
+  @classmethod
+  @profiling.traced("export.tar")
+  def export_kp_tar(cls, kp_db: PyKeePass, fileobj: BinaryIO, include: Iterable[str] | None = None) -> UnpackReport:
+    """Write the attachments matching `include` to `fileobj` as an uncompressed tar stream, `written` lists them.
+
+    Members are named by the path they were packed from, relative to ``/``, with the mode, owner and mtime the
+    manifest recorded (0600 and root for what predates that).  The archive is written sequentially and each attachment
+    decompressed a chunk at a time, so `fileobj` may be a pipe and no plain file is ever held or staged as a whole.
+    """
+    report = UnpackReport()
+    now: float = time.time()
+    with tarfile.open(fileobj=fileobj, mode="w|", format=tarfile.PAX_FORMAT) as archive:
+      for filename, parts, record in cls._selected_attachments(kp_db, include):
+        member = tarfile.TarInfo(name=filename.lstrip("/"))
+        if record is None:
+          # Nothing says how large the plain file is, which tar needs up front
+          plain: bytes = b"".join(chunking.iter_parts(parts))
+          member.size, stream = len(plain), io.BytesIO(plain)
+        else:
+          member.size, stream = record.size, _ChunkReader(chunking.iter_parts(parts))
+          member.mode = 0o600 if record.mode is None else record.mode
+          member.uid, member.gid = record.uid or 0, record.gid or 0
+        member.mtime = record.mtime_ns / 1e9 if record is not None and record.mtime_ns else now
+        archive.addfile(member, stream)
+        profiling.count("export.bytes_written", member.size)
+        report.written.append(member.name)
+    return report
+
+  @classmethod
+  def read_attachment(cls, kp_fp: Path, kp_token: Path, kp_key: Path | None, filename: str,
+                      use_agent: bool = True) -> bytes:
+    """Decoded content of the attachment packed from `filename`, without writing it anywhere."""
+    if use_agent and (client := agent_client()) is not None:
+      with contextlib.suppress(ConnectionError):
+        return base64.b64decode(client.request("attachment", kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key,
+                                               filename=filename))
+    return cls.read_kp_attachment(cls._open_kp_db(kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key), filename)
+
+  @staticmethod
+  def read_kp_attachment(kp_db: PyKeePass, filename: str) -> bytes:
+    attachment: Attachment | None = VaultIndex.of(kp_db).attachment(filename)
+    if attachment is None:
+      raise KeyError(filename)
+    codec: str | None = attachment.entry.get_custom_property(f"{codec_utils.CODEC_PROPERTY_PREFIX}{filename}")
+    return _ChunkStore(kp_db).read(attachment, codec)
+
+  @classmethod
+  def read_field(cls, kp_fp: Path, kp_token: Path, kp_key: Path | None, title: str, field_name: str = "password",
+                 use_agent: bool = True) -> str | None:
+    """A standard field (password, username, url, notes) or custom property of the entry titled `title`."""
+    if use_agent and (client := agent_client()) is not None:
+      with contextlib.suppress(ConnectionError):
+        return client.request("field", kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key, title=title,
+                              field_name=field_name)
+    return cls.read_kp_field(cls._open_kp_db(kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key), title, field_name)
+
+  @staticmethod
+  def read_kp_field(kp_db: PyKeePass, title: str, field_name: str = "password") -> str | None:
+    entry: Entry | None = VaultIndex.of(kp_db).entry(title)
+    if entry is None:
+      raise KeyError(title)
+    if field_name in ENTRY_FIELDS:
+      return getattr(entry, field_name)
+    return entry.get_custom_property(field_name)
+
+  @classmethod
+  def load_kv_store(cls, kp_fp: Path, kp_token: Path, kp_key: Path | None = None, use_agent: bool = True,
+                    **kwargs) -> KeyValueStore:
+    """The vault's Key/Value store, deserialized into memory without touching disk.
+
+    Keyword arguments are passed through to `KeyValueStore`.  Routed through the unlock agent when one is running.
+    """
+    if use_agent and (client := agent_client()) is not None:
+      with contextlib.suppress(ConnectionError):
+        data = base64.b64decode(client.request("properties", kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key))
+        return KeyValueStore.from_bytes(data, **kwargs)
+    return cls.load_kp_kv_store(cls._open_kp_db(kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key), **kwargs)
+
+  @classmethod
+  def load_kp_kv_store(cls, kp_db: PyKeePass, **kwargs) -> KeyValueStore:
+    """`load_kv_store` against an already unlocked vault."""
+    return KeyValueStore.from_bytes(cls.read_kp_properties(kp_db), **kwargs)
+
+  @classmethod
+  def read_kp_properties(cls, kp_db: PyKeePass) -> bytes:
+    """The serialized Key/Value store attached to the Properties entry."""
+    entry: Entry = cls._find_properties_entry(kp_db)
+    if not entry.attachments:
+      raise KeyError(PROPERTIES_TITLE)
+    attachment: Attachment = entry.attachments[PROPERTIES_IDX]
+    codec: str | None = entry.get_custom_property(f"{codec_utils.CODEC_PROPERTY_PREFIX}{attachment.filename}")
+    return _ChunkStore(kp_db).read(attachment, codec)
+
+  @classmethod
+  def _find_properties_entry(cls, kp_db: PyKeePass) -> Entry:
+    entry: Entry | None = VaultIndex.of(kp_db).entry(PROPERTIES_TITLE, cls._find_group(kp_db))
+    if entry is None:
+      raise KeyError(PROPERTIES_TITLE)
+    return entry
+
+  @classmethod
+  def _properties_filename(cls, kp_db: PyKeePass, group: Group) -> str:
+    """Path the Key/Value store was attached under, `KV_STORE` for a vault without one."""
+    entry: Entry | None = VaultIndex.of(kp_db).entry(PROPERTIES_TITLE, group)
+    if entry is None or not entry.attachments:
+      return str(KV_STORE)
+    return entry.attachments[PROPERTIES_IDX].filename
+
+  @staticmethod
+  def _encode_artifact(entry: Entry, filename: str, data: bytes, compress: bool = True) -> bytes:
+    """Compress `data` for attachment as `filename` and record the codec used on `entry`."""
+    codec_property: str = f"{codec_utils.CODEC_PROPERTY_PREFIX}{filename}"
+    with profiling.span("codec.choose"):
+      codec: str | None = codec_utils.choose_codec(data) if compress else None
+    if codec is None:
+      if entry.get_custom_property(codec_property) is not None:
+        entry.delete_custom_property(codec_property)
+      return data
+    entry.set_custom_property(codec_property, codec)
+    with profiling.span("codec.compress", codec=codec):
+      encoded: bytes = codec_utils.compress(data, codec)
+    profiling.count("codec.bytes_in", len(data))
+    profiling.count("codec.bytes_out", len(encoded))
+    return encoded
+
+  @staticmethod
+  def _open_kp_db(kp_fp: Path, kp_token: Path, kp_key: Path | None = None) -> PyKeePass:
+    with profiling.span("kdbx.open", filename=str(kp_fp)):
+      kp_db = PyKeePass(filename=kp_fp, password=kp_token.read_text("utf-8").strip("\n"), keyfile=kp_key)
+    if profiling.enabled():
+      profiling.count("kdbx.opens")
+      profiling.count("kdbx.bytes_read", os.stat(kp_fp).st_size)
+    return kp_db
+
+  @staticmethod
+  def _find_group(kp_db: PyKeePass) -> Group:
+    group: Group | None = VaultIndex.of(kp_db).group(SPECIAL_BINARIES)
+    if group is None:
+      raise AttributeError(f"Special binaries ({SPECIAL_BINARIES}) group does not exist, create the store first")
+    return group
+
+  @staticmethod
+  def _find_entry(kp_db: PyKeePass, group: Group, title: str) -> Entry:
+    """Entry `title` of the special binaries group, added on first use."""
+    index: VaultIndex = VaultIndex.of(kp_db)
+    entry: Entry | None = index.entry(title, group)
+    if entry is None:
+      entry = index.add_entry(group, title)
+    return entry
 
   @staticmethod
   def _create_kp_db(kp_fp: Path, kp_token: Path, kp_key: Path | None = None) -> PyKeePass:
-    """Create a new keepass vault in the KEEPASS_DB_PATH, with the KEEPASS_DB_KEY, and KEEPASS_DB_TOKEN."""
+    """Create a new keepass vault in the KEEPASS_DB_PATH, with the KEEPASS_DB_KEY, and KEEPASS_DB_TOKEN.
+
+    Unlike `create_database` nothing is written yet, the caller saves once the vault is populated.
+    """
     if not kp_fp.is_file():
       # make the directory at least if the database does not exist
       kp_fp.parent.mkdir(mode=0o700, exist_ok=True, parents=True)
@@ -73,41 +772,85 @@ class DbUtils:
       kp_key.parent.mkdir(mode=0o700, exist_ok=True, parents=True)
       raise FileNotFoundError(f"Key file not found in path {kp_key}")
 
-    return create_database(kp_fp, password=kp_token.read_text("utf-8").strip("\n"), keyfile=kp_key)
+    with profiling.span("kdbx.open_blank"):
+      kp_db = PyKeePass(BLANK_DATABASE_LOCATION, BLANK_DATABASE_PASSWORD)
+    kp_db.filename = kp_fp
+    kp_db.password = kp_token.read_text("utf-8").strip("\n")
+    kp_db.keyfile = kp_key
+    return kp_db
 
   @staticmethod
   def _create_group(kp_db: PyKeePass) -> Group:
     # Keepass database params are always expected, so these pertain to an embedded attachment
-    group = kp_db.find_groups(name=SPECIAL_BINARIES, first=True)
+    index: VaultIndex = VaultIndex.of(kp_db)
+    group = index.group(SPECIAL_BINARIES)
     if group is None or len(group) == 0:
-      group = kp_db.add_group(
-        destination_group=kp_db.root_group,
-        group_name=SPECIAL_BINARIES,
+      group = index.add_group(
+        kp_db.root_group,
+        SPECIAL_BINARIES,
         notes="Special group dedicated to auxiliary data stores"
       )
-      kp_db.save()
       return group
     else:
       raise AttributeError(f"Special binaries ({SPECIAL_BINARIES}) group already exists")
 
   @staticmethod
-  def _create_kv_store(kp_db: PyKeePass, group: Group, kv_fp: Path = KV_STORE, prop_table_name: str = "Properties") -> KeyValueStore:
-    properties_entry: Entry = kp_db.add_entry(destination_group=group, title=prop_table_name, username="", password="")
+  def _create_kv_store(kp_db: PyKeePass, group: Group, kv_fp: Path | None = None, prop_table_name: str = PROPERTIES_TITLE) -> KeyValueStore:
+    """Attach the serialized Key/Value store to a new Properties entry.
 
-    """Create the sqlite database with a Key/Value store that is closed immediately after it exports the init sql"""
-    kv_db = KeyValueStore(filename=kv_fp)
+    An existing store at `kv_fp` is imported, otherwise the store is created in memory and nothing lands on disk.
+    `kv_fp` (`KV_STORE` by default) is only recorded as the path the store unpacks to.
+    """
+    index: VaultIndex = VaultIndex.of(kp_db)
+    properties_entry: Entry = index.add_entry(group, prop_table_name)
+
+    kv_fp = KV_STORE if kv_fp is None else kv_fp
+    if kv_fp.is_file():
+      # Read-only, opening it as a KeyValueStore would migrate the user's file and switch it to WAL as a side effect
+      with contextlib.closing(sqlite3.connect(f"{kv_fp.absolute().as_uri()}?mode=ro", uri=True)) as source:
+        kv_db = KeyValueStore.from_bytes(source.serialize())
+    else:
+      kv_db = KeyValueStore(filename=MEMORY)
 
-    # binary: bytes = bytes("".join(kv_db.iterdump()), "utf-8")
     properties_id: int = kp_db.add_binary(bytes(kv_db), protected=True)
-    properties_entry.add_attachment(id=properties_id, filename=str(kv_fp))
+    index.add_attachment(properties_entry, properties_id, filename=str(kv_fp))
 
     if not (len(kp_db.groups) > 0 and len(kp_db.entries) > 0 and len(kp_db.attachments) > 0 and len(kp_db.binaries) > 0):
       raise ValueError("Could not create special binary group in keepass db")
 
-    kp_db.save()
     return kv_db
 
   @staticmethod
-  def load_boltdb_store(bp_fp: Path) -> BoltDB:
+  def load_boltdb_store(bp_fp: Path) -> "BoltDB":
+    from boltdb import BoltDB
+
     bolt_db = BoltDB(filename=bp_fp, readonly=True)
     return bolt_db
+
+  @staticmethod
+  def ingest_boltdb_store(bp_fp: Path, kv_fp: Path = KV_STORE, buckets: Iterable[str] | None = None,
+                          batch_size: int | None = None) -> "SyncReport":
+    """Sync chezmoi's BoltDB state at `bp_fp` into the Key/Value store at `kv_fp`, see `util.bolt_sync`.
+
+    `buckets` defaults to chezmoi's own, `batch_size` to `bolt_sync.BATCH_SIZE`.
+    """
+    from trapper_keeper.util import bolt_sync
+
+    if not bp_fp.is_file():
+      raise FileNotFoundError(f"BoltDB not found in path {bp_fp}")
+    with bolt_sync.open_boltdb(bp_fp) as bolt_db, KeyValueStore(kv_fp) as kv_store:
+      return bolt_sync.ingest_boltdb(bolt_db, kv_store, buckets=buckets or bolt_sync.CHEZMOI_BUCKETS,
+                                     batch_size=batch_size or bolt_sync.BATCH_SIZE)
+
+  @staticmethod
+  def export_boltdb_store(bp_fp: Path, kv_fp: Path = KV_STORE, buckets: Iterable[str] | None = None,
+                          batch_size: int | None = None) -> "SyncReport":
+    """Write the BoltDB state held in the Key/Value store at `kv_fp` back into `bp_fp`, creating it if needed."""
+    from trapper_keeper.util import bolt_sync
+
+    if not kv_fp.is_file():
+      raise FileNotFoundError(f"Key/Value store not found in path {kv_fp}")
+    bp_fp.parent.mkdir(mode=0o700, exist_ok=True, parents=True)
+    with KeyValueStore(kv_fp) as kv_store, bolt_sync.open_boltdb(bp_fp, readonly=False) as bolt_db:
+      return bolt_sync.export_boltdb(kv_store, bolt_db, buckets=buckets or bolt_sync.CHEZMOI_BUCKETS,
+                                     batch_size=batch_size or bolt_sync.BATCH_SIZE)
@@ -0,0 +1,213 @@
+"""Find the artifacts `repack` gathers from the XDG directories, without hashing the whole home directory.
+
+The roots are walked in parallel, one `os.scandir` per directory on a thread pool, with excluded directories pruned
+before they are entered.  Every file seen is compared with a stat index kept in the Key/Value store under
+``<INDEX_PREFIX><path>``: a file whose inode, size and mtime are all unchanged is skipped outright, any other file is
+hashed and only counts as changed when its sha256 moved.  An unchanged tree therefore costs one ``stat`` per file and
+no reads.
+
+The index describes what was last packed, so `commit_index` is only called once the changed files are in the vault.
+"""
+
+import fnmatch
+import os
+import re
+import time
+from collections.abc import Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from trapper_keeper import xdg_bin_home, xdg_config_home, xdg_data_home, xdg_state_home
+from trapper_keeper.sqlite_kvstore import KeyValueStore, _prefix_upper_bound
+from trapper_keeper.util import profiling
+from trapper_keeper.util.manifest import file_sha256
+
+INDEX_PREFIX: str = ".discovery/stat/"
+# Matched against both the name and the path relative to its root, a matching directory is not entered.  Everything
+# trapper_keeper keeps in the XDG directories (vault, key, token) sits in a ``trapper_keeper`` directory
+DEFAULT_EXCLUDES: tuple[str, ...] = ("trapper_keeper", "*.kdbx", ".git", "__pycache__", "*.pyc", "*.sock", "*.lock",
+                                     "*.swp", "*.tmp", "*-wal", "*-shm")
+
+
+def default_roots() -> list[Path]:
+  """The XDG homes artifacts are gathered from, the cache is left out as it only holds what can be rebuilt."""
+  return [xdg_config_home(), xdg_data_home(), xdg_state_home(), xdg_bin_home()]
+
+
+def _compile(patterns: Iterable[str]) -> re.Pattern | None:
+  patterns = list(patterns)
+  return re.compile("|".join(fnmatch.translate(pattern) for pattern in patterns)) if patterns else None
+
+
+@dataclass(frozen=True)
+class ScanRules:
+  """fnmatch patterns for the files to gather, excludes win over includes."""
+  include: tuple[str, ...] = ("*",)
+  exclude: tuple[str, ...] = DEFAULT_EXCLUDES
+
+  def __post_init__(self):
+    # One regex per side instead of a fnmatch call per pattern and file
+    object.__setattr__(self, "_include", _compile(self.include))
+    object.__setattr__(self, "_exclude", _compile(self.exclude))
+
+  def excluded(self, name: str, relative: str) -> bool:
+    return self._exclude is not None and bool(self._exclude.match(name) or self._exclude.match(relative))
+
+  def included(self, name: str, relative: str) -> bool:
+    if self.excluded(name, relative):
+      return False
+    if "*" in self.include:
+      return True
+    return self._include is not None and bool(self._include.match(name) or self._include.match(relative))
+
+
+@dataclass(frozen=True)
+class IndexRecord:
+  """Stat and hash of a file as it was last packed."""
+  inode: int
+  size: int
+  mtime_ns: int
+  sha256: str
+
+  def dumps(self) -> str:
+    return f"{_stat_key(self.inode, self.size, self.mtime_ns)}{self.sha256}"
+
+  @classmethod
+  def loads(cls, text: str) -> "IndexRecord":
+    inode, size, mtime_ns, sha256 = text.split(" ")
+    return cls(inode=int(inode), size=int(size), mtime_ns=int(mtime_ns), sha256=sha256)
+
+
+def _stat_key(inode: int, size: int, mtime_ns: int) -> str:
+  """Leading part of a serialized `IndexRecord`, compared as a string so unchanged files are never parsed."""
+  return f"{inode} {size} {mtime_ns} "
+
+
+@dataclass
+class Discovery:
+  """Outcome of `discover`.
+
+  `changed` are the files to pack.  `updates` holds the new index record of every file whose stat moved, including
+  those whose content did not, and `removed` the indexed files that are gone or no longer match the rules.
+  """
+  scanned: int = 0
+  hashed: int = 0
+  changed: list[str] = field(default_factory=list)
+  removed: list[str] = field(default_factory=list)
+  errors: list[str] = field(default_factory=list)
+  updates: dict[str, IndexRecord] = field(default_factory=dict)
+  seconds: float = 0.0
+
+  @property
+  def artifacts(self) -> list[Path]:
+    return [Path(path) for path in self.changed]
+
+
+def _scan_dir(directory: str, relative: str, rules: ScanRules,
+              skip: frozenset[str]) -> tuple[list[tuple[str, os.stat_result]], list[tuple[str, str]], str | None]:
+  """Files of one directory with their stat, the subdirectories to descend into, and the error if it was unreadable."""
+  files: list[tuple[str, os.stat_result]] = []
+  subdirs: list[tuple[str, str]] = []
+  try:
+    with os.scandir(directory) as entries:
+      for entry in entries:
+        entry_relative = f"{relative}{entry.name}"
+        if entry.path in skip:
+          continue
+        if entry.is_dir(follow_symlinks=False):
+          if not rules.excluded(entry.name, entry_relative):
+            subdirs.append((entry.path, f"{entry_relative}/"))
+        elif entry.is_file(follow_symlinks=False) and rules.included(entry.name, entry_relative):
+          files.append((entry.path, entry.stat(follow_symlinks=False)))
+  except OSError as e:
+    return files, subdirs, f"{directory}: {e.strerror}"
+  return files, subdirs, None
+
+
+def walk(roots: Iterable[Path], rules: ScanRules, skip: Iterable[Path] = (), workers: int | None = None,
+         errors: list[str] | None = None) -> Iterator[tuple[str, os.stat_result]]:
+  """Yield ``(path, stat)`` of every regular file under `roots` matching `rules`, in no particular order.
+
+  Symlinks are not followed and paths in `skip` are left out.  Unreadable directories are appended to `errors`.
+  """
+  skip = frozenset(str(Path(path).absolute()) for path in skip)
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    pending: set[Future] = {pool.submit(_scan_dir, str(Path(root).absolute()), "", rules, skip)
+                            for root in dict.fromkeys(roots) if Path(root).is_dir()}
+    while pending:
+      done, pending = wait(pending, return_when=FIRST_COMPLETED)
+      for future in done:
+        files, subdirs, error = future.result()
+        if error is not None and errors is not None:
+          errors.append(error)
+        pending.update(pool.submit(_scan_dir, path, relative, rules, skip) for path, relative in subdirs)
+        yield from files
+
+
+def _load_raw_index(store: KeyValueStore, roots: Iterable[Path]) -> dict[str, str]:
+  index: dict[str, str] = {}
+  for root in dict.fromkeys(roots):
+    prefix = f"{INDEX_PREFIX}{Path(root).absolute()}/"
+    index.update((key[len(INDEX_PREFIX):], value) for key, value in store.range(prefix, _prefix_upper_bound(prefix)))
+  return index
+
+
+def load_index(store: KeyValueStore, roots: Iterable[Path]) -> dict[str, IndexRecord]:
+  """Index records of the files under `roots`, keyed by path."""
+  return {path: IndexRecord.loads(value) for path, value in _load_raw_index(store, roots).items()}
+
+
+def _hash(item: tuple[str, os.stat_result]) -> tuple[str, IndexRecord | None]:
+  path, stat = item
+  try:
+    return path, IndexRecord(inode=stat.st_ino, size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+                             sha256=file_sha256(Path(path)))
+  except OSError:
+    # Deleted or made unreadable between the scan and now, picked up by the next run
+    return path, None
+
+
+@profiling.traced("discover")
+def discover(store: KeyValueStore, roots: Iterable[Path] | None = None, rules: ScanRules | None = None,
+             skip: Iterable[Path] = (), workers: int | None = None) -> Discovery:
+  """Compare the files under `roots` (`default_roots`) with the stat index in `store`, nothing is written to it."""
+  start = time.perf_counter()
+  roots = default_roots() if roots is None else list(roots)
+  rules = ScanRules() if rules is None else rules
+  index: dict[str, str] = _load_raw_index(store, roots)
+  discovery = Discovery()
+
+  stale: list[tuple[str, os.stat_result]] = []
+  seen: set[str] = set()
+  for path, stat in walk(roots, rules, skip=skip, workers=workers, errors=discovery.errors):
+    discovery.scanned += 1
+    seen.add(path)
+    if (value := index.get(path)) is None or not value.startswith(_stat_key(stat.st_ino, stat.st_size, stat.st_mtime_ns)):
+      stale.append((path, stat))
+
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    for path, record in pool.map(_hash, stale):
+      if record is None:
+        continue
+      discovery.hashed += 1
+      discovery.updates[path] = record
+      if (value := index.get(path)) is None or IndexRecord.loads(value).sha256 != record.sha256:
+        discovery.changed.append(path)
+
+  discovery.changed.sort()
+  discovery.removed = sorted(set(index) - seen)
+  profiling.count("discover.files", discovery.scanned)
+  profiling.count("discover.hashed", discovery.hashed)
+  discovery.seconds = time.perf_counter() - start
+  return discovery
+
+
+def commit_index(store: KeyValueStore, discovery: Discovery) -> None:
+  """Record `discovery` in the stat index, once its changed files are packed."""
+  if not (discovery.updates or discovery.removed):
+    return
+  with store.transaction():
+    store.set_many((f"{INDEX_PREFIX}{path}", record.dumps()) for path, record in discovery.updates.items())
+    for path in discovery.removed:
+      del store[f"{INDEX_PREFIX}{path}"]
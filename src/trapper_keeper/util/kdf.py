@@ -0,0 +1,133 @@
+"""Argon2 key derivation settings of a vault.
+
+Every open and every save of a vault runs its KDF, so these settings decide the unlock latency of every command.
+`calibrate` picks them per machine: one Argon2 lane per core, then as much memory and as many passes as fit in a
+target time, so a vault opens in about the same time on a small CI runner as on a large build host.
+"""
+
+import contextlib
+import os
+import secrets
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+from argon2.low_level import Type, hash_secret_raw
+from pykeepass.pykeepass import PyKeePass
+
+DEFAULT_TARGET_SECONDS: float = 1.0
+# Bounds of the memory `calibrate` settles on: below the floor a vault is cheap to attack whatever the machine, above the
+# ceiling it could not be opened on the smaller machines the vault is unpacked on
+MIN_MEMORY_KIB: int = 8 * 1024
+MAX_MEMORY_KIB: int = 1024 * 1024
+# Share of the machine's (or container's) memory a single unlock may take
+MEMORY_SHARE: int = 4
+CGROUP_MEMORY_MAX: Path = Path("/sys/fs/cgroup/memory.max")
+
+
+def available_cores() -> int:
+  """Cores this process may be scheduled on, which is less than `os.cpu_count` under taskset or a cgroup cpuset."""
+  with_affinity = getattr(os, "sched_getaffinity", None)
+  return len(with_affinity(0)) if with_affinity is not None else os.cpu_count() or 1
+
+
+def available_memory_kib() -> int | None:
+  """Physical memory, or the cgroup limit of the container when that is lower, None when neither can be told."""
+  limits: list[int] = []
+  with contextlib.suppress(AttributeError, ValueError, OSError):
+    limits.append(os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // 1024)
+  # Missing outside of cgroup v2, or "max" when unlimited
+  with contextlib.suppress(OSError, ValueError):
+    limits.append(int(CGROUP_MEMORY_MAX.read_text(encoding="ascii")) // 1024)
+  return min(limits, default=None)
+
+
+@dataclass(frozen=True)
+class KdfParameters:
+  """Argon2 cost parameters as stored in the KDBX4 header."""
+  iterations: int
+  memory_kib: int
+  parallelism: int
+
+  @staticmethod
+  def _header(kp_db: PyKeePass) -> dict:
+    if kp_db.version < (4, 0) or kp_db.kdf_algorithm not in ("argon2", "argon2id"):
+      raise ValueError(f"Only KDBX4 vaults with Argon2 are supported, not {kp_db.kdf_algorithm}")
+    return kp_db.kdbx.header.value.dynamic_header.kdf_parameters.data.dict
+
+  @classmethod
+  def of(cls, kp_db: PyKeePass) -> "KdfParameters":
+    """The settings `kp_db` is currently encrypted with."""
+    header = cls._header(kp_db)
+    return cls(iterations=header["I"].value, memory_kib=header["M"].value // 1024, parallelism=header["P"].value)
+
+  def apply(self, kp_db: PyKeePass) -> None:
+    """Use these settings from the next save of `kp_db` on."""
+    if min(asdict(self).values()) < 1:
+      raise ValueError(f"KDF parameters must be positive, got {self}")
+    header = self._header(kp_db)
+    header["I"].value = self.iterations
+    header["M"].value = self.memory_kib * 1024
+    header["P"].value = self.parallelism
+
+  def measure(self) -> float:
+    """Seconds one derivation with these settings takes on this machine, which is what every open and save pays."""
+    start = time.perf_counter()
+    hash_secret_raw(secret=secrets.token_bytes(32), salt=secrets.token_bytes(32), hash_len=32, type=Type.ID,
+                    time_cost=self.iterations, memory_cost=self.memory_kib, parallelism=self.parallelism)
+    return time.perf_counter() - start
+
+
+@dataclass(frozen=True)
+class Calibration:
+  """Settings `calibrate` chose, with what a derivation measured at them and how many derivations it ran."""
+  parameters: KdfParameters
+  seconds: float
+  target_seconds: float
+  trials: int
+
+
+def calibrate(target_seconds: float = DEFAULT_TARGET_SECONDS, max_memory_kib: int | None = None,
+              parallelism: int | None = None) -> Calibration:
+  """Strongest Argon2 settings whose derivation stays within `target_seconds` on this machine.
+
+  Args:
+      target_seconds: Time one derivation may take.
+      max_memory_kib: Memory ceiling, `MAX_MEMORY_KIB` or 1/`MEMORY_SHARE` of `available_memory_kib` if that is lower.
+      parallelism: Argon2 lanes, `available_cores` by default.
+
+  Memory is raised first, doubling it while a single pass still fits in the target, as memory is what makes guessing
+  expensive on GPUs.  The passes left in the budget then go to iterations, and the result is measured once more and
+  backed off should it overshoot.  A machine too slow for even `MIN_MEMORY_KIB` and one pass gets those, over target.
+  """
+  if target_seconds <= 0:
+    raise ValueError(f"Target time must be positive, got {target_seconds}")
+  lanes: int = parallelism or available_cores()
+  ceiling: int = max_memory_kib or MAX_MEMORY_KIB
+  if (memory := available_memory_kib()) is not None:
+    ceiling = min(ceiling, memory // MEMORY_SHARE)
+  # Argon2 needs at least 8 KiB per lane
+  ceiling = max(ceiling, MIN_MEMORY_KIB, 8 * lanes)
+
+  parameters = KdfParameters(iterations=1, memory_kib=max(MIN_MEMORY_KIB, 8 * lanes), parallelism=lanes)
+  seconds: float = parameters.measure()
+  trials: int = 1
+  while seconds * 2 <= target_seconds and parameters.memory_kib < ceiling:
+    larger = KdfParameters(iterations=1, memory_kib=min(parameters.memory_kib * 2, ceiling), parallelism=lanes)
+    larger_seconds: float = larger.measure()
+    trials += 1
+    if larger_seconds > target_seconds:
+      break
+    parameters, seconds = larger, larger_seconds
+
+  # Time grows linearly with the passes over memory
+  iterations: int = max(1, int(target_seconds / seconds))
+  while iterations > 1:
+    candidate = KdfParameters(iterations=iterations, memory_kib=parameters.memory_kib, parallelism=lanes)
+    candidate_seconds: float = candidate.measure()
+    trials += 1
+    if candidate_seconds <= target_seconds:
+      parameters, seconds = candidate, candidate_seconds
+      break
+    iterations = max(1, int(iterations * target_seconds / candidate_seconds))
+  return Calibration(parameters=parameters, seconds=seconds, target_seconds=target_seconds, trials=trials)
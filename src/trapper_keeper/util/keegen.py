@@ -2,14 +2,22 @@
 
 Methods from [fauxfactory](https://github.com/omaciel/fauxfactory/tree/master)
 """
-import random
+import functools
+import hashlib
+import os
+import secrets
+import time
+from array import array
 from collections import namedtuple
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
 
 import unicodedata
 
-from trapper_keeper.util.db_utils import KEEPASS_DB_KEY, KEEPASS_DB_TOKEN
+from trapper_keeper import xdg_cache_home
+from trapper_keeper.util.paths import KEEPASS_DB_KEY, KEEPASS_DB_TOKEN
 
 TOKEN_SIZE: int = 40
 KEY_SIZE: int = 190
@@ -18,6 +26,11 @@ UnicodePlane = namedtuple("UnicodePlane", ["min", "max"])
 BMP = UnicodePlane(int("0x0000", 16), int("0xffff", 16))
 SMP = UnicodePlane(int("0x10000", 16), int("0x1ffff", 16))
 
+# Bounds the size of each random integer in `random_indices`, splitting huge integers is quadratic
+_INDICES_PER_DRAW: int = 16
+# The on-disk letters table starts with the sha256 of the code points that follow
+_TABLE_DIGEST_SIZE: int = hashlib.sha256().digest_size
+
 def _read_secret(secret: Path | None = None):
   return secret.read_text(encoding="utf-8")
 
@@ -28,8 +41,10 @@ def _create_secret(secret: Path | None = None):
     return _read_secret(secret)
 
 def _write_secret(secret: tuple[Path, str]):
-  with open(file=secret[0], encoding="utf-8", mode="x"):
-    secret[0].write_text(secret[1])
+  # Private from the moment it exists, whatever the umask, and never over an existing file
+  fd = os.open(secret[0], os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+  with open(fd, encoding="utf-8", mode="w") as secret_file:
+    secret_file.write(secret[1])
 
 @dataclass
 class KeeAuth:
@@ -73,6 +88,64 @@ class KeeAuth:
   def items(self):
     return zip(self.__iter__(), self)
 
+  @classmethod
+  def batch(cls, destinations: Iterable[Path], smp: bool = True) -> list["KeeAuth"]:
+    """Mint a fresh token and key for every destination directory in one pass.
+
+    The files are named like the defaults (`KEEPASS_DB_TOKEN`, `KEEPASS_DB_KEY`) and nothing is written until
+    `save_batch`.
+    """
+    destinations = list(destinations)
+    tokens = gen_utf8_many(len(destinations), TOKEN_SIZE, smp)
+    keys = gen_utf8_many(len(destinations), KEY_SIZE, smp)
+    return [
+      cls(_kp_token=(destination / KEEPASS_DB_TOKEN.name, token), _kp_key=(destination / KEEPASS_DB_KEY.name, key))
+      for destination, token, key in zip(destinations, tokens, keys, strict=True)
+    ]
+
+
+@dataclass
+class BatchReport:
+  """Throughput of a `gen_credentials` run."""
+  count: int
+  files: int
+  gen_seconds: float
+  write_seconds: float
+
+  @property
+  def seconds(self) -> float:
+    return self.gen_seconds + self.write_seconds
+
+  @property
+  def per_second(self) -> float:
+    return self.count / self.seconds if self.seconds > 0 else float("inf")
+
+
+def save_batch(auths: Iterable[KeeAuth], workers: int | None = None) -> int:
+  """Write every secret of `auths` through a thread pool, returns the number of files written.
+
+  Like `KeeAuth.save`, existing files are never overwritten and raise `FileExistsError`.
+  """
+  secrets_to_write = [secret for auth in auths for secret in auth]
+  for parent in {secret[0].parent for secret in secrets_to_write}:
+    parent.mkdir(parents=True, exist_ok=True)
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    # list() surfaces the first failed write
+    list(pool.map(_write_secret, secrets_to_write))
+  return len(secrets_to_write)
+
+
+def gen_credentials(count: int, dest: Path, workers: int | None = None, smp: bool = True) -> tuple[list[KeeAuth], BatchReport]:
+  """Generate and save `count` token/key pairs under numbered subdirectories of `dest`."""
+  width = len(str(max(count - 1, 0)))
+  start = time.perf_counter()
+  auths = KeeAuth.batch((dest / f"{i:0{width}d}" for i in range(count)), smp=smp)
+  generated = time.perf_counter()
+  files = save_batch(auths, workers=workers)
+  return auths, BatchReport(count=count, files=files, gen_seconds=generated - start,
+                            write_seconds=time.perf_counter() - generated)
+
+
 def gen_utf8(length=TOKEN_SIZE, smp=True, start=None, separator=""):
     """Return a random string made up of UTF-8 letters characters.
 
@@ -89,8 +162,8 @@ def gen_utf8(length=TOKEN_SIZE, smp=True, start=None, separator=""):
     .. _`RFC 3629`: http://www.rfc-editor.org/rfc/rfc3629.txt
 
     """
-    unicode_letters = list(unicode_letters_generator(smp))
-    output_string = "".join(random.choices(unicode_letters, k=length))
+    unicode_letters: array = unicode_letters_table(smp)
+    output_string = "".join(map(chr, map(unicode_letters.__getitem__, random_indices(len(unicode_letters), length))))
 
     if start:
         output_string = f"{start}{separator}{output_string}"[0:length]
@@ -109,3 +182,90 @@ def unicode_letters_generator(smp=True):
         char = chr(i)
         if unicodedata.category(char).startswith("L"):
             yield char
+
+
+def gen_utf8_many(count, length=TOKEN_SIZE, smp=True):
+    """Return `count` random strings of `length` UTF-8 letters, see `gen_utf8`.
+
+    The indices for every string are sampled in one call and mapped through the letter table in bulk.
+
+    :param int count: Number of strings.
+    :param int length: Length of every string.
+    :param bool smp: Include Supplementary Multilingual Plane (SMP)
+        characters
+    :returns: a list of ``count`` strings
+
+    """
+    if length <= 0:
+        return [""] * count
+    unicode_letters: array = unicode_letters_table(smp)
+    chars = "".join(map(chr, map(unicode_letters.__getitem__, random_indices(len(unicode_letters), count * length))))
+    return [chars[i:i + length] for i in range(0, count * length, length)]
+
+
+def random_indices(population: int, k: int) -> list[int]:
+    """Return `k` uniformly distributed indices below `population`.
+
+    Each `secrets.randbits` draw is split into up to `_INDICES_PER_DRAW` base-`population` digits instead of asking the
+    CSPRNG once per index.  The 64 surplus bits per draw keep the modulo bias of the digits below 2**-64.
+
+    :param int population: Exclusive upper bound of every index
+    :param int k: Number of indices
+    :returns: a list of ``k`` indices
+
+    """
+    indices = []
+    while (remaining := k - len(indices)) > 0:
+        draw = min(remaining, _INDICES_PER_DRAW)
+        value = secrets.randbits(draw * population.bit_length() + 64)
+        for _ in range(draw):
+            value, index = divmod(value, population)
+            indices.append(index)
+    return indices
+
+
+def _letters_table_path(smp: bool) -> Path:
+    plane = "smp" if smp else "bmp"
+    return Path(xdg_cache_home(), "trapper_keeper", f"unicode_letters-{unicodedata.unidata_version}-{plane}.bin")
+
+
+@functools.cache
+def unicode_letters_table(smp=True, persist=True):
+    """Return every unicode letter as an array of code points, built once per process.
+
+    The table depends only on the unicode database shipped with the interpreter, so it is also kept under
+    ``xdg_cache_home()`` keyed by `unicodedata.unidata_version` and read back on later runs instead of walking all
+    planes again.  The copy is prefixed with the sha256 of the table and rebuilt when it does not match.
+
+    :param bool smp: Include Supplementary Multilingual Plane (SMP)
+        characters
+    :param bool persist: Read and write the on-disk copy of the table
+    :return: an ``array('I')`` of code points
+
+    """
+    table_fp = _letters_table_path(smp)
+    if persist:
+        table = array("I")
+        try:
+            content = table_fp.read_bytes()
+            digest, body = content[:_TABLE_DIGEST_SIZE], content[_TABLE_DIGEST_SIZE:]
+            # a truncated or otherwise damaged copy would bias every key generated from it, rebuild it instead
+            if body and hashlib.sha256(body).digest() == digest:
+                table.frombytes(body)
+        except (OSError, ValueError):
+            table = array("I")
+        if len(table) > 0:
+            return table
+
+    table = array("I", (ord(char) for char in unicode_letters_generator(smp)))
+    if persist:
+        try:
+            table_fp.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            tmp_fp = table_fp.with_name(f"{table_fp.name}.{os.getpid()}.tmp")
+            body = table.tobytes()
+            tmp_fp.write_bytes(hashlib.sha256(body).digest() + body)
+            tmp_fp.replace(table_fp)
+        except OSError:
+            # the cache is an optimization only, a read-only home must not break key generation
+            pass
+    return table
@@ -0,0 +1,97 @@
+"""Content-hash manifest of the artifacts packed into a vault.
+
+Each packed file is recorded with its size, mtime and sha256.  A repack only hashes files whose size or mtime moved and
+only re-attaches files whose hash moved, so an unchanged artifact set never reaches `PyKeePass.save`.
+"""
+
+import hashlib
+import json
+import os
+import stat as stat_module
+from dataclasses import asdict, dataclass, replace
+from pathlib import Path
+
+from pykeepass.group import Entry, Group
+from pykeepass.pykeepass import PyKeePass
+
+from trapper_keeper.util import profiling
+from trapper_keeper.util.vault_index import VaultIndex
+
+MANIFEST_TITLE: str = "Manifest"
+MANIFEST_VERSION: int = 1
+
+
+def file_sha256(path: Path) -> str:
+  with profiling.span("hash.sha256"), open(path, mode="rb") as artifact:
+    digest: str = hashlib.file_digest(artifact, "sha256").hexdigest()
+    profiling.count("hash.bytes", artifact.tell())
+  return digest
+
+
+@dataclass(frozen=True)
+class ArtifactRecord:
+  """What a packed artifact looked like when it was attached.
+
+  Permission bits and ownership are None for records written before they were tracked and for the Key/Value store.
+  """
+  path: str
+  size: int
+  mtime_ns: int
+  sha256: str
+  mode: int | None = None
+  uid: int | None = None
+  gid: int | None = None
+
+  @classmethod
+  def read(cls, path: Path, previous: "ArtifactRecord | None" = None) -> "tuple[ArtifactRecord, bytes | None]":
+    """Describe `path` along with its bytes, so the record is of exactly the bytes that get stored.
+
+    When size and mtime are unchanged since `previous` its hash is reused and the bytes are not read, None is returned
+    in their place.
+    """
+    with open(path, mode="rb") as artifact:
+      stat = os.fstat(artifact.fileno())
+      owner = {"mode": stat_module.S_IMODE(stat.st_mode), "uid": stat.st_uid, "gid": stat.st_gid}
+      if previous is not None and previous.size == stat.st_size and previous.mtime_ns == stat.st_mtime_ns:
+        return (previous if previous.owner == owner else replace(previous, **owner)), None
+      data: bytes = artifact.read()
+    with profiling.span("hash.sha256"):
+      digest: str = hashlib.sha256(data).hexdigest()
+    profiling.count("hash.bytes", len(data))
+    return cls(path=str(path), size=len(data), mtime_ns=stat.st_mtime_ns, sha256=digest, **owner), data
+
+  @property
+  def owner(self) -> dict[str, int | None]:
+    """Permission bits and ownership, which a pack records even when the content is unchanged."""
+    return {"mode": self.mode, "uid": self.uid, "gid": self.gid}
+
+  def owner_changed(self, previous: "ArtifactRecord | None") -> bool:
+    return previous is not None and previous.mode is not None and previous.owner != self.owner
+
+
+class Manifest(dict[str, ArtifactRecord]):
+  """Artifact records keyed by path, kept as JSON in the notes of the `MANIFEST_TITLE` entry."""
+
+  @classmethod
+  def loads(cls, text: str | None) -> "Manifest":
+    manifest = cls()
+    if text:
+      for record in json.loads(text).get("artifacts", []):
+        manifest[record["path"]] = ArtifactRecord(**record)
+    return manifest
+
+  def dumps(self) -> str:
+    return json.dumps({"version": MANIFEST_VERSION, "artifacts": [asdict(record) for record in self.values()]},
+                      separators=(",", ":"))
+
+  @classmethod
+  def load(cls, kp_db: PyKeePass, group: Group) -> "Manifest":
+    entry: Entry | None = VaultIndex.of(kp_db).entry(MANIFEST_TITLE, group)
+    return cls.loads(None if entry is None else entry.notes)
+
+  def store(self, kp_db: PyKeePass, group: Group) -> None:
+    index: VaultIndex = VaultIndex.of(kp_db)
+    entry: Entry | None = index.entry(MANIFEST_TITLE, group)
+    if entry is None:
+      entry = index.add_entry(group, MANIFEST_TITLE)
+    entry.notes = self.dumps()
@@ -0,0 +1,14 @@
+"""Default locations of the vault, its secrets and the Key/Value store.
+
+Kept free of any backend import so that the CLI and `keegen` can use them without loading pykeepass, sqlite or
+BoltDB.
+"""
+
+from pathlib import Path
+
+from trapper_keeper import xdg_cache_home, xdg_config_home, xdg_data_home, xdg_state_home
+
+KV_STORE: Path = Path(xdg_cache_home(), "trapper_keeper/kv_store.sqlite")
+KEEPASS_DB_PATH: Path = Path.joinpath(xdg_data_home(), "trapper_keeper/secrets.kdbx")
+KEEPASS_DB_KEY: Path = Path.joinpath(xdg_config_home(), "trapper_keeper/secrets.keyx")
+KEEPASS_DB_TOKEN: Path = Path.joinpath(xdg_state_home(), "trapper_keeper/secrets_token")
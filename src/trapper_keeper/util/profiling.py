@@ -0,0 +1,217 @@
+"""Timing spans and counters for finding out where a command spends its time.
+
+Code is instrumented with `span` blocks and `count` calls.  While no `Profiler` is active both return after a single
+global lookup, so the instrumentation stays in place in production.  An active profiler records every span with its
+thread and attributes, sums counters, and can render the result as a text breakdown or as a Chrome trace (load it in
+``chrome://tracing`` or https://ui.perfetto.dev).
+
+The vault's own cost centres live inside pykeepass, so while profiling the profiler also wraps the library's Argon2 KDF,
+payload cipher, gzip, XML (de)serialization and protected value stream, and restores them when it stops.
+"""
+
+import contextlib
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass, field
+from pathlib import Path
+
+_profiler: "Profiler | None" = None
+
+
+@dataclass
+class SpanRecord:
+  name: str
+  start_ns: int
+  duration_ns: int
+  thread_id: int
+  attrs: dict = field(default_factory=dict)
+
+
+class Profiler:
+  """Collects spans and counters while it is the active profiler, see `profiling`."""
+
+  def __init__(self):
+    self.spans: list[SpanRecord] = []
+    self.counters: dict[str, int] = defaultdict(int)
+    self.started_ns: int = time.perf_counter_ns()
+    self._lock = threading.Lock()
+    self._restore: list[Callable[[], None]] = []
+
+  @contextlib.contextmanager
+  def span(self, name: str, **attrs) -> Iterator[dict]:
+    """Time the block, attributes may be added to the yielded dict from inside it."""
+    start: int = time.perf_counter_ns()
+    try:
+      yield attrs
+    finally:
+      record = SpanRecord(name, start, time.perf_counter_ns() - start, threading.get_ident(), attrs)
+      with self._lock:
+        self.spans.append(record)
+
+  def count(self, name: str, amount: int = 1) -> None:
+    with self._lock:
+      self.counters[name] += amount
+
+  def summary(self) -> dict[str, dict[str, float]]:
+    """Calls, total and max seconds per span name, slowest first.
+
+    Spans nest, so the totals of a span and of the spans inside it overlap.
+    """
+    totals: dict[str, list[int]] = defaultdict(lambda: [0, 0, 0])
+    for record in self.spans:
+      total = totals[record.name]
+      total[0] += 1
+      total[1] += record.duration_ns
+      total[2] = max(total[2], record.duration_ns)
+    return {name: {"calls": calls, "seconds": total / 1e9, "max_seconds": longest / 1e9}
+            for name, (calls, total, longest) in sorted(totals.items(), key=lambda item: -item[1][1])}
+
+  def report(self) -> str:
+    """Human readable breakdown of `summary` and the counters."""
+    elapsed: float = (time.perf_counter_ns() - self.started_ns) / 1e9
+    lines: list[str] = [f"{'span':<32} {'calls':>7} {'total s':>10} {'max s':>10} {'%':>6}"]
+    for name, row in self.summary().items():
+      share = 100 * row["seconds"] / elapsed if elapsed else 0.0
+      lines.append(f"{name:<32} {row['calls']:>7} {row['seconds']:>10.4f} {row['max_seconds']:>10.4f} {share:>6.1f}")
+    lines.append(f"{'wall clock':<32} {'':>7} {elapsed:>10.4f}")
+    if self.counters:
+      lines.append("")
+      lines.extend(f"{name:<32} {value:>18,}" for name, value in sorted(self.counters.items()))
+    return "\n".join(lines)
+
+  def chrome_trace(self) -> dict:
+    """Spans as complete ("X") events of the Trace Event Format, counters and summary in ``otherData``."""
+    pid: int = os.getpid()
+    events = [{
+      "name": record.name,
+      "cat": record.name.split(".", 1)[0],
+      "ph": "X",
+      "ts": (record.start_ns - self.started_ns) / 1000,
+      "dur": record.duration_ns / 1000,
+      "pid": pid,
+      "tid": record.thread_id,
+      "args": record.attrs,
+    } for record in self.spans]
+    return {"traceEvents": events, "displayTimeUnit": "ms",
+            "otherData": {"counters": dict(self.counters), "summary": self.summary()}}
+
+  def write(self, path: Path) -> None:
+    path.write_text(json.dumps(self.chrome_trace(), default=str), encoding="utf-8")
+
+  def _wrap(self, owner: object, attr: str, name: str) -> None:
+    original = getattr(owner, attr, None)
+    if original is None:
+      # A pykeepass release without this stage, its time shows up in the enclosing span instead
+      return
+
+    @functools.wraps(original)
+    def wrapper(*args, **kwargs):
+      with self.span(name):
+        return original(*args, **kwargs)
+
+    setattr(owner, attr, wrapper)
+    self._restore.append(lambda: setattr(owner, attr, original))
+
+  def install_probes(self) -> None:
+    """Wrap the stages pykeepass runs on every open and save in spans."""
+    import argon2.low_level
+    from pykeepass.kdbx_parsing import common
+
+    self._wrap(argon2.low_level, "hash_secret_raw", "kdf.argon2")
+    self._wrap(common.DecryptedPayload, "_decode", "crypto.decrypt")
+    self._wrap(common.DecryptedPayload, "_encode", "crypto.encrypt")
+    self._wrap(common.Decompressed, "_decode", "gzip.decompress")
+    self._wrap(common.Decompressed, "_encode", "gzip.compress")
+    self._wrap(common.XML, "_decode", "xml.parse")
+    self._wrap(common.XML, "_encode", "xml.serialize")
+    self._wrap(common.UnprotectedStream, "_decode", "xml.unprotect")
+    self._wrap(common.UnprotectedStream, "_encode", "xml.protect")
+
+  def remove_probes(self) -> None:
+    while self._restore:
+      self._restore.pop()()
+
+
+def active() -> "Profiler | None":
+  return _profiler
+
+
+def enabled() -> bool:
+  return _profiler is not None
+
+
+def span(name: str, **attrs) -> contextlib.AbstractContextManager[dict]:
+  """Time the block under `name` when profiling, a shared no-op context otherwise."""
+  if _profiler is None:
+    return _NULL_SPAN
+  return _profiler.span(name, **attrs)
+
+
+def count(name: str, amount: int = 1) -> None:
+  """Add `amount` to counter `name` when profiling."""
+  if _profiler is not None:
+    _profiler.count(name, amount)
+
+
+def traced(name: str) -> Callable[[Callable], Callable]:
+  """Decorator running the function inside `span(name)`."""
+  def decorator(func: Callable) -> Callable:
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      if _profiler is None:
+        return func(*args, **kwargs)
+      with _profiler.span(name):
+        return func(*args, **kwargs)
+    return wrapper
+  return decorator
+
+
+@contextlib.contextmanager
+def profiling(probes: bool = True, cprofile: Path | None = None) -> Iterator[Profiler]:
+  """Activate a fresh `Profiler` for the block, optionally with pykeepass probes and a cProfile dump to `cprofile`."""
+  global _profiler
+  if _profiler is not None:
+    raise RuntimeError("A profiler is already active")
+  profiler = Profiler()
+  if probes:
+    profiler.install_probes()
+  _profiler = profiler
+  profile = cProfile.Profile() if cprofile is not None else None
+  try:
+    if profile is not None:
+      profile.enable()
+    yield profiler
+  finally:
+    if profile is not None:
+      profile.disable()
+      profile.dump_stats(cprofile)
+    _profiler = None
+    profiler.remove_probes()
+
+
+class _Discard(dict):
+  """Attributes set on a span while profiling is off go nowhere."""
+
+  def __setitem__(self, key, value):
+    pass
+
+
+class _NullSpan(contextlib.AbstractContextManager):
+  """Reusable no-op span, `span` must not allocate while profiling is off."""
+  __slots__ = ()
+
+  def __enter__(self) -> dict:
+    return _DISCARD
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    return None
+
+
+_DISCARD = _Discard()
+_NULL_SPAN = _NullSpan()
@@ -0,0 +1,64 @@
+"""Deferred-write session over an unlocked vault.
+
+Every `PyKeePass.save` re-serializes the whole XML tree, runs the KDF on a fresh salt and re-encrypts the database, so
+callers mutate the vault through a `VaultSession` and pay for one save when the session is flushed or closed rather
+than one per step.
+"""
+
+import os
+import time
+from dataclasses import dataclass
+
+from pykeepass.pykeepass import PyKeePass
+
+from trapper_keeper.util import profiling
+from trapper_keeper.util.vault_index import VaultIndex
+
+
+@dataclass
+class SaveStats:
+  """How often a session wrote its vault and how long that took."""
+  saves: int = 0
+  seconds: float = 0.0
+  last_seconds: float = 0.0
+
+
+class VaultSession:
+  """Collects mutations of `kp_db` and writes them with a single save.
+
+  Used as a context manager the session flushes on a clean exit and discards pending changes when the block raises,
+  leaving the file on disk as it was.
+  """
+
+  def __init__(self, kp_db: PyKeePass, dirty: bool = False):
+    self.kp_db = kp_db
+    self.dirty = dirty
+    self.stats = SaveStats()
+
+  def mark_dirty(self) -> None:
+    """Record that `kp_db` changed and has to be saved by the next `flush`."""
+    self.dirty = True
+
+  def flush(self, force: bool = False) -> bool:
+    """Save the vault if anything changed since the last flush, returns whether it was written."""
+    if not (self.dirty or force):
+      return False
+    start = time.perf_counter()
+    with profiling.span("kdbx.save", filename=str(self.kp_db.filename)):
+      self.kp_db.save()
+    VaultIndex.vault_saved(self.kp_db)
+    self.stats.last_seconds = time.perf_counter() - start
+    if profiling.enabled():
+      profiling.count("kdbx.saves")
+      profiling.count("kdbx.bytes_written", os.stat(self.kp_db.filename).st_size)
+    self.stats.seconds += self.stats.last_seconds
+    self.stats.saves += 1
+    self.dirty = False
+    return True
+
+  def __enter__(self) -> "VaultSession":
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    if exc_type is None:
+      self.flush()
@@ -0,0 +1,281 @@
+"""Constant time lookups of groups, entries and attachments in an open vault.
+
+`PyKeePass.find_*` compile every query to an XPath expression that scans the whole XML tree, so resolving the special
+binaries group, an entry or an attachment gets slower as the vault grows.  `VaultIndex.of` walks the tree once per
+opened vault and maps group paths, entry titles, entry UUIDs and attachment filenames to their elements.  Mutations made
+through the index keep it current; a hit whose element was changed behind its back is detected and the index rebuilt.
+
+An index can also be persisted to ``<vault>.idx`` (see `VaultIndex.persist`).  Once that file exists it is loaded on
+open instead of walking the tree, as long as it was written for exactly the vault file on disk (same sha256), and it is
+rewritten after every save.  Lookup keys are stored as HMACs under a random key kept inside the encrypted vault, so the
+file does not disclose entry titles or the paths of packed artifacts.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import secrets
+import uuid
+import weakref
+from collections.abc import Iterator
+from pathlib import Path
+
+from lxml.builder import E
+from pykeepass.attachment import Attachment
+from pykeepass.entry import Entry
+from pykeepass.group import Group
+from pykeepass.pykeepass import PyKeePass
+
+from trapper_keeper.util import profiling
+from trapper_keeper.util.atomic import atomic_write
+
+INDEX_SUFFIX: str = ".idx"
+INDEX_VERSION: int = 1
+# Meta/CustomData item of the vault holding the HMAC key of its persisted index
+INDEX_KEY_ITEM: str = "trapper_keeper.index_key"
+
+GROUP, ENTRY, TITLE, UUID, ATTACHMENT = "group", "entry", "title", "uuid", "attachment"
+
+# Slot of an attachment that was deleted while another entry may still hold one of the same filename
+_RESCAN = object()
+
+_indexes: "weakref.WeakKeyDictionary[PyKeePass, VaultIndex]" = weakref.WeakKeyDictionary()
+
+
+def index_path(kp_fp: Path) -> Path:
+  return Path(kp_fp).with_name(f"{Path(kp_fp).name}{INDEX_SUFFIX}")
+
+
+def _sha256(path: Path) -> str:
+  with open(path, mode="rb") as vault:
+    return hashlib.file_digest(vault, "sha256").hexdigest()
+
+
+def _entry_title(element) -> str | None:
+  return element.findtext("String[Key='Title']/Value")
+
+
+def _entry_uuid(element) -> uuid.UUID:
+  return uuid.UUID(bytes=base64.b64decode(element.findtext("UUID")))
+
+
+def _walk(kp_db: PyKeePass) -> Iterator[tuple[str, str, object, list[int]]]:
+  """Yield ``(kind, name, element, position)`` for everything indexed, in document order.
+
+  `position` holds the child indices leading from the document root to the element.  History entries are skipped,
+  lookups only ever resolve the current version of an entry.
+  """
+  root = kp_db.tree.getroot()
+  root_group = root.find("Root/Group")
+  stack: list[tuple[object, tuple[str, ...], list[int]]] = [
+    (root_group, (), [root.index(root_group.getparent()), root_group.getparent().index(root_group)])]
+  while stack:
+    group, path, position = stack.pop()
+    subgroups = []
+    for i, child in enumerate(group):
+      if child.tag == "Group":
+        subgroup_path = (*path, child.findtext("Name") or "")
+        yield GROUP, "/".join(subgroup_path), child, [*position, i]
+        subgroups.append((child, subgroup_path, [*position, i]))
+      elif child.tag == "Entry":
+        entry_position = [*position, i]
+        title = _entry_title(child) or ""
+        yield UUID, str(_entry_uuid(child)), child, entry_position
+        yield ENTRY, f"{'/'.join(path)}\0{title}", child, entry_position
+        yield TITLE, title, child, entry_position
+        for j, attachment in enumerate(child):
+          if attachment.tag == "Binary":
+            yield ATTACHMENT, attachment.findtext("Key") or "", attachment, [*entry_position, j]
+    # Reversed so that groups pop in document order and the first match of a title or filename wins
+    stack.extend(reversed(subgroups))
+
+
+class VaultIndex:
+  """Lookup tables of one open vault, get the shared instance with `of`."""
+
+  def __init__(self, kp_db: PyKeePass, secret: bytes | None = None, slots: dict | None = None, persistent: bool = False):
+    self.kp_db = kp_db
+    # Slots are plain ``(kind, name)`` tuples, or HMACs of them for an index that is persisted.  Values are elements,
+    # or the positions of a loaded index until they are first looked up
+    self._secret = secret
+    self._slots: dict = {}
+    self.persistent = persistent
+    if slots is None:
+      self.rebuild()
+    else:
+      self._slots.update(slots)
+
+  @classmethod
+  def of(cls, kp_db: PyKeePass) -> "VaultIndex":
+    """The index of `kp_db`, loaded from its ``.idx`` file or built on first use."""
+    index: VaultIndex | None = _indexes.get(kp_db)
+    if index is None:
+      index = cls.load(kp_db) or cls(kp_db)
+      _indexes[kp_db] = index
+    return index
+
+  @staticmethod
+  def vault_saved(kp_db: PyKeePass) -> None:
+    """Called once `kp_db` was saved, keeps a persisted index in step with the file."""
+    if (index := _indexes.get(kp_db)) is not None:
+      index.saved()
+
+  @staticmethod
+  def discard(kp_db: PyKeePass) -> None:
+    """Forget the index of `kp_db`, e.g. after it was changed outside of the index."""
+    _indexes.pop(kp_db, None)
+
+  def _slot(self, kind: str, name: str):
+    if self._secret is None:
+      return kind, name
+    return hmac.digest(self._secret, f"{kind}\0{name}".encode(), "sha256")[:16]
+
+  @profiling.traced("index.build")
+  def rebuild(self) -> None:
+    self._slots.clear()
+    for kind, name, element, _ in _walk(self.kp_db):
+      self._slots.setdefault(self._slot(kind, name), element)
+
+  def _lookup(self, kind: str, name: str, check) -> object | None:
+    """Element of `name`, resolving a persisted position on first use.
+
+    `check` tells whether the element still carries `name`, a stale hit rebuilds the index once.
+    """
+    slot = self._slot(kind, name)
+    for attempt in range(2):
+      element = self._slots.get(slot)
+      if element is _RESCAN:
+        attachment: Attachment | None = self.kp_db.find_attachments(filename=name, first=True)
+        element = None if attachment is None else attachment._element
+        if element is None:
+          del self._slots[slot]
+        else:
+          self._slots[slot] = element
+      if isinstance(element, list):
+        element = self._resolve(element)
+        self._slots[slot] = element
+      if element is None or (element.getparent() is not None and check(element)):
+        return element
+      if attempt == 0:
+        self.rebuild()
+    return None
+
+  def _resolve(self, position: list[int]) -> object | None:
+    element = self.kp_db.tree.getroot()
+    for i in position:
+      if i >= len(element):
+        return None
+      element = element[i]
+    return element
+
+  def group(self, path: str | tuple[str, ...]) -> Group | None:
+    """Group by its names from the root group down, a single name for a group right under the root."""
+    path = path if isinstance(path, str) else "/".join(path)
+    element = self._lookup(GROUP, path, lambda el: el.tag == "Group" and el.findtext("Name") == path.rsplit("/", 1)[-1])
+    return None if element is None else Group(element=element, kp=self.kp_db)
+
+  def entry(self, title: str, group: Group | None = None) -> Entry | None:
+    """Entry by title, directly inside `group` or anywhere in the vault (first in document order)."""
+    if group is None:
+      element = self._lookup(TITLE, title, lambda el: el.tag == "Entry" and _entry_title(el) == title)
+    else:
+      group_path = "/".join(group.path)
+      element = self._lookup(ENTRY, f"{group_path}\0{title}", lambda el: (
+        el.tag == "Entry" and _entry_title(el) == title and el.getparent() == group._element))
+    return None if element is None else Entry(element=element, kp=self.kp_db)
+
+  def entry_by_uuid(self, entry_uuid: uuid.UUID) -> Entry | None:
+    element = self._lookup(UUID, str(entry_uuid), lambda el: el.tag == "Entry" and _entry_uuid(el) == entry_uuid)
+    return None if element is None else Entry(element=element, kp=self.kp_db)
+
+  def attachment(self, filename: str, entry: Entry | None = None) -> Attachment | None:
+    """Attachment by filename, of `entry` or of any entry (first in document order)."""
+    element = self._lookup(ATTACHMENT, filename, lambda el: el.tag == "Binary" and el.findtext("Key") == filename)
+    if entry is not None and element is not None and element.getparent() != entry._element:
+      # The same filename on another entry, rare enough for a scan of this entry's attachments
+      return next((attachment for attachment in entry.attachments if attachment.filename == filename), None)
+    return None if element is None else Attachment(element=element, kp=self.kp_db)
+
+  def add_group(self, parent: Group, name: str, **kwargs) -> Group:
+    group: Group = self.kp_db.add_group(destination_group=parent, group_name=name, **kwargs)
+    self._slots.setdefault(self._slot(GROUP, "/".join(group.path)), group._element)
+    return group
+
+  def add_entry(self, group: Group, title: str, **kwargs) -> Entry:
+    kwargs = {"username": "", "password": "", **kwargs}
+    entry: Entry = self.kp_db.add_entry(destination_group=group, title=title, **kwargs)
+    self._slots.setdefault(self._slot(UUID, str(entry.uuid)), entry._element)
+    self._slots.setdefault(self._slot(ENTRY, f"{'/'.join(group.path)}\0{title}"), entry._element)
+    self._slots.setdefault(self._slot(TITLE, title), entry._element)
+    return entry
+
+  def add_attachment(self, entry: Entry, binary_id: int, filename: str) -> Attachment:
+    attachment: Attachment = entry.add_attachment(id=binary_id, filename=filename)
+    slot = self._slot(ATTACHMENT, filename)
+    if self._slots.get(slot, _RESCAN) is _RESCAN:
+      self._slots[slot] = attachment._element
+    return attachment
+
+  def delete_attachment(self, attachment: Attachment) -> None:
+    slot = self._slot(ATTACHMENT, attachment.filename)
+    indexed = self._slots.get(slot)
+    attachment.delete()
+    if indexed is attachment._element or isinstance(indexed, list):
+      # Another entry may hold the same filename, the next lookup searches for it unless it is attached again first
+      self._slots[slot] = _RESCAN
+
+  @staticmethod
+  def _vault_secret(kp_db: PyKeePass) -> bytes | None:
+    value: str | None = kp_db.tree.getroot().findtext(f"Meta/CustomData/Item[Key='{INDEX_KEY_ITEM}']/Value")
+    return None if value is None else base64.b64decode(value)
+
+  @classmethod
+  def load(cls, kp_db: PyKeePass) -> "VaultIndex | None":
+    """The persisted index of `kp_db`, or None when there is none or it was written for another version of the file."""
+    path: Path = index_path(kp_db.filename)
+    if not path.is_file() or (secret := cls._vault_secret(kp_db)) is None:
+      return None
+    with profiling.span("index.load"):
+      try:
+        document = json.loads(path.read_text(encoding="utf-8"))
+      except ValueError:
+        return None
+      if document.get("version") != INDEX_VERSION or document.get("sha256") != _sha256(kp_db.filename):
+        return None
+      slots = {bytes.fromhex(slot): position for slot, position in document["slots"].items()}
+    return cls(kp_db, secret=secret, slots=slots, persistent=True)
+
+  def persist(self) -> bool:
+    """Keep this index in ``<vault>.idx`` from now on, returns whether the vault changed and has to be saved.
+
+    The HMAC key is stored in the vault, so a vault without one gets a new key and the index file is only written by
+    the `saved` that follows its save.
+    """
+    added: bool = False
+    if (secret := self._vault_secret(self.kp_db)) is None:
+      secret = secrets.token_bytes(32)
+      meta = self.kp_db.tree.getroot().find("Meta")
+      custom_data = meta.find("CustomData")
+      if custom_data is None:
+        custom_data = E.CustomData()
+        meta.append(custom_data)
+      custom_data.append(E.Item(E.Key(INDEX_KEY_ITEM), E.Value(base64.b64encode(secret).decode("ascii"))))
+      added = True
+    self._secret = secret
+    self.persistent = True
+    self.rebuild()
+    if not added:
+      self.saved()
+    return added
+
+  def saved(self) -> None:
+    """Rewrite the index file for the vault file just saved, a no-op unless `persistent`."""
+    if not self.persistent:
+      return
+    with profiling.span("index.persist"):
+      slots: dict[str, list[int]] = {}
+      for kind, name, _, position in _walk(self.kp_db):
+        slots.setdefault(self._slot(kind, name).hex(), position)
+      document = {"version": INDEX_VERSION, "sha256": _sha256(self.kp_db.filename), "slots": slots}
+      atomic_write(index_path(self.kp_db.filename), json.dumps(document, separators=(",", ":")).encode("utf-8"))
@@ -0,0 +1,92 @@
+import os
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from trapper_keeper import agent
+from trapper_keeper.agent import AgentClient, VaultAgent
+from trapper_keeper.util.db_utils import DbUtils, PROPERTIES_TITLE
+from trapper_keeper.util.keegen import KeeAuth
+
+
+class TestVaultAgent(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.tmpdir = tempfile.TemporaryDirectory()
+    cls.kp_key = Path(cls.tmpdir.name, "key")
+    cls.kp_token = Path(cls.tmpdir.name, "token")
+    cls.kp_db = Path(cls.tmpdir.name, "kp.kdbx")
+    cls.artifact = Path(cls.tmpdir.name, "env")
+    cls.artifact.write_text("export REGION=eu\n", encoding="utf-8")
+    kee_auth: KeeAuth = KeeAuth()
+    kee_auth.kp_key = cls.kp_key
+    kee_auth.kp_token = cls.kp_token
+    kee_auth.save()
+    DbUtils.create_tk_store(kp_fp=cls.kp_db, kp_token=cls.kp_token, kp_key=cls.kp_key,
+                            kv_fp=Path(cls.tmpdir.name, "kv.sqlite"))
+    DbUtils.pack_tk_store(kp_fp=cls.kp_db, kp_token=cls.kp_token, kp_key=cls.kp_key, artifacts=[cls.artifact],
+                          use_agent=False)
+
+  def setUp(self):
+    self.runtime_dir = tempfile.TemporaryDirectory()
+    self.env = mock.patch.dict(os.environ, {"XDG_RUNTIME_DIR": self.runtime_dir.name})
+    self.env.start()
+    self.agent = VaultAgent(agent.agent_socket_path(), idle_timeout=60)
+    self.server = threading.Thread(target=self.agent.serve_forever, daemon=True)
+    self.server.start()
+    for _ in range(100):
+      if (client := AgentClient.connect()) is not None:
+        self.client = client
+        break
+      threading.Event().wait(0.05)
+
+  def test_reads_unlock_once(self):
+    self.assertEqual(0o600, agent.agent_socket_path().stat().st_mode & 0o777)
+    with mock.patch.object(DbUtils, "_open_kp_db", wraps=DbUtils._open_kp_db) as open_kp_db:
+      for _ in range(3):
+        content = DbUtils.read_attachment(self.kp_db, self.kp_token, self.kp_key, str(self.artifact))
+        self.assertEqual(b"export REGION=eu\n", content)
+      self.assertIsNone(DbUtils.read_field(self.kp_db, self.kp_token, self.kp_key, PROPERTIES_TITLE))
+      self.assertEqual(1, open_kp_db.call_count)
+    self.assertEqual(1, self.client.ping()["vaults"])
+
+  def test_errors_and_eviction(self):
+    with self.assertRaises(KeyError):
+      DbUtils.read_attachment(self.kp_db, self.kp_token, self.kp_key, "/not/packed")
+    self.agent.idle_timeout = 0
+    self.assertEqual(1, self.agent.evict_idle())
+    self.assertEqual(0, self.client.ping()["vaults"])
+
+  def test_unpack_through_agent(self):
+    root = Path(self.runtime_dir.name, "rootfs")
+    report = DbUtils.unpack_tk_store(self.kp_db, self.kp_token, self.kp_key, include=[str(self.artifact)], root=root)
+    self.assertEqual(1, len(report.written))
+    self.assertEqual(self.artifact.read_bytes(), Path(report.written[0]).read_bytes())
+
+  def test_failed_pack_discards_vault(self):
+    changed = Path(self.runtime_dir.name, "changed")
+    changed.write_text("half applied\n", encoding="utf-8")
+    request = {"op": "pack", "kp_fp": str(self.kp_db), "kp_token": str(self.kp_token), "kp_key": str(self.kp_key),
+               "artifacts": [str(changed), str(Path(self.runtime_dir.name, "missing"))]}
+    with self.assertRaises(FileNotFoundError):
+      self.agent.handle(request)
+    self.assertEqual(0, self.client.ping()["vaults"])
+    with self.assertRaises(KeyError):
+      DbUtils.read_attachment(self.kp_db, self.kp_token, self.kp_key, str(changed))
+
+  def tearDown(self):
+    self.client.stop()
+    self.server.join(timeout=5)
+    self.env.stop()
+    self.runtime_dir.cleanup()
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.tmpdir.cleanup()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,69 @@
+import asyncio
+import tempfile
+import unittest
+from pathlib import Path
+
+from pykeepass.pykeepass import PyKeePass
+
+from trapper_keeper import aio
+from trapper_keeper.aio import AsyncKeyValueStore
+from trapper_keeper.util.db_utils import SPECIAL_BINARIES
+from trapper_keeper.util.keegen import KeeAuth
+
+
+class TestAsyncKeyValueStore(unittest.IsolatedAsyncioTestCase):
+
+  async def asyncSetUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.kv_store = await AsyncKeyValueStore.open(Path(self.tmpdir.name, "kv_store.sqlite"))
+
+  async def test_get_set(self):
+    await asyncio.gather(*(self.kv_store.set(f"host/{i}", str(i)) for i in range(32)))
+    values = await asyncio.gather(*(self.kv_store.get(f"host/{i}") for i in range(32)))
+    self.assertEqual([str(i) for i in range(32)], values)
+    self.assertTrue(await self.kv_store.contains("host/0"))
+    await self.kv_store.delete("host/0")
+    self.assertIsNone(await self.kv_store.get("host/0"))
+    with self.assertRaises(KeyError):
+      await self.kv_store.getitem("host/0")
+
+  async def test_scan(self):
+    await self.kv_store.set_many((f"env/{i:04}", str(i)) for i in range(1000))
+    await self.kv_store.update({"ssh/id": "key"})
+    self.assertEqual(1001, await self.kv_store.length())
+    keys = [key async for key, _ in self.kv_store.scan("env/", fetch_size=64)]
+    self.assertEqual([f"env/{i:04}" for i in range(1000)], keys)
+
+  async def asyncTearDown(self):
+    await self.kv_store.close()
+    self.tmpdir.cleanup()
+
+
+class TestAsyncVault(unittest.IsolatedAsyncioTestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.kp_key = Path(self.tmpdir.name, "key")
+    self.kp_token = Path(self.tmpdir.name, "token")
+    kee_auth: KeeAuth = KeeAuth()
+    kee_auth.kp_key = self.kp_key
+    kee_auth.kp_token = self.kp_token
+    kee_auth.save()
+
+  async def test_create_concurrently(self):
+    vaults = [Path(self.tmpdir.name, f"kp{i}.kdbx") for i in range(2)]
+    await asyncio.gather(*(
+      aio.create_tk_store(kp_fp=vault, kp_token=self.kp_token, kp_key=self.kp_key,
+                          kv_fp=Path(self.tmpdir.name, f"kv{i}.sqlite"))
+      for i, vault in enumerate(vaults)
+    ))
+    for vault in vaults:
+      kp_db = PyKeePass(filename=vault, password=self.kp_token.read_text(encoding="utf-8"), keyfile=self.kp_key)
+      self.assertIsNotNone(kp_db.find_groups(name=SPECIAL_BINARIES, first=True))
+
+  def tearDown(self):
+    self.tmpdir.cleanup()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,57 @@
+import json
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from trapper_keeper import bench
+from trapper_keeper.sqlite_kvstore import KeyValueStore
+from trapper_keeper.util import keegen
+from trapper_keeper.util.kdf import KdfParameters
+
+
+class TestBench(unittest.TestCase):
+
+  def test_run(self):
+    results = bench.run(artifact_counts=[3], artifact_sizes=[1024], kv_rows=[200], token_lengths=[64], token_count=5,
+                        kdf=KdfParameters(iterations=1, memory_kib=1024, parallelism=1), repeat=1, label="test")
+    # Results have to survive a round trip through the JSON written by the CLI
+    results = json.loads(json.dumps(results))
+    keys = [result["key"] for result in results["results"]]
+    self.assertIn("create[kdf_iterations=1,kdf_memory_kib=1024,kdf_parallelism=1]", keys)
+    self.assertIn("pack[artifacts=3,kdf_iterations=1,kdf_memory_kib=1024,kdf_parallelism=1,size=1024]", keys)
+    self.assertIn("kv_get[lookups=200,rows=200]", keys)
+    self.assertIn("gen_utf8_many[count=5,length=64]", keys)
+    self.assertTrue(all(result["best"] > 0 for result in results["results"]))
+    self.assertEqual("test", results["label"])
+
+  def test_scratch_xdg(self):
+    with tempfile.TemporaryDirectory() as cache_home, mock.patch.dict(os.environ, {"XDG_CACHE_HOME": cache_home}):
+      keegen.unicode_letters_table.cache_clear()
+      try:
+        bench.run(cases=["keygen"], token_lengths=[8], token_count=2, repeat=1)
+      finally:
+        keegen.unicode_letters_table.cache_clear()
+      self.assertEqual([], os.listdir(cache_home))
+      self.assertEqual(cache_home, os.environ["XDG_CACHE_HOME"])
+
+  def test_kv_set_many_inserts(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      bench.bench_kv(Path(tmpdir), [50], repeat=3)
+      stores = sorted(Path(tmpdir).glob("kv-50-*.sqlite"))
+      self.assertEqual(3, len(stores))
+      for store_fp in stores:
+        with KeyValueStore(store_fp) as store:
+          self.assertEqual(50, len(store))
+
+  def test_compare(self):
+    baseline = {"results": [{"key": "a", "best": 1.0}, {"key": "b", "best": 1.0}, {"key": "c", "best": 0.0001}]}
+    current = {"results": [{"key": "a", "best": 1.5}, {"key": "b", "best": 1.0}, {"key": "c", "best": 0.0005},
+                           {"key": "new", "best": 1.0}]}
+    self.assertEqual([("a", 1.0, 1.5, True), ("b", 1.0, 1.0, False), ("c", 0.0001, 0.0005, False)],
+                     bench.compare(baseline, current))
+
+  def test_unknown_case(self):
+    with self.assertRaises(ValueError):
+      bench.run(cases=["nope"])
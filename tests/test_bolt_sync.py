@@ -0,0 +1,83 @@
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from trapper_keeper.sqlite_kvstore import KeyValueStore
+from trapper_keeper.util import bolt_sync
+from trapper_keeper.util.bolt_sync import export_boltdb, ingest_boltdb, open_boltdb
+
+
+class TestBoltSync(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.bolt_path = Path(self.tmpdir.name, "chezmoistate.boltdb")
+    self.kv_store = KeyValueStore(Path(self.tmpdir.name, "kv.sqlite"))
+    self._put("entryState", {f"/home/user/.file{i:03}".encode(): f'{{"mode":{i}}}'.encode() for i in range(25)})
+    self._put("scriptState", {b"abc": b"\x00\xffbinary"})
+
+  def _put(self, bucket_name: str, pairs: dict[bytes, bytes], delete: tuple[bytes, ...] = ()):
+    with open_boltdb(self.bolt_path, readonly=False) as bolt_db, bolt_db.update() as tx:
+      bucket = tx.bucket(bucket_name.encode()) or tx.create_bucket(bucket_name.encode())
+      for key, value in pairs.items():
+        bucket.put(key, value)
+      for key in delete:
+        bucket.delete(key)
+
+  def _ingest(self, **kwargs) -> bolt_sync.SyncReport:
+    with open_boltdb(self.bolt_path) as bolt_db:
+      return ingest_boltdb(bolt_db, self.kv_store, batch_size=10, **kwargs)
+
+  def test_ingest_namespaced(self):
+    report = self._ingest()
+    self.assertEqual(26, report.written)
+    self.assertEqual(["entryState", "scriptState"], report.buckets)
+    self.assertIn("configState", report.skipped)
+    self.assertEqual(b'{"mode":3}', self.kv_store["chezmoi/entryState//home/user/.file003"])
+    self.assertEqual(b"\x00\xffbinary", self.kv_store["chezmoi/scriptState/abc"])
+
+  def test_incremental(self):
+    self._ingest()
+    report = self._ingest()
+    self.assertEqual(0, report.written)
+    self.assertIn("entryState", report.skipped)
+
+    self._put("entryState", {b"/home/user/.file001": b"{}"}, delete=(b"/home/user/.file024",))
+    report = self._ingest(buckets=["entryState"])
+    self.assertEqual((1, 1, 23), (report.written, report.deleted, report.unchanged))
+    self.assertNotIn("chezmoi/entryState//home/user/.file024", self.kv_store)
+
+  def test_resume(self):
+    real_merge = bolt_sync._merge_range
+    calls = []
+
+    def failing_merge(*args):
+      calls.append(args)
+      if len(calls) == 2:
+        raise RuntimeError("interrupted")
+      real_merge(*args)
+
+    with mock.patch.object(bolt_sync, "_merge_range", failing_merge), self.assertRaises(RuntimeError):
+      self._ingest(buckets=["entryState"])
+    self.assertEqual(10, len(self.kv_store.keys()) - 1)
+
+    report = self._ingest(buckets=["entryState"])
+    # Only the batches after the checkpoint are read again
+    self.assertEqual(15, report.written + report.unchanged)
+    self.assertEqual(25, len(list(self.kv_store.scan("chezmoi/entryState/"))))
+
+  def test_export_round_trip(self):
+    self._ingest()
+    exported = Path(self.tmpdir.name, "exported.boltdb")
+    with open_boltdb(exported, readonly=False) as bolt_db:
+      report = export_boltdb(self.kv_store, bolt_db, buckets=["entryState", "scriptState"], batch_size=10)
+    self.assertEqual(26, report.written)
+    with open_boltdb(exported) as bolt_db, bolt_db.view() as tx:
+      self.assertEqual(b'{"mode":7}', tx.bucket(b"entryState").get(b"/home/user/.file007"))
+      self.assertEqual(b"\x00\xffbinary", tx.bucket(b"scriptState").get(b"abc"))
+      self.assertEqual(25, sum(1 for _ in tx.bucket(b"entryState")))
+
+  def tearDown(self):
+    self.kv_store.close()
+    self.tmpdir.cleanup()
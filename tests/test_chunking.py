@@ -0,0 +1,42 @@
+import hashlib
+import random
+import unittest
+
+from trapper_keeper.util import chunking
+
+
+def _recipe(data: bytes, previous=()) -> list[tuple[str, int]]:
+  return [(digest, len(chunk)) for digest, chunk in chunking.iter_chunks(data, previous)]
+
+
+class TestChunking(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.data = random.Random(0).randbytes(2 * 1024 * 1024)
+
+  def test_chunk_sizes(self):
+    recipe = _recipe(self.data)
+    self.assertEqual(len(self.data), sum(size for _, size in recipe))
+    for _, size in recipe[:-1]:
+      self.assertGreaterEqual(size, chunking.MIN_CHUNK_SIZE)
+      self.assertLessEqual(size, chunking.MAX_CHUNK_SIZE)
+    self.assertEqual([(hashlib.sha256(b"tiny").hexdigest(), 4)], _recipe(b"tiny"))
+
+  def test_insertion_is_local(self):
+    middle = len(self.data) // 2
+    edited = self.data[:middle] + b"inserted" + self.data[middle:]
+    recipe, edited_recipe = _recipe(self.data), _recipe(edited)
+    self.assertLessEqual(len(set(edited_recipe) - set(recipe)), 2)
+    # Taking over the unchanged head of the old recipe cuts exactly like chunking from scratch
+    self.assertEqual(edited_recipe, _recipe(edited, recipe))
+    self.assertEqual(_recipe(self.data + b"appended"), _recipe(self.data + b"appended", recipe))
+
+  def test_recipe_round_trip(self):
+    recipe = _recipe(self.data)
+    self.assertEqual(recipe, chunking.loads_recipe(chunking.dumps_recipe(recipe)))
+    self.assertEqual([], chunking.loads_recipe(chunking.dumps_recipe([])))
+
+
+if __name__ == '__main__':
+  unittest.main()
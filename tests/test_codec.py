@@ -0,0 +1,30 @@
+import os
+import unittest
+
+from trapper_keeper.util import codec
+
+
+class TestCodec(unittest.TestCase):
+
+  def test_small_and_random_stay_raw(self):
+    self.assertIsNone(codec.choose_codec(b"export A=1\n"))
+    self.assertIsNone(codec.choose_codec(os.urandom(256 * 1024)))
+
+  def test_text_is_compressed(self):
+    history = b"".join(f"{i}: git status && task test:all\n".encode() for i in range(20000))
+    chosen = codec.choose_codec(history)
+    self.assertIn(chosen, codec.CODECS)
+    compressed = codec.compress(history, chosen)
+    self.assertLess(len(compressed), len(history) // 4)
+    self.assertEqual(history, codec.decompress(compressed, chosen))
+
+  def test_streaming_round_trip(self):
+    data = b"abcdefgh" * 100000
+    for name in codec.CODECS:
+      chunks = list(codec.iter_decompress(codec.compress(data, name), name, chunk_size=1024))
+      self.assertEqual(data, b"".join(chunks))
+    self.assertEqual([data], list(codec.iter_decompress(data, None)))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,3 +1,12 @@
+import hashlib
+import contextlib
+import io
+import os
+import random
+import shutil
+import sqlite3
+import stat
+import tarfile
 import tempfile
 import unittest
 from pathlib import Path
@@ -7,7 +16,9 @@ from boltdb.tx import Tx
 from pykeepass.group import Group
 from pykeepass.pykeepass import PyKeePass
 
-from trapper_keeper.util.db_utils import DbUtils, SPECIAL_BINARIES
+from trapper_keeper.util import chunking
+from trapper_keeper.util.db_utils import ARTIFACTS_TITLE, DbUtils, SPECIAL_BINARIES
+from trapper_keeper.util.manifest import Manifest
 from trapper_keeper.util.keegen import KeeAuth
 
 
@@ -93,5 +104,334 @@ class TestKeepassCase(unittest.TestCase):
     dir_parent.rmdir()
 
 
+class TestPackCase(unittest.TestCase):
+  """Pack/unpack tests against copies of one vault, creating a vault per test would be dominated by the KDF."""
+
+  @classmethod
+  def setUpClass(cls):
+    cls.template_dir = tempfile.TemporaryDirectory()
+    cls.kp_key = Path(cls.template_dir.name, "key")
+    cls.kp_token = Path(cls.template_dir.name, "token")
+    cls.template_db = Path(cls.template_dir.name, "kp.kdbx")
+    kee_auth: KeeAuth = KeeAuth()
+    kee_auth.kp_key = cls.kp_key
+    kee_auth.kp_token = cls.kp_token
+    kee_auth.save()
+    cls.create_stats = DbUtils.create_tk_store(kp_fp=cls.template_db, kp_token=cls.kp_token, kp_key=cls.kp_key,
+                                               kv_fp=Path(cls.template_dir.name, "kv.sqlite"))
+
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.kp_db = Path(shutil.copy(self.template_db, Path(self.tmpdir.name, "kp.kdbx")))
+    self.artifacts = [Path(self.tmpdir.name, "artifacts", name) for name in ("env", "history", "ssh/config")]
+    for artifact in self.artifacts:
+      artifact.parent.mkdir(parents=True, exist_ok=True)
+      artifact.write_text(f"contents of {artifact.name}\n", encoding="utf-8")
+
+  def _pack(self):
+    return DbUtils.pack_tk_store(kp_fp=self.kp_db, kp_token=self.kp_token, kp_key=self.kp_key, artifacts=self.artifacts)
+
+  def _open(self) -> PyKeePass:
+    return PyKeePass(filename=self.kp_db, password=self.kp_token.read_text(encoding="utf-8"), keyfile=self.kp_key)
+
+  def test_incremental_pack(self):
+    report = self._pack()
+    self.assertEqual([str(artifact) for artifact in self.artifacts], report.attached)
+    self.assertTrue(report.saved)
+
+    vault_mtime = self.kp_db.stat().st_mtime_ns
+    report = self._pack()
+    self.assertEqual([], report.attached)
+    self.assertEqual(3, len(report.unchanged))
+    self.assertFalse(report.saved)
+    self.assertEqual(vault_mtime, self.kp_db.stat().st_mtime_ns)
+
+    # touched but identical content is still not re-attached
+    os.utime(self.artifacts[0], ns=(0, 0))
+    self.assertFalse(self._pack().saved)
+
+    self.artifacts[1].write_text("changed\n", encoding="utf-8")
+    report = self._pack()
+    self.assertEqual([str(self.artifacts[1])], report.attached)
+
+    kp_db = self._open()
+    entry = kp_db.find_entries(title=ARTIFACTS_TITLE, first=True)
+    attachments = {attachment.filename: attachment.binary for attachment in entry.attachments}
+    self.assertEqual(3, len(attachments))
+    self.assertEqual(b"changed\n", attachments[str(self.artifacts[1])])
+    manifest = Manifest.load(kp_db, kp_db.find_groups(name=SPECIAL_BINARIES, first=True))
+    self.assertEqual(len(b"changed\n"), manifest[str(self.artifacts[1])].size)
+
+  def test_pack_records_stored_bytes(self):
+    self._pack()
+    kp_db = self._open()
+    entry = kp_db.find_entries(title=ARTIFACTS_TITLE, first=True)
+    entry.delete_attachment(next(a for a in entry.attachments if a.filename == str(self.artifacts[0])))
+    kp_db.save()
+
+    # The manifest still describes the dropped attachment, its bytes are read again rather than trusted
+    report = self._pack()
+    self.assertEqual([str(self.artifacts[0])], report.attached)
+    kp_db = self._open()
+    manifest = Manifest.load(kp_db, kp_db.find_groups(name=SPECIAL_BINARIES, first=True))
+    for artifact in self.artifacts:
+      stored = DbUtils.read_attachment(kp_fp=self.kp_db, kp_token=self.kp_token, kp_key=self.kp_key,
+                                       filename=str(artifact))
+      self.assertEqual((len(stored), hashlib.sha256(stored).hexdigest()),
+                       (manifest[str(artifact)].size, manifest[str(artifact)].sha256))
+
+  def test_pack_compacts(self):
+    self.artifacts[2].write_text("contents of env\n", encoding="utf-8")
+    self._pack()
+    self.artifacts[1].write_text("changed\n", encoding="utf-8")
+    report = self._pack()
+    self.assertEqual(len("contents of history\n"), report.reclaimed)
+
+    kp_db = self._open()
+    attachments = {a.filename: a for a in kp_db.find_entries(title=ARTIFACTS_TITLE, first=True).attachments}
+    env, ssh_config = attachments[str(self.artifacts[0])], attachments[str(self.artifacts[2])]
+    self.assertEqual(b"contents of env\n", ssh_config.binary)
+    self.assertEqual(env.id, ssh_config.id)
+    # The kv store, the two distinct artifacts and nothing else
+    self.assertEqual(3, len(kp_db.binaries))
+
+  def test_compact(self):
+    kp_db = self._open()
+    kp_db.add_binary(b"garbage" * 100)
+    kp_db.save()
+
+    report = DbUtils.compact_tk_store(kp_fp=self.kp_db, kp_token=self.kp_token, kp_key=self.kp_key)
+    self.assertEqual((1, 700, True), (report.unreferenced, report.bytes_reclaimed, report.saved))
+    report = DbUtils.compact_tk_store(kp_fp=self.kp_db, kp_token=self.kp_token, kp_key=self.kp_key)
+    self.assertEqual((0, False), (report.bytes_reclaimed, report.saved))
+
+  def test_create_saves_once(self):
+    self.assertEqual(1, self.create_stats.saves)
+
+  def test_create_with_artifacts(self):
+    kp_db = Path(self.tmpdir.name, "fresh.kdbx")
+    stats = DbUtils.create_tk_store(kp_fp=kp_db, kp_token=self.kp_token, kp_key=self.kp_key,
+                                    kv_fp=Path(self.tmpdir.name, "kv.sqlite"), artifacts=self.artifacts)
+    self.assertEqual(1, stats.saves)
+    self.kp_db = kp_db
+    entry = self._open().find_entries(title=ARTIFACTS_TITLE, first=True)
+    self.assertEqual({str(artifact) for artifact in self.artifacts}, {a.filename for a in entry.attachments})
+
+  def test_create_imports_kv_store_read_only(self):
+    kv_fp = Path(self.tmpdir.name, "legacy.sqlite")
+    with contextlib.closing(sqlite3.connect(kv_fp)) as legacy:
+      legacy.execute("CREATE TABLE kv (key text unique, value text)")
+      legacy.execute("INSERT INTO kv VALUES ('editor', 'nvim')")
+      legacy.commit()
+    legacy_bytes = kv_fp.read_bytes()
+    kp_db = Path(self.tmpdir.name, "fresh.kdbx")
+    DbUtils.create_tk_store(kp_fp=kp_db, kp_token=self.kp_token, kp_key=self.kp_key, kv_fp=kv_fp)
+    # Neither migrated nor switched to WAL on disk
+    self.assertEqual(legacy_bytes, kv_fp.read_bytes())
+    self.assertFalse(Path(f"{kv_fp}-wal").exists())
+    self.kp_db = kp_db
+    with DbUtils.load_kp_kv_store(self._open()) as kv_store:
+      self.assertEqual("nvim", kv_store["editor"])
+
+  def test_session_discards_on_error(self):
+    vault_mtime = self.kp_db.stat().st_mtime_ns
+    with self.assertRaises(RuntimeError):
+      with DbUtils.open_session(kp_fp=self.kp_db, kp_token=self.kp_token, kp_key=self.kp_key) as session:
+        DbUtils.pack_kp_db(session, artifacts=self.artifacts)
+        self.assertTrue(session.dirty)
+        raise RuntimeError("abort")
+    self.assertEqual(0, session.stats.saves)
+    self.assertEqual(vault_mtime, self.kp_db.stat().st_mtime_ns)
+
+  def test_kv_store_in_memory(self):
+    self.assertFalse(Path(self.template_dir.name, "kv.sqlite").exists())
+    kv_store = DbUtils.load_kv_store(kp_fp=self.kp_db, kp_token=self.kp_token, kp_key=self.kp_key)
+    self.assertEqual(0, len(kv_store))
+    kv_store.update({"editor": "nvim", "shell": "zsh"})
+    with DbUtils.open_session(kp_fp=self.kp_db, kp_token=self.kp_token, kp_key=self.kp_key) as session:
+      report = DbUtils.pack_kp_db(session, kv_store=kv_store)
+    self.assertEqual([str(Path(self.template_dir.name, "kv.sqlite"))], report.attached)
+
+    kv_store = DbUtils.load_kv_store(kp_fp=self.kp_db, kp_token=self.kp_token, kp_key=self.kp_key)
+    self.assertEqual("nvim", kv_store["editor"])
+    self.assertEqual([], list(Path(self.tmpdir.name).glob("*.sqlite*")))
+
+  def test_repack(self):
+    root = Path(self.tmpdir.name, "artifacts")
+    kv_fp = Path(self.tmpdir.name, "index.sqlite")
+
+    def repack():
+      return DbUtils.repack_tk_store(kp_fp=self.kp_db, kp_token=self.kp_token, kp_key=self.kp_key, kv_fp=kv_fp,
+                                     roots=[root], use_agent=False)
+
+    report = repack()
+    self.assertEqual(sorted(str(artifact) for artifact in self.artifacts), sorted(report.pack.attached))
+    self.assertEqual(b"contents of env\n", DbUtils.read_attachment(
+      kp_fp=self.kp_db, kp_token=self.kp_token, kp_key=self.kp_key, filename=str(self.artifacts[0]), use_agent=False))
+
+    vault_mtime = self.kp_db.stat().st_mtime_ns
+    report = repack()
+    self.assertIsNone(report.pack)
+    self.assertEqual((3, 0), (report.discovery.scanned, report.discovery.hashed))
+    self.assertEqual(vault_mtime, self.kp_db.stat().st_mtime_ns)
+
+    self.artifacts[1].write_text("changed\n", encoding="utf-8")
+    report = repack()
+    self.assertEqual([str(self.artifacts[1])], report.pack.attached)
+
+  def test_unpack(self):
+    self._pack()
+    root = Path(self.tmpdir.name, "rootfs")
+    report = DbUtils.unpack_tk_store(kp_fp=self.kp_db, kp_token=self.kp_token, kp_key=self.kp_key, root=root,
+                                     workers=2)
+    restored = [Path(root, str(artifact).lstrip("/")) for artifact in self.artifacts]
+    for artifact, restored_artifact in zip(self.artifacts, restored, strict=True):
+      self.assertEqual(artifact.read_bytes(), restored_artifact.read_bytes())
+    self.assertEqual(len(report.written), len(set(report.written)))
+    self.assertEqual([], report.skipped)
+    self.assertEqual([], list(root.rglob("*.tmp")))
+
+    restored[0].write_text("tampered\n", encoding="utf-8")
+    report = DbUtils.unpack_tk_store(kp_fp=self.kp_db, kp_token=self.kp_token, kp_key=self.kp_key, root=root)
+    self.assertEqual([str(restored[0])], report.written)
+    self.assertEqual(self.artifacts[0].read_bytes(), restored[0].read_bytes())
+
+  def test_unpack_selective(self):
+    self._pack()
+    root = Path(self.tmpdir.name, "rootfs")
+    report = DbUtils.unpack_tk_store(kp_fp=self.kp_db, kp_token=self.kp_token, kp_key=self.kp_key, root=root,
+                                     include=["*/ssh/*"])
+    self.assertEqual([str(Path(root, str(self.artifacts[2]).lstrip("/")))], report.written)
+
+  def test_unpack_keeps_modes(self):
+    self.artifacts[0].chmod(0o755)
+    self.artifacts[1].chmod(0o640)
+    self._pack()
+    root = Path(self.tmpdir.name, "rootfs")
+    restored = [Path(root, str(artifact).lstrip("/")) for artifact in self.artifacts]
+    restored[1].parent.mkdir(parents=True)
+    restored[1].write_text("stale\n", encoding="utf-8")
+    restored[1].chmod(0o644)
+    DbUtils.unpack_tk_store(kp_fp=self.kp_db, kp_token=self.kp_token, kp_key=self.kp_key, root=root)
+    self.assertEqual(0o755, stat.S_IMODE(restored[0].stat().st_mode))
+    self.assertEqual(0o640, stat.S_IMODE(restored[1].stat().st_mode))
+
+  def test_compressed_round_trip(self):
+    history = b"".join(f"{i}: ssh-add ~/.ssh/id_ed25519\n".encode() for i in range(5000))
+    self.artifacts[1].write_bytes(history)
+    self._pack()
+    entry = self._open().find_entries(title=ARTIFACTS_TITLE, first=True)
+    attachment = next(a for a in entry.attachments if a.filename == str(self.artifacts[1]))
+    self.assertLess(len(attachment.binary), len(history) // 4)
+    self.assertIsNotNone(entry.get_custom_property(f"codec:{self.artifacts[1]}"))
+
+    root = Path(self.tmpdir.name, "rootfs")
+    DbUtils.unpack_tk_store(kp_fp=self.kp_db, kp_token=self.kp_token, kp_key=self.kp_key, root=root)
+    self.assertEqual(history, Path(root, str(self.artifacts[1]).lstrip("/")).read_bytes())
+
+  def test_chunked_pack(self):
+    store = bytearray(random.Random(0).randbytes(2 * 1024 * 1024))
+    self.artifacts[0].write_bytes(store)
+    report = self._pack()
+    self.assertGreater(report.chunks_added, 8)
+    chunks = self._open().find_entries(title=chunking.CHUNKS_TITLE, first=True)
+    self.assertEqual(report.chunks_added, len(chunks.attachments))
+
+    # One changed byte re-adds the chunk around it, the old one is dropped with it
+    store[len(store) // 2] ^= 0xFF
+    self.artifacts[0].write_bytes(store)
+    report = self._pack()
+    self.assertEqual((1, 1), (report.chunks_added, len(report.attached)))
+    self.assertGreater(report.reclaimed, 0)
+    kp_db = self._open()
+    chunks = kp_db.find_entries(title=chunking.CHUNKS_TITLE, first=True)
+    self.assertEqual(report.chunks_added + report.chunks_reused, len(chunks.attachments))
+
+    # An identical copy anywhere else adds nothing
+    self.artifacts[1].write_bytes(store)
+    report = self._pack()
+    self.assertEqual(0, report.chunks_added)
+
+    self.assertEqual(bytes(store), DbUtils.read_attachment(kp_fp=self.kp_db, kp_token=self.kp_token,
+                                                           kp_key=self.kp_key, filename=str(self.artifacts[0])))
+    root = Path(self.tmpdir.name, "rootfs")
+    report = DbUtils.unpack_tk_store(kp_fp=self.kp_db, kp_token=self.kp_token, kp_key=self.kp_key, root=root)
+    # Artifacts and the Key/Value store, chunks are not unpacked on their own
+    self.assertEqual(len(self.artifacts) + 1, len(report.written))
+    self.assertEqual(bytes(store), Path(root, str(self.artifacts[1]).lstrip("/")).read_bytes())
+
+  def test_tar_round_trip(self):
+    self.artifacts[2].chmod(0o600)
+    self._pack()
+    archive = io.BytesIO()
+    report = DbUtils.export_tk_tar(kp_fp=self.kp_db, kp_token=self.kp_token, kp_key=self.kp_key, fileobj=archive)
+    # The Key/Value store is an attachment like any other
+    self.assertEqual(len(self.artifacts) + 1, len(report.written))
+    archive.seek(0)
+    with tarfile.open(fileobj=archive) as tar:
+      members = {f"/{member.name}": member for member in tar}
+      self.assertEqual(self.artifacts[0].read_bytes(), tar.extractfile(members[str(self.artifacts[0])]).read())
+    self.assertEqual(0o600, members[str(self.artifacts[2])].mode)
+    self.assertEqual(self.artifacts[2].stat().st_mtime_ns // 10**9, int(members[str(self.artifacts[2])].mtime))
+
+    # A mode change alone is recorded without re-attaching anything
+    self.artifacts[2].chmod(0o640)
+    report = self._pack()
+    self.assertEqual(([], True), (report.attached, report.saved))
+
+  def _export_members(self) -> dict[str, bytes]:
+    archive = io.BytesIO()
+    DbUtils.export_tk_tar(kp_fp=self.kp_db, kp_token=self.kp_token, kp_key=self.kp_key, fileobj=archive)
+    archive.seek(0)
+    with tarfile.open(fileobj=archive) as tar:
+      return {f"/{member.name}": tar.extractfile(member).read() for member in tar}
+
+  def test_tar_export_large_compressed(self):
+    history = b"".join(f"{i}: ssh-add ~/.ssh/id_ed25519\n".encode() for i in range(100_000))
+    self.artifacts[1].write_bytes(history)
+    self._pack()
+    self.assertEqual(history, self._export_members()[str(self.artifacts[1])])
+
+  def test_tar_export_chunked(self):
+    store = random.Random(1).randbytes(chunking.CHUNKED_MIN_SIZE + 200 * 1024)
+    self.artifacts[0].write_bytes(store)
+    report = self._pack()
+    self.assertGreater(report.chunks_added, 1)
+    self.assertEqual(store, self._export_members()[str(self.artifacts[0])])
+
+  def test_tar_import(self):
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w") as tar:
+      for name, data in (("etc/motd", b"hello\n"), ("../etc/../root/.profile", b"umask 077\n")):
+        member = tarfile.TarInfo(name)
+        member.size, member.mode = len(data), 0o644
+        tar.addfile(member, io.BytesIO(data))
+    archive.seek(0)
+    report = DbUtils.import_tk_tar(kp_fp=self.kp_db, kp_token=self.kp_token, kp_key=self.kp_key, fileobj=archive)
+    self.assertEqual((["/etc/motd", "/root/.profile"], True), (report.attached, report.saved))
+    self.assertEqual(b"umask 077\n", DbUtils.read_attachment(kp_fp=self.kp_db, kp_token=self.kp_token,
+                                                              kp_key=self.kp_key, filename="/root/.profile"))
+    self.assertEqual(0o644, Manifest.load(kp_db := self._open(), kp_db.find_groups(name=SPECIAL_BINARIES, first=True))
+                     .get("/etc/motd").mode)
+
+    # An absolute member name lands on the same artifact rather than next to it
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w") as tar:
+      member = tarfile.TarInfo("/etc/motd")
+      member.size = len(b"changed\n")
+      tar.addfile(member, io.BytesIO(b"changed\n"))
+    archive.seek(0)
+    report = DbUtils.import_tk_tar(kp_fp=self.kp_db, kp_token=self.kp_token, kp_key=self.kp_key, fileobj=archive)
+    self.assertEqual(["/etc/motd"], report.attached)
+    self.assertEqual(1, len(self._open().find_attachments(filename="/etc/motd")))
+
+  def tearDown(self):
+    self.tmpdir.cleanup()
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.template_dir.cleanup()
+
+
 if __name__ == '__main__':
   unittest.main()
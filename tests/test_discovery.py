@@ -0,0 +1,62 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from trapper_keeper.sqlite_kvstore import KeyValueStore
+from trapper_keeper.util import discovery
+from trapper_keeper.util.discovery import ScanRules
+
+
+class TestDiscovery(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.root = Path(self.tmpdir.name, "config")
+    self.store = KeyValueStore(Path(self.tmpdir.name, "kv.sqlite"))
+    for name in ("git/config", "nvim/init.lua", "nvim/lua/plugins.lua", "nvim/.git/HEAD", "trapper_keeper/secrets.keyx",
+                 "app/state.lock", "app/settings.json"):
+      Path(self.root, name).parent.mkdir(parents=True, exist_ok=True)
+      Path(self.root, name).write_text(f"{name}\n", encoding="utf-8")
+    os.symlink(Path(self.root, "git"), Path(self.root, "linked"))
+
+  def _discover(self, **kwargs) -> discovery.Discovery:
+    return discovery.discover(self.store, roots=[self.root], **kwargs)
+
+  def _paths(self, paths) -> list[str]:
+    return sorted(Path(path).relative_to(self.root).as_posix() for path in paths)
+
+  def test_rules(self):
+    found = self._discover()
+    self.assertEqual(["app/settings.json", "git/config", "nvim/init.lua", "nvim/lua/plugins.lua"],
+                     self._paths(found.changed))
+    found = self._discover(rules=ScanRules(include=("*.lua",), exclude=("nvim/lua",)),
+                           skip=[Path(self.root, "git/config")])
+    self.assertEqual(["nvim/init.lua"], self._paths(found.changed))
+
+  def test_index(self):
+    discovery.commit_index(self.store, self._discover())
+    found = self._discover()
+    self.assertEqual((4, 0, []), (found.scanned, found.hashed, found.changed))
+
+    # Touched but identical files are hashed once more and then left alone
+    os.utime(Path(self.root, "git/config"), ns=(0, 0))
+    Path(self.root, "nvim/init.lua").write_text("changed\n", encoding="utf-8")
+    Path(self.root, "app/settings.json").unlink()
+    found = self._discover()
+    self.assertEqual(2, found.hashed)
+    self.assertEqual(["nvim/init.lua"], self._paths(found.changed))
+    self.assertEqual(["app/settings.json"], self._paths(found.removed))
+
+    discovery.commit_index(self.store, found)
+    self.assertEqual(3, len(discovery.load_index(self.store, [self.root])))
+    self.assertEqual(0, self._discover().hashed)
+
+  def test_uncommitted(self):
+    # An index that was never committed, e.g. because the pack failed, finds the same changes again
+    self._discover()
+    self.assertEqual(4, len(self._discover().changed))
+
+  def tearDown(self):
+    self.store.close()
+    self.tmpdir.cleanup()
@@ -0,0 +1,67 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+from trapper_keeper import fleet
+from trapper_keeper.util.db_utils import DbUtils
+from trapper_keeper.util.kdf import KdfParameters
+from trapper_keeper.util.keegen import KeeAuth
+
+FAST_KDF = KdfParameters(iterations=1, memory_kib=1024, parallelism=1)
+
+
+class TestFleet(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.root = Path(self.tmpdir.name)
+    entries = []
+    for auth in KeeAuth.batch(Path(self.root, f"img-{i}") for i in range(3)):
+      auth.save()
+      image = auth.kp_token[0].parent
+      artifact = Path(image, "etc", "hosts")
+      artifact.parent.mkdir()
+      artifact.write_text(f"127.0.0.1 {image.name}\n", encoding="utf-8")
+      entries.append({"vault": f"{image.name}/secrets.kdbx", "token": f"{image.name}/{auth.kp_token[0].name}",
+                      "key": f"{image.name}/{auth.kp_key[0].name}", "artifacts": [f"{image.name}/etc/hosts"]})
+    # A vault whose token was never minted must fail on its own
+    entries.append({"vault": "broken/secrets.kdbx", "token": "broken/missing", "key": "broken/missing.keyx"})
+    self.fleet_file = Path(self.root, "fleet.json")
+    self.fleet_file.write_text(json.dumps(entries), encoding="utf-8")
+
+  def test_load_fleet(self):
+    jobs = fleet.load_fleet(self.fleet_file)
+    self.assertEqual(4, len(jobs))
+    self.assertEqual(Path(self.root, "img-0", "secrets.kdbx"), jobs[0].vault)
+    self.assertEqual((Path(self.root, "img-0", "etc", "hosts"),), jobs[0].artifacts)
+    self.assertEqual((), jobs[3].artifacts)
+
+    self.fleet_file.write_text(json.dumps([{"vault": "a.kdbx"}]), encoding="utf-8")
+    with self.assertRaises(ValueError):
+      fleet.load_fleet(self.fleet_file)
+
+  def test_run_fleet(self):
+    jobs = fleet.load_fleet(self.fleet_file)
+    seen = []
+    report = fleet.run_fleet(jobs, workers=2, kdf=FAST_KDF, progress=lambda result, done, total: seen.append(done))
+    self.assertEqual([1, 2, 3, 4], seen)
+    self.assertEqual(2, report.workers)
+    self.assertEqual(["broken/secrets.kdbx"], [Path(r.vault).relative_to(self.root).as_posix() for r in report.failed])
+    self.assertIn("FileNotFoundError", report.failed[0].error)
+    self.assertEqual({"create"}, {result.action for result in report.results})
+    self.assertEqual(b"127.0.0.1 img-1\n", DbUtils.read_attachment(
+      kp_fp=jobs[1].vault, kp_token=jobs[1].token, kp_key=jobs[1].key, filename=str(jobs[1].artifacts[0]),
+      use_agent=False))
+
+    # Existing vaults are packed, nothing changed so none is written again
+    report = fleet.run_fleet(jobs[:3], workers=2)
+    self.assertEqual([("pack", 0, 1, False)] * 3,
+                     [(result.action, result.attached, result.unchanged, result.saved) for result in report.results])
+
+  def test_unknown_mode(self):
+    with self.assertRaises(ValueError):
+      fleet.run_fleet([], mode="nope")
+
+  def tearDown(self):
+    self.tmpdir.cleanup()
@@ -0,0 +1,45 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from pykeepass.pykeepass import PyKeePass
+
+from trapper_keeper.util import kdf
+from trapper_keeper.util.db_utils import DbUtils
+from trapper_keeper.util.kdf import KdfParameters
+from trapper_keeper.util.keegen import KeeAuth
+
+FAST_KDF = KdfParameters(iterations=1, memory_kib=1024, parallelism=1)
+
+
+class TestKdf(unittest.TestCase):
+
+  def test_calibrate(self):
+    calibration = kdf.calibrate(target_seconds=0.05, max_memory_kib=16 * 1024)
+    chosen = calibration.parameters
+    self.assertEqual(kdf.available_cores(), chosen.parallelism)
+    self.assertIn(chosen.memory_kib, (kdf.MIN_MEMORY_KIB, 16 * 1024))
+    self.assertGreaterEqual(chosen.iterations, 1)
+    self.assertGreaterEqual(calibration.trials, 1)
+
+    self.assertEqual(2, kdf.calibrate(target_seconds=0.01, parallelism=2).parameters.parallelism)
+    with self.assertRaises(ValueError):
+      kdf.calibrate(target_seconds=0)
+
+  def test_tune_tk_store(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      kee_auth: KeeAuth = KeeAuth.batch([Path(tmpdir)])[0]
+      kee_auth.save()
+      kp_token, kp_key = kee_auth.kp_token[0], kee_auth.kp_key[0]
+      kp_fp = Path(tmpdir, "kp.kdbx")
+      DbUtils.create_tk_store(kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key, kdf=FAST_KDF)
+
+      tuned = KdfParameters(iterations=2, memory_kib=2048, parallelism=2)
+      self.assertTrue(DbUtils.tune_tk_store(kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key, kdf=tuned))
+      self.assertFalse(DbUtils.tune_tk_store(kp_fp=kp_fp, kp_token=kp_token, kp_key=kp_key, kdf=tuned))
+      kp_db = PyKeePass(filename=kp_fp, password=kp_token.read_text(encoding="utf-8"), keyfile=kp_key)
+      self.assertEqual(tuned, KdfParameters.of(kp_db))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,6 +1,10 @@
+import os
+import stat
 import tempfile
+import unicodedata
 import unittest
 from pathlib import Path
+from unittest import mock
 
 from trapper_keeper.util import keegen
 from trapper_keeper.util.keegen import KeeAuth
@@ -42,3 +46,81 @@ class TestGenAuth(unittest.TestCase):
     self.kp_key.unlink(missing_ok=True)
     self.kp_token.unlink(missing_ok=True)
     dir_folder.rmdir()
+
+
+class TestUnicodeLetters(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.env = mock.patch.dict(os.environ, {"XDG_CACHE_HOME": self.tmpdir.name})
+    self.env.start()
+    keegen.unicode_letters_table.cache_clear()
+
+  def test_table_matches_generator(self):
+    table = keegen.unicode_letters_table(smp=False)
+    self.assertEqual([ord(char) for char in keegen.unicode_letters_generator(smp=False)], table.tolist())
+    self.assertIs(table, keegen.unicode_letters_table(smp=False))
+
+  def test_table_persisted(self):
+    table = keegen.unicode_letters_table(smp=True)
+    table_fp = keegen._letters_table_path(smp=True)
+    self.assertTrue(table_fp.is_file())
+    self.assertIn(unicodedata.unidata_version, table_fp.name)
+    keegen.unicode_letters_table.cache_clear()
+    with mock.patch.object(keegen, "unicode_letters_generator") as generator:
+      self.assertEqual(table, keegen.unicode_letters_table(smp=True))
+      generator.assert_not_called()
+
+  def test_damaged_table_rebuilt(self):
+    table = keegen.unicode_letters_table(smp=False)
+    table_fp = keegen._letters_table_path(smp=False)
+    content = table_fp.read_bytes()
+    for damaged in (content[:len(content) // 2], content[keegen._TABLE_DIGEST_SIZE:]):
+      table_fp.write_bytes(damaged)
+      keegen.unicode_letters_table.cache_clear()
+      self.assertEqual(table, keegen.unicode_letters_table(smp=False))
+      self.assertEqual(content, table_fp.read_bytes())
+
+  def test_gen_utf8(self):
+    token = keegen.gen_utf8(keegen.TOKEN_SIZE)
+    self.assertEqual(keegen.TOKEN_SIZE, len(token))
+    self.assertTrue(all(unicodedata.category(char).startswith("L") for char in token))
+    self.assertTrue(keegen.gen_utf8(10, start="abc", separator="-").startswith("abc-"))
+
+  def tearDown(self):
+    self.env.stop()
+    keegen.unicode_letters_table.cache_clear()
+    self.tmpdir.cleanup()
+
+
+class TestBatchCredentials(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.dest = Path(self.tmpdir.name)
+
+  def test_gen_credentials(self):
+    auths, report = keegen.gen_credentials(count=12, dest=self.dest, workers=4)
+    self.assertEqual(12, report.count)
+    self.assertEqual(24, report.files)
+    self.assertGreater(report.per_second, 0)
+    self.assertEqual(12, len({auth.kp_token[1] for auth in auths}))
+    for auth in auths:
+      for secret_path, secret in auth:
+        self.assertEqual(secret, secret_path.read_text(encoding="utf-8"))
+        self.assertEqual(0o600, stat.S_IMODE(secret_path.stat().st_mode))
+    self.assertEqual(keegen.KEY_SIZE, len(auths[0].kp_key[1]))
+    self.assertTrue(Path(self.dest, "00", keegen.KEEPASS_DB_TOKEN.name).is_file())
+
+  def test_no_overwrite(self):
+    keegen.gen_credentials(count=1, dest=self.dest)
+    with self.assertRaises(FileExistsError):
+      keegen.gen_credentials(count=1, dest=self.dest)
+
+  def test_gen_utf8_many(self):
+    tokens = keegen.gen_utf8_many(5, 7)
+    self.assertEqual([7] * 5, [len(token) for token in tokens])
+    self.assertEqual([""] * 2, keegen.gen_utf8_many(2, 0))
+
+  def tearDown(self):
+    self.tmpdir.cleanup()
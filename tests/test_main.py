@@ -0,0 +1,50 @@
+import inspect
+import os
+import subprocess
+import sys
+import unittest
+from pathlib import Path
+
+from trapper_keeper import __main__ as cli
+
+HEAVY_MODULES = ("pykeepass", "boltdb", "lxml", "argon2", "Cryptodome", "sqlite3", "trapper_keeper.util.db_utils")
+# Generous bound on the wall clock of ``--help``, the whole stack takes several times as long
+HELP_SECONDS = 1.0
+
+
+def _run(code: str) -> subprocess.CompletedProcess:
+  env = {**os.environ, "PYTHONPATH": str(Path(__file__).parents[1] / "src")}
+  return subprocess.run([sys.executable, "-c", code], env=env, check=True, capture_output=True, text=True)
+
+
+class TestImportTime(unittest.TestCase):
+
+  def test_help_skips_backends(self):
+    result = _run(
+      "import runpy, sys\n"
+      "sys.argv = ['trapper_keeper', '--help']\n"
+      "try:\n"
+      "  runpy.run_module('trapper_keeper', run_name='__main__')\n"
+      "except SystemExit:\n"
+      "  pass\n"
+      f"print(' '.join(m for m in sys.modules if m.startswith({HEAVY_MODULES!r})), file=sys.stderr, end='')\n"
+    )
+    self.assertIn("unpack", result.stdout)
+    self.assertEqual("", result.stderr)
+
+  def test_help_is_fast(self):
+    elapsed = float(_run(
+      "import time\n"
+      "start = time.perf_counter()\n"
+      "import trapper_keeper.__main__\n"
+      "print(time.perf_counter() - start)\n"
+    ).stdout)
+    self.assertLess(elapsed, HELP_SECONDS)
+
+  def test_defaults_match_backends(self):
+    from trapper_keeper import agent, bench
+    from trapper_keeper.util import kdf
+
+    self.assertEqual(agent.IDLE_TIMEOUT, inspect.signature(cli.run_agent).parameters["idle_timeout"].default)
+    self.assertEqual(bench.REPEAT, inspect.signature(cli.run_bench).parameters["repeat"].default)
+    self.assertEqual(kdf.DEFAULT_TARGET_SECONDS, inspect.signature(cli.calibrate_kdf).parameters["target"].default)
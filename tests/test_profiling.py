@@ -0,0 +1,54 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from pykeepass.kdbx_parsing import common
+
+from trapper_keeper.sqlite_kvstore import KeyValueStore
+from trapper_keeper.util import profiling
+
+
+class TestProfiling(unittest.TestCase):
+
+  def test_disabled_is_shared_no_op(self):
+    self.assertFalse(profiling.enabled())
+    with profiling.span("anything", size=1) as span:
+      span["bytes"] = 10
+    self.assertIs(profiling.span("a"), profiling.span("b"))
+    self.assertEqual({}, dict(span))
+    profiling.count("nothing")
+
+  def test_spans_and_counters(self):
+    with profiling.profiling(probes=False) as profiler:
+      with profiling.span("outer"):
+        for _ in range(3):
+          with profiling.span("inner") as span:
+            span["bytes"] = 5
+            profiling.count("bytes", 5)
+    self.assertFalse(profiling.enabled())
+    summary = profiler.summary()
+    self.assertEqual(["outer", "inner"], list(summary))
+    self.assertEqual(3, summary["inner"]["calls"])
+    self.assertEqual({"bytes": 15}, dict(profiler.counters))
+
+    trace = profiler.chrome_trace()
+    self.assertEqual(4, len(trace["traceEvents"]))
+    self.assertEqual({"bytes": 5}, trace["traceEvents"][0]["args"])
+    self.assertIn("inner", profiler.report())
+
+  def test_probes_restored(self):
+    original = common.XML._decode
+    with profiling.profiling():
+      self.assertIsNot(original, common.XML._decode)
+    self.assertIs(original, common.XML._decode)
+
+  def test_sqlite_statements_and_cprofile(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      cprofile = Path(tmpdir, "kv.prof")
+      with profiling.profiling(probes=False, cprofile=cprofile) as profiler:
+        with KeyValueStore(Path(tmpdir, "kv.sqlite")) as kv_store:
+          kv_store.set_many([("a", "1"), ("b", "2")])
+          self.assertEqual("1", kv_store["a"])
+      self.assertGreater(profiler.counters["sqlite.statements"], 3)
+      self.assertIn("sqlite.commit", profiler.summary())
+      self.assertGreater(cprofile.stat().st_size, 0)
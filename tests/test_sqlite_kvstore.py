@@ -0,0 +1,254 @@
+import contextlib
+import math
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from trapper_keeper.sqlite_kvstore import SCHEMA_VERSION, KeyValueStore, SharedKeyValueStore
+
+
+class TestKeyValueStore(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.kv_path = Path(self.tmpdir.name, "kv_store.sqlite")
+    self.kv_store = KeyValueStore(filename=self.kv_path)
+
+  def _other_reader(self) -> sqlite3.Connection:
+    """A second connection sees only what was actually committed."""
+    return sqlite3.connect(self.kv_path)
+
+  def test_setitem_is_committed(self):
+    self.kv_store["ssh/id_ed25519"] = "key"
+    with self._other_reader() as reader:
+      self.assertEqual(("key",), reader.execute("SELECT value FROM kv WHERE key = 'ssh/id_ed25519'").fetchone())
+
+  def test_set_many(self):
+    self.kv_store.set_many((f"env/{i}", str(i)) for i in range(2000))
+    self.assertEqual(2000, len(self.kv_store))
+    self.assertEqual("1999", self.kv_store["env/1999"])
+    with self._other_reader() as reader:
+      self.assertEqual(2000, reader.execute("SELECT COUNT(*) FROM kv").fetchone()[0])
+
+  def test_update(self):
+    self.kv_store.update({"a": "1"}, b="2")
+    self.kv_store.update([("c", "3")])
+    self.assertEqual(["a", "b", "c"], sorted(self.kv_store.keys()))
+
+  def test_transaction_rollback(self):
+    self.kv_store["kept"] = "1"
+    with self.assertRaises(RuntimeError), self.kv_store.transaction():
+      self.kv_store["dropped"] = "1"
+      with self.kv_store.batch():
+        self.kv_store["nested"] = "1"
+      raise RuntimeError("abort")
+    self.assertIn("kept", self.kv_store)
+    self.assertNotIn("dropped", self.kv_store)
+    self.assertNotIn("nested", self.kv_store)
+    self.assertFalse(self.kv_store.in_transaction)
+
+  def test_explicit_commit(self):
+    with self.kv_store.transaction():
+      self.kv_store["first"] = "1"
+      self.kv_store.commit()
+      with self._other_reader() as reader:
+        self.assertIsNotNone(reader.execute("SELECT 1 FROM kv WHERE key = 'first'").fetchone())
+      self.kv_store["second"] = "2"
+    self.assertIn("second", self.kv_store)
+
+  def test_wal_and_synchronous(self):
+    self.assertEqual("wal", self.kv_store.conn.execute("PRAGMA journal_mode").fetchone()[0])
+    with KeyValueStore(filename=Path(self.tmpdir.name, "full.sqlite"), synchronous="full") as full_store:
+      self.assertEqual(2, full_store.conn.execute("PRAGMA synchronous").fetchone()[0])
+    with self.assertRaises(ValueError):
+      KeyValueStore(filename=":memory:", synchronous="sometimes")
+
+  def test_serialize_round_trip(self):
+    self.kv_store.update({"a": "1", "b": "2"})
+    image = bytes(self.kv_store)
+    # Taken from a WAL database, the image still has to open in memory
+    self.assertEqual(b"\x02\x02", image[18:20])
+    with KeyValueStore.from_bytes(image, cache_size=8) as in_memory:
+      self.assertEqual([("a", "1"), ("b", "2")], in_memory.items())
+      in_memory["c"] = "3"
+      self.assertEqual(3, len(KeyValueStore.from_bytes(in_memory.serialize())))
+    self.assertNotIn("c", self.kv_store)
+
+  def test_from_bytes_empty(self):
+    with KeyValueStore.from_bytes(b"") as in_memory:
+      in_memory["a"] = "1"
+      self.assertEqual("1", in_memory["a"])
+
+  def test_delitem(self):
+    self.kv_store["gone"] = "1"
+    del self.kv_store["gone"]
+    self.assertNotIn("gone", self.kv_store)
+    with self.assertRaises(KeyError):
+      del self.kv_store["gone"]
+
+  def test_typed_values(self):
+    values = {"bytes": b"\x00\xff", "int": 2 ** 40, "big": 2 ** 70, "float": 0.5, "str": "text", "none": None,
+              "bool": True, "json": {"hosts": ["a", "b"], "port": 22}}
+    self.kv_store.update(values)
+    self.assertEqual(values, dict(self.kv_store.items()))
+    self.assertIs(True, self.kv_store["bool"])
+    with KeyValueStore.from_bytes(self.kv_store.serialize(), cache_size=4) as in_memory:
+      self.assertEqual(values["json"], in_memory["json"])
+      in_memory["json"]["port"] = 2222
+      self.assertEqual(22, in_memory["json"]["port"])
+    with self._other_reader() as reader:
+      # Scalars stay plain sqlite values any client can read
+      self.assertEqual(("blob", 2 ** 40), reader.execute("SELECT typeof(value), (SELECT value FROM kv WHERE key = 'int') "
+                                                         "FROM kv WHERE key = 'bytes'").fetchone())
+
+  def test_nan_round_trip(self):
+    self.kv_store["nan"] = float("nan")
+    self.assertTrue(math.isnan(self.kv_store["nan"]))
+    with KeyValueStore.from_bytes(self.kv_store.serialize()) as in_memory:
+      self.assertTrue(math.isnan(in_memory["nan"]))
+
+  def test_ttl(self):
+    self.kv_store.set("session", "token", ttl=0.05)
+    self.kv_store.set_many([("a", "1"), ("b", "2")], ttl=0.05)
+    self.kv_store["kept"] = "1"
+    self.assertEqual("token", self.kv_store["session"])
+    time.sleep(0.1)
+    self.assertNotIn("session", self.kv_store)
+    self.assertIsNone(self.kv_store.get("a"))
+    self.assertEqual(["kept"], self.kv_store.keys())
+    self.assertEqual(1, len(self.kv_store))
+    with self.assertRaises(KeyError):
+      del self.kv_store["b"]
+    self.assertEqual(2, self.kv_store.purge_expired())
+    with self.assertRaises(ValueError):
+      self.kv_store.set("never", "1", ttl=0)
+
+  def test_background_purge(self):
+    self.kv_store.set("session", "token", ttl=0.01)
+    self.kv_store.start_purge(interval=0.02)
+    time.sleep(0.2)
+    self.kv_store.close()
+    with self._other_reader() as reader:
+      self.assertEqual(0, reader.execute("SELECT COUNT(*) FROM kv").fetchone()[0])
+    self.kv_store = KeyValueStore(filename=self.kv_path)
+
+  def test_migrates_version_1(self):
+    legacy_path = Path(self.tmpdir.name, "legacy.sqlite")
+    with contextlib.closing(sqlite3.connect(legacy_path)) as legacy:
+      legacy.execute("CREATE TABLE kv (key text unique, value text)")
+      legacy.executemany("INSERT INTO kv VALUES (?, ?)", [("a", "1"), ("b", b"\x00"), ("c", 3), (None, "orphan")])
+      legacy.commit()
+    with KeyValueStore(filename=legacy_path) as migrated:
+      self.assertEqual([("a", "1"), ("b", b"\x00"), ("c", "3")], migrated.items())
+      self.assertEqual(SCHEMA_VERSION, migrated.conn.execute("PRAGMA user_version").fetchone()[0])
+      self.assertIn("WITHOUT ROWID", migrated.conn.execute("SELECT sql FROM sqlite_master WHERE name = 'kv'").fetchone()[0])
+      # Vacuumed, no free pages of the old table and its index are left behind
+      self.assertEqual(0, migrated.conn.execute("PRAGMA freelist_count").fetchone()[0])
+    with contextlib.closing(sqlite3.connect(":memory:")) as legacy:
+      legacy.execute("CREATE TABLE kv (key text unique, value text)")
+      legacy.execute("INSERT INTO kv VALUES ('a', '1')")
+      with KeyValueStore.from_bytes(legacy.serialize()) as in_memory:
+        self.assertEqual([("a", "1")], in_memory.items())
+        in_memory.set("b", 2)
+        self.assertEqual(2, in_memory["b"])
+
+  def test_cache_hits_and_eviction(self):
+    with KeyValueStore(filename=self.kv_path, cache_size=2) as cached:
+      cached.update({"a": "1", "b": "2", "c": "3"})
+      self.assertEqual("1", cached["a"])
+      self.assertEqual("1", cached["a"])
+      self.assertNotIn("missing", cached)
+      self.assertNotIn("missing", cached)
+      self.assertEqual("2", cached.get("b"))
+      info = cached.cache_info()
+      self.assertEqual((2, 3, 2, 2), (info.hits, info.misses, info.maxsize, info.currsize))
+
+  def test_cache_sees_own_writes(self):
+    with KeyValueStore(filename=self.kv_path, cache_size=8) as cached:
+      cached["key"] = "old"
+      self.assertEqual("old", cached["key"])
+      cached["key"] = "new"
+      self.assertEqual("new", cached["key"])
+      del cached["key"]
+      self.assertNotIn("key", cached)
+
+  def test_cache_invalidated_by_other_connection(self):
+    with KeyValueStore(filename=self.kv_path, cache_size=8) as cached:
+      self.kv_store["shared"] = "old"
+      self.assertEqual("old", cached["shared"])
+      self.kv_store["shared"] = "new"
+      self.assertEqual("new", cached["shared"])
+      self.assertIsNone(cached.get("other"))
+      self.kv_store["other"] = "present"
+      self.assertIn("other", cached)
+
+  def test_scan_prefix(self):
+    self.kv_store.update({"env/prod/a": "1", "env/prod/b": "2", "env/prodx": "3", "ssh/id": "4", "env/pro": "5"})
+    self.assertEqual([("env/prod/a", "1"), ("env/prod/b", "2")], list(self.kv_store.scan("env/prod/")))
+    self.assertEqual(["ssh/id"], [key for key, _ in self.kv_store.scan("ssh/")])
+    self.assertEqual(5, len(list(self.kv_store.scan())))
+
+  def test_range(self):
+    self.kv_store.set_many((f"k{i:03}", str(i)) for i in range(100))
+    self.assertEqual([f"k{i:03}" for i in range(10, 20)], [key for key, _ in self.kv_store.range("k010", "k020")])
+    self.assertEqual(5, len(list(self.kv_store.range(start="k095"))))
+    self.assertEqual(3, len(list(self.kv_store.range(end="k003", fetch_size=1))))
+
+  def test_streaming_iterators(self):
+    self.kv_store.fetch_size = 7
+    self.kv_store.set_many((str(i), str(i)) for i in range(50))
+    self.assertEqual(50, len(list(self.kv_store.iteritems())))
+    self.assertEqual(sorted(self.kv_store.keys()), sorted(self.kv_store.values()))
+
+  def tearDown(self):
+    self.kv_store.close()
+    self.tmpdir.cleanup()
+
+
+class TestSharedKeyValueStore(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.kv_store = SharedKeyValueStore(filename=Path(self.tmpdir.name, "kv_store.sqlite"), cache_size=16)
+    self.kv_store.set_many((f"key/{i}", str(i)) for i in range(256))
+
+  def test_parallel_reads(self):
+    with ThreadPoolExecutor(max_workers=8) as pool:
+      values = list(pool.map(lambda i: self.kv_store[f"key/{i % 256}"], range(2048)))
+    self.assertEqual([str(i % 256) for i in range(2048)], values)
+    self.assertEqual(2048, sum(self.kv_store.cache_info()[:2]))
+
+  def test_parallel_writes(self):
+    def write(worker: int):
+      for i in range(50):
+        self.kv_store[f"worker/{worker}/{i}"] = str(i)
+      with self.kv_store.transaction():
+        self.kv_store[f"worker/{worker}/done"] = "1"
+        return self.kv_store[f"worker/{worker}/done"]
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+      self.assertEqual(["1"] * 8, list(pool.map(write, range(8))))
+    self.assertEqual(8 * 51, len(list(self.kv_store.scan("worker/"))))
+
+  def test_reads_see_other_thread_writes(self):
+    self.assertEqual("0", self.kv_store["key/0"])
+    writer = threading.Thread(target=self.kv_store.__setitem__, args=("key/0", "changed"))
+    writer.start()
+    writer.join()
+    self.assertEqual("changed", self.kv_store["key/0"])
+
+  def test_memory_rejected(self):
+    with self.assertRaises(ValueError):
+      SharedKeyValueStore(filename=":memory:")
+
+  def tearDown(self):
+    self.kv_store.close()
+    self.tmpdir.cleanup()
+
+
+if __name__ == '__main__':
+  unittest.main()
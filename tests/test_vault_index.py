@@ -0,0 +1,91 @@
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+from pykeepass.pykeepass import PyKeePass
+
+from trapper_keeper.util.db_utils import ARTIFACTS_TITLE, PROPERTIES_TITLE, SPECIAL_BINARIES, DbUtils
+from trapper_keeper.util.kdf import KdfParameters
+from trapper_keeper.util.keegen import KeeAuth
+from trapper_keeper.util.vault_index import VaultIndex, index_path
+
+
+class TestVaultIndex(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.template_dir = tempfile.TemporaryDirectory()
+    kee_auth: KeeAuth = KeeAuth.batch([Path(cls.template_dir.name)])[0]
+    kee_auth.save()
+    cls.kp_token, cls.kp_key = kee_auth.kp_token[0], kee_auth.kp_key[0]
+    cls.artifact = Path(cls.template_dir.name, "env")
+    cls.artifact.write_text("PATH=/bin\n", encoding="utf-8")
+    cls.template_db = Path(cls.template_dir.name, "kp.kdbx")
+    DbUtils.create_tk_store(kp_fp=cls.template_db, kp_token=cls.kp_token, kp_key=cls.kp_key, artifacts=[cls.artifact],
+                            kdf=KdfParameters(iterations=1, memory_kib=1024, parallelism=1))
+
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.kp_fp = Path(shutil.copy(self.template_db, Path(self.tmpdir.name, "kp.kdbx")))
+
+  def _open(self) -> PyKeePass:
+    return PyKeePass(filename=self.kp_fp, password=self.kp_token.read_text(encoding="utf-8"), keyfile=self.kp_key)
+
+  def test_lookups(self):
+    kp_db = self._open()
+    index = VaultIndex.of(kp_db)
+    self.assertIs(index, VaultIndex.of(kp_db))
+    group = index.group(SPECIAL_BINARIES)
+    self.assertEqual(SPECIAL_BINARIES, group.name)
+    entry = index.entry(ARTIFACTS_TITLE, group)
+    self.assertEqual(entry, index.entry(ARTIFACTS_TITLE))
+    self.assertEqual(entry, index.entry_by_uuid(entry.uuid))
+    self.assertEqual(b"PATH=/bin\n", index.attachment(str(self.artifact)).binary)
+    self.assertIsNone(index.entry(PROPERTIES_TITLE, kp_db.root_group))
+    self.assertIsNone(index.attachment("/nowhere"))
+
+  def test_mutations(self):
+    kp_db = self._open()
+    index = VaultIndex.of(kp_db)
+    group = index.add_group(index.group(SPECIAL_BINARIES), "nested")
+    self.assertEqual(group, index.group((SPECIAL_BINARIES, "nested")))
+    entry = index.add_entry(group, "extra")
+    self.assertEqual(entry, index.entry("extra", group))
+    attachment = index.add_attachment(entry, kp_db.add_binary(b"data"), "/extra")
+    self.assertEqual(b"data", index.attachment("/extra", entry).binary)
+    index.delete_attachment(attachment)
+    self.assertIsNone(index.attachment("/extra"))
+
+    # Changed behind the index's back, the stale hit is noticed
+    entry.title = "renamed"
+    self.assertIsNone(index.entry("extra"))
+    self.assertEqual(entry, index.entry("renamed"))
+
+  def test_persisted(self):
+    self.assertEqual(index_path(self.kp_fp), DbUtils.index_tk_store(kp_fp=self.kp_fp, kp_token=self.kp_token,
+                                                                    kp_key=self.kp_key))
+    self.assertNotIn(ARTIFACTS_TITLE, index_path(self.kp_fp).read_text(encoding="utf-8"))
+    index = VaultIndex.of(self._open())
+    self.assertTrue(index.persistent)
+    self.assertEqual(b"PATH=/bin\n", index.attachment(str(self.artifact)).binary)
+
+    # Saves through a session keep the file current, a save behind its back makes it stale
+    self.artifact.write_text("PATH=/usr/bin\n", encoding="utf-8")
+    try:
+      DbUtils.pack_tk_store(kp_fp=self.kp_fp, kp_token=self.kp_token, kp_key=self.kp_key, artifacts=[self.artifact],
+                            use_agent=False)
+    finally:
+      self.artifact.write_text("PATH=/bin\n", encoding="utf-8")
+    kp_db = self._open()
+    self.assertIsNotNone(VaultIndex.load(kp_db))
+    self.assertEqual(b"PATH=/usr/bin\n", VaultIndex.of(kp_db).attachment(str(self.artifact)).binary)
+    kp_db.save()
+    self.assertIsNone(VaultIndex.load(kp_db))
+
+  def tearDown(self):
+    self.tmpdir.cleanup()
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.template_dir.cleanup()